@@ -0,0 +1,21 @@
+"""
+性能测试
+
+python -m benchmarks -o result.json
+python -m benchmarks -b result.json --threshold 0.1
+"""
+from .runner import Bench, measure, run, compare, report, load, dump
+from .cases import BENCHES, Env, bench
+
+__all__ = [
+    "Bench",
+    "BENCHES",
+    "Env",
+    "bench",
+    "measure",
+    "run",
+    "compare",
+    "report",
+    "load",
+    "dump",
+]
@@ -0,0 +1,68 @@
+import sys
+import asyncio
+import argparse
+
+from .runner import run, compare, report, load, dump
+from .cases import BENCHES, Env
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="restful_model benchmarks",
+    )
+    parser.add_argument(
+        "-k", "--filter",
+        action="append",
+        help="只执行名字或分组包含该字符串的测试项，可多次指定",
+    )
+    parser.add_argument("--rows", type=int, default=10000, help="生成的行数")
+    parser.add_argument("--repeat", type=int, default=5, help="重复轮数")
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.05,
+        help="每轮最少耗时，秒",
+    )
+    parser.add_argument("-o", "--output", help="结果写入的 json 文件")
+    parser.add_argument("-b", "--baseline", help="用于比较的基线 json 文件")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="最小值超过基线该比例时记为退化",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    benches = BENCHES
+    if args.filter:
+        benches = [
+            b for b in BENCHES
+            if any(k in b.name or k == b.group for k in args.filter)
+        ]
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    env = Env(loop, args.rows)
+    env.setup()
+    try:
+        echo = None if args.baseline else print
+        result = run(benches, env, args.repeat, args.min_time, echo)
+    finally:
+        env.close()
+        loop.close()
+    if args.output:
+        dump(result, args.output)
+    if args.baseline:
+        diff = compare(result, load(args.baseline), args.threshold)
+        lines, regressions = report(result, diff, args.threshold)
+        print("\n".join(lines))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
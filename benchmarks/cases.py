@@ -0,0 +1,300 @@
+"""
+测试项，数据表使用 tests/model.py 中的 User 和 Article
+"""
+import json
+import random
+from typing import List
+from urllib.parse import urlencode
+
+from restful_model import DataBase, BaseView, Context
+from restful_model.utils import (
+    handle_where_param,
+    handle_keys,
+    select_sql,
+    update_sql,
+    model_to_dict,
+    rows_to_dict,
+    return_true,
+)
+from tests.model import User, Article
+from .runner import Bench
+
+__all__ = ["BENCHES", "Env", "bench"]
+
+BENCHES: List[Bench] = []
+
+WHERE = {
+    "$or": {
+        "account": {"opt": "$like", "val": "user1%"},
+        "$and": {
+            "id": [
+                {"opt": "$gt", "val": 10},
+                {"opt": "$lte", "val": 5000},
+            ],
+            "role_name": {"opt": "$ne", "val": "admin"},
+            "$or": {
+                "email": {
+                    "opt": "$in",
+                    "val": ["a@test.com", "b@test.com", "c@test.com"],
+                },
+                "create_time": [
+                    {"opt": "$gte", "val": 1500000000},
+                    {"opt": "$lt", "val": 1600000000},
+                ],
+            },
+        },
+    },
+    "password": {"opt": "$ne", "val": None},
+}
+FUNC_KEYS = [
+    "id",
+    "account",
+    'lower("$account",):lower_account',
+    'length("$email",):email_len',
+    'coalesce("$role_name", "-"):role',
+    'max("$create_time",):latest',
+    {"column": "create_time", "func": "abs", "label": "abs_time"},
+]
+ORDERS = ["-create_time", "id"]
+
+
+def bench(name: str, group: str):
+    """
+    注册测试项
+    """
+    def decorator(setup):
+        BENCHES.append(Bench(name, setup, group))
+        return setup
+    return decorator
+
+
+def make_users(count: int, seed: int = 0) -> list:
+    rand = random.Random(seed)
+    roles = ("admin", "editor", "guest", "member")
+    return [
+        {
+            "id": i,
+            "account": "user%d" % i,
+            "role_name": rand.choice(roles),
+            "email": "user%d@test.com" % i,
+            "password": "%032x" % rand.getrandbits(128),
+            "create_time": 1500000000 + rand.randrange(100000000),
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def make_articles(count: int, users: int, seed: int = 1) -> list:
+    rand = random.Random(seed)
+    return [
+        {
+            "id": i,
+            "user_id": rand.randrange(1, users + 1),
+            "title": "title %d" % i,
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+class UserView(BaseView):
+    __model__ = User
+
+
+class ArticleView(BaseView):
+    __model__ = Article
+
+
+class Env(object):
+    """
+    内存 sqlite 数据库和生成的数据
+    """
+    def __init__(self, loop, rows: int = 10000):
+        self.loop = loop
+        self.rows = rows
+        self.db = DataBase("sqlite:///:memory:", loop)
+        self.users = make_users(rows)
+        self.articles = make_articles(rows, rows)
+        self._rows = None
+
+    def setup(self) -> None:
+        self.loop.run_until_complete(self._setup())
+
+    async def _setup(self) -> None:
+        db = self.db
+        db.engine = await db.create_engine()
+        await db.create_tables([User, Article])
+        await db.execute_dml(User.insert(), self.users)
+        await db.execute_dml(Article.insert(), self.articles)
+        self.user_view = UserView(db)
+        self.article_view = ArticleView(db)
+
+    def close(self) -> None:
+        self.loop.run_until_complete(self.db.close())
+
+    def rows_proxy(self) -> list:
+        """
+        查询出的整表 RowProxy
+        """
+        if self._rows is None:
+            self._rows = self.loop.run_until_complete(self._fetch_rows())
+        return self._rows
+
+    async def _fetch_rows(self) -> list:
+        async with self.db.engine.acquire() as conn:
+            async with conn.execute(User.select()) as cursor:
+                return await cursor.fetchall()
+
+
+def dispatch(
+        view: BaseView,
+        method: str,
+        url_param=None,
+        args=None,
+        form_data=None,
+):
+    """
+    每次调用由查询字符串和请求体新建 Context，与适配层的处理一致
+
+    :param args: 查询参数，值为 json 数据
+    """
+    query_string = urlencode({
+        k: json.dumps(v) for k, v in args.items()
+    }) if args else None
+    body = json.dumps(form_data).encode("utf-8") \
+        if form_data is not None else None
+
+    async def run():
+        context = Context.from_raw(
+            method,
+            "",
+            url_param=url_param,
+            query_string=query_string,
+            body=body,
+        )
+        resp = await view.dispatch_request(context)
+        assert resp["status"] < 400, resp
+    return run
+
+
+@bench("where_nested", "sql")
+def where_nested(env: Env):
+    columns = User.columns
+
+    def run():
+        handle_where_param(columns, WHERE)
+    return run
+
+
+@bench("keys_func", "sql")
+def keys_func(env: Env):
+    columns = User.columns
+
+    def run():
+        handle_keys(columns, FUNC_KEYS, return_true, "sqlite")
+    return run
+
+
+@bench("select_sql", "sql")
+def select_build(env: Env):
+    def run():
+        select_sql(
+            User,
+            WHERE,
+            keys=FUNC_KEYS,
+            orders=ORDERS,
+            limit=(20, 10),
+            group=["role_name"],
+            drivername="sqlite",
+        )
+    return run
+
+
+@bench("update_sql", "sql")
+def update_build(env: Env):
+    data = {
+        "where": {
+            "id": {"opt": "$in", "val": [1, 2, 3]},
+            "role_name": "guest",
+        },
+        "values": {
+            "email": "new@test.com",
+            "role_name": "member",
+            "create_time": "$incr.1",
+        },
+    }
+
+    def run():
+        update_sql(User, data)
+    return run
+
+
+@bench("model_to_dict", "convert")
+def convert_model_to_dict(env: Env):
+    rows = env.rows_proxy()
+
+    def run():
+        [model_to_dict(row) for row in rows]
+    return run
+
+
+@bench("rows_to_dict", "convert")
+def convert_rows_to_dict(env: Env):
+    rows = env.rows_proxy()
+    keys = rows[0].keys() if rows else []
+
+    def run():
+        rows_to_dict(keys, rows)
+    return run
+
+
+@bench("dispatch_get_pk", "dispatch")
+def dispatch_get_pk(env: Env):
+    return dispatch(env.user_view, "get", url_param={"id": 42})
+
+
+@bench("dispatch_get_page", "dispatch")
+def dispatch_get_page(env: Env):
+    return dispatch(
+        env.user_view,
+        "get",
+        args={
+            "where": {
+                "role_name": "guest",
+                "id": {"opt": "$gt", "val": 100},
+            },
+            "order": ORDERS,
+            "limit": [2, 20],
+        },
+    )
+
+
+@bench("dispatch_get_keys", "dispatch")
+def dispatch_get_keys(env: Env):
+    return dispatch(
+        env.article_view,
+        "get",
+        args={
+            "keys": ["user_id", 'count("$id",):total'],
+            "group": ["user_id"],
+            "where": {"user_id": {"opt": "$lt", "val": 50}},
+        },
+    )
+
+
+@bench("dispatch_post", "dispatch")
+def dispatch_post(env: Env):
+    return dispatch(
+        env.article_view,
+        "post",
+        form_data={"user_id": 1, "title": "bench"},
+    )
+
+
+@bench("dispatch_put", "dispatch")
+def dispatch_put(env: Env):
+    return dispatch(
+        env.user_view,
+        "put",
+        url_param={"id": 7},
+        form_data={"values": {"role_name": "editor"}},
+    )
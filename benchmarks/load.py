@@ -0,0 +1,444 @@
+"""
+HTTP 压测，子进程启动 sanic 或 tornado 应用，asyncio 客户端固定并发发送请求
+
+python -m benchmarks.load sanic --concurrency 32 --duration 10
+python -m benchmarks.load tornado --workers 4 --mix get_pk=1,insert=1
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from urllib.parse import quote
+from typing import Callable, Dict, List, Tuple
+
+from .server import ADAPTERS, prepare_db, serve
+from .runner import dump
+
+__all__ = ["OPS", "parse_mix", "percentile", "summary", "Client", "main"]
+
+DEFAULT_MIX = "get_pk=40,list=20,page=20,insert=10,polymerization=10"
+
+
+def query(path: str, **kwargs) -> str:
+    return path + "?" + "&".join(
+        "%s=%s" % (k, quote(json.dumps(v, separators=(",", ":"))))
+        for k, v in kwargs.items()
+    )
+
+
+def op_get_pk(rand: random.Random, rows: int):
+    return "GET", "/user/%d" % rand.randint(1, rows), None
+
+
+def op_list(rand: random.Random, rows: int):
+    start = rand.randint(1, max(rows - 50, 1))
+    return "GET", query("/user", where={
+        "id": [
+            {"opt": "$gte", "val": start},
+            {"opt": "$lt", "val": start + 50},
+        ],
+        "role_name": {"opt": "$ne", "val": "admin"},
+    }), None
+
+
+def op_page(rand: random.Random, rows: int):
+    return "GET", query(
+        "/article",
+        where={"user_id": {"opt": "$lte", "val": max(rows // 10, 1)}},
+        order=["-id"],
+        limit=[rand.randint(0, 10) * 20, 20],
+    ), None
+
+
+def op_insert(rand: random.Random, rows: int):
+    return "POST", "/article", {
+        "user_id": rand.randint(1, rows),
+        "title": "load %d" % rand.getrandbits(32),
+    }
+
+
+def op_polymerization(rand: random.Random, rows: int):
+    account = "load%d" % rand.getrandbits(32)
+    return "POST", "/polymerization/post", [
+        {"name": "user", "data": {
+            "account": account,
+            "role_name": "guest",
+            "email": account + "@test.com",
+            "password": "123456",
+            "create_time": int(time.time()),
+        }},
+        {"name": "article", "data": {"user_id": "$user.id", "title": "p"}},
+    ]
+
+
+OPS: Dict[str, Callable] = {
+    "get_pk": op_get_pk,
+    "list": op_list,
+    "page": op_page,
+    "insert": op_insert,
+    "polymerization": op_polymerization,
+}
+
+
+def parse_mix(mix: str) -> List[Tuple[str, int]]:
+    """
+    get_pk=4,insert=1 -> [("get_pk", 4), ("insert", 1)]
+    """
+    res = []
+    for item in mix.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in OPS:
+            raise ValueError("unknown op: %s" % name)
+        weight = int(weight) if weight else 1
+        if weight > 0:
+            res.append((name, weight))
+    if not res:
+        raise ValueError("empty mix")
+    return res
+
+
+class Client(object):
+    """
+    一个 keep-alive 的 HTTP/1.1 连接
+    """
+    __slots__ = ("host", "port", "reader", "writer")
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host,
+            self.port,
+        )
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method: str, path: str, body=None):
+        """
+        :return: (状态码, 响应内容)
+        """
+        if self.writer is None:
+            await self.connect()
+        head = "%s %s HTTP/1.1\r\nHost: %s:%d\r\n" % (
+            method,
+            path,
+            self.host,
+            self.port,
+        )
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            head += "Content-Type: application/json\r\n"
+            head += "Content-Length: %d\r\n" % len(data)
+        else:
+            data = b""
+        self.writer.write(head.encode("latin-1") + b"\r\n" + data)
+        try:
+            return await self.read_response()
+        except Exception:
+            self.close()
+            raise
+
+    async def read_response(self):
+        reader = self.reader
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        status = int(line.split(b" ", 2)[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        else:
+            body = await reader.readexactly(
+                int(headers.get("content-length", 0)),
+            )
+        if headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, body
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    最近秩百分位，values 需已排序
+    """
+    if not values:
+        return 0.0
+    index = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summary(latencies: List[float], errors: int, elapsed: float) -> dict:
+    values = sorted(latencies)
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "rps": len(values) / elapsed if elapsed else 0.0,
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": values[-1] if values else 0.0,
+    }
+
+
+async def worker(
+        host: str,
+        port: int,
+        mix: List[Tuple[str, int]],
+        rows: int,
+        rand: random.Random,
+        start_at: float,
+        stop_at: float,
+        stats: Dict[str, list],
+) -> None:
+    """
+    顺序发送请求，start_at 之前为预热不计入统计
+    """
+    client = Client(host, port)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    try:
+        while True:
+            name = rand.choices(names, weights)[0]
+            method, path, body = OPS[name](rand, rows)
+            begin = time.perf_counter()
+            if begin >= stop_at:
+                break
+            try:
+                status, _ = await client.request(method, path, body)
+                ok = status < 400
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                ok = False
+            end = time.perf_counter()
+            if begin < start_at:
+                continue
+            item = stats[name]
+            if ok:
+                item[0].append(end - begin)
+            else:
+                item[1] += 1
+    finally:
+        client.close()
+
+
+async def drive(
+        host: str,
+        port: int,
+        mix: List[Tuple[str, int]],
+        rows: int,
+        concurrency: int,
+        duration: float,
+        warmup: float,
+        seed: int,
+) -> dict:
+    stats = {name: [[], 0] for name, _ in mix}
+    now = time.perf_counter()
+    start_at = now + warmup
+    stop_at = start_at + duration
+    await asyncio.gather(*(
+        worker(
+            host,
+            port,
+            mix,
+            rows,
+            random.Random(seed + i),
+            start_at,
+            stop_at,
+            stats,
+        )
+        for i in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - start_at
+    latencies = []
+    errors = 0
+    ops = {}
+    for name, (values, errs) in stats.items():
+        ops[name] = summary(values, errs, elapsed)
+        latencies.extend(values)
+        errors += errs
+    return {"total": summary(latencies, errors, elapsed), "ops": ops}
+
+
+async def wait_ready(
+        host: str,
+        port: int,
+        process=None,
+        timeout: float = 30.0,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            if process is not None and not process.is_alive():
+                raise RuntimeError("server exited: %s" % process.exitcode)
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+            continue
+        writer.close()
+        return
+
+
+def free_port(host: str) -> int:
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def run_server(*args) -> None:
+    # 独立进程组，结束时连同 worker 子进程一起结束
+    os.setsid()
+    serve(*args)
+
+
+def stop_server(process) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    process.join(10)
+    if process.is_alive():
+        os.killpg(process.pid, signal.SIGKILL)
+        process.join()
+
+
+def format_ms(seconds: float) -> str:
+    return "%.2f" % (seconds * 1000)
+
+
+def format_report(adapter: str, result: dict) -> str:
+    lines = ["%s  concurrency %d  workers %d  loop %s  %.1fs" % (
+        adapter,
+        result["concurrency"],
+        result["workers"],
+        result["loop"],
+        result["duration"],
+    )]
+    lines.append("%-16s %9s %7s %10s %9s %9s %9s %9s" % (
+        "op", "requests", "errors", "req/s",
+        "p50 ms", "p95 ms", "p99 ms", "max ms",
+    ))
+    items = list(result["ops"].items()) + [("total", result["total"])]
+    for name, item in items:
+        lines.append("%-16s %9d %7d %10.1f %9s %9s %9s %9s" % (
+            name,
+            item["requests"],
+            item["errors"],
+            item["rps"],
+            format_ms(item["p50"]),
+            format_ms(item["p95"]),
+            format_ms(item["p99"]),
+            format_ms(item["max"]),
+        ))
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.load",
+        description="restful_model http load test",
+    )
+    parser.add_argument("adapter", choices=ADAPTERS)
+    parser.add_argument("-c", "--concurrency", type=int, default=32)
+    parser.add_argument("-d", "--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help="请求比例，可选 %s" % ", ".join(OPS),
+    )
+    parser.add_argument("--rows", type=int, default=10000, help="生成的行数")
+    parser.add_argument("--workers", type=int, default=1, help="服务进程数")
+    parser.add_argument(
+        "--loop",
+        choices=("auto", "asyncio", "uvloop"),
+        default="auto",
+        help="服务端事件循环",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0, help="0 为随机端口")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="结果写入的 json 文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    mix = parse_mix(args.mix)
+    port = args.port or free_port(args.host)
+    tmp = tempfile.mkdtemp(prefix="restful_model_load_")
+    path = os.path.join(tmp, "load.db")
+    prepare_db(path, args.rows)
+    process = multiprocessing.get_context("spawn").Process(
+        target=run_server,
+        args=(args.adapter, path, args.host, port, args.workers, args.loop),
+    )
+    process.start()
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(wait_ready(args.host, port, process))
+        result = loop.run_until_complete(drive(
+            args.host,
+            port,
+            mix,
+            args.rows,
+            args.concurrency,
+            args.duration,
+            args.warmup,
+            args.seed,
+        ))
+    finally:
+        loop.close()
+        stop_server(process)
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+    result.update(
+        adapter=args.adapter,
+        concurrency=args.concurrency,
+        workers=args.workers,
+        loop=args.loop,
+        duration=args.duration,
+        mix=dict(mix),
+    )
+    print(format_report(args.adapter, result))
+    if args.output:
+        dump(result, args.output)
+    return 1 if result["total"]["errors"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
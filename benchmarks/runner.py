@@ -0,0 +1,222 @@
+import gc
+import asyncio
+import json
+import time
+import platform
+import statistics
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import sqlalchemy as sa
+
+__all__ = ["Bench", "measure", "run", "compare", "report", "load", "dump"]
+
+
+class Bench(object):
+    """
+    一个测试项，setup(env) 返回被计时的函数，可以是协程函数
+    """
+    __slots__ = ("name", "setup", "group")
+
+    def __init__(self, name: str, setup: Callable, group: str):
+        self.name = name
+        self.setup = setup
+        self.group = group
+
+
+def _timer(func, loop):
+    """
+    返回 timer(number)，执行 number 次的总耗时，协程在 loop 内计时
+    """
+    if loop is None:
+        def timer(number: int) -> float:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            return time.perf_counter() - start
+        return timer
+
+    async def timed(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return time.perf_counter() - start
+
+    def timer(number: int) -> float:
+        return loop.run_until_complete(timed(number))
+    return timer
+
+
+def autorange(timer, min_time: float) -> int:
+    """
+    按 1, 2, 5, 10, 20, 50 ... 增加次数，直到单轮耗时超过 min_time
+    """
+    scale = 1
+    while True:
+        for step in (1, 2, 5):
+            number = scale * step
+            if timer(number) >= min_time:
+                return number
+        scale *= 10
+
+
+def measure(
+        func: Callable,
+        loop=None,
+        repeat: int = 5,
+        min_time: float = 0.05,
+) -> dict:
+    """
+    与 timeit 一致，先找到单轮耗时超过 min_time 的次数再重复 repeat 轮，
+    计时期间关闭 gc；内存为单次执行的峰值和执行后多占用的块数
+    """
+    timer = _timer(func, loop)
+    # 预热，填充语句缓存等
+    timer(1)
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        number = autorange(timer, min_time)
+        elapsed = timer(number)
+        samples = [elapsed / number]
+        for _ in range(repeat - 1):
+            samples.append(timer(number) / number)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = len(tracemalloc.take_snapshot().traces)
+        timer(1)
+        _, peak = tracemalloc.get_traced_memory()
+        blocks = len(tracemalloc.take_snapshot().traces) - before
+    finally:
+        tracemalloc.stop()
+    return {
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "loops": number,
+        "repeat": len(samples),
+        "peak_bytes": peak,
+        "blocks": blocks,
+    }
+
+
+def run(
+        benches: List[Bench],
+        env,
+        repeat: int = 5,
+        min_time: float = 0.05,
+        echo: Optional[Callable] = None,
+) -> dict:
+    """
+    依次执行所有测试项，返回可写入 json 的结果
+    """
+    results = {}
+    for bench in benches:
+        func = bench.setup(env)
+        loop = env.loop if _is_coroutine(func) else None
+        res = measure(func, loop, repeat, min_time)
+        res["group"] = bench.group
+        results[bench.name] = res
+        if echo is not None:
+            echo(format_line(bench.name, res))
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "sqlalchemy": sa.__version__,
+            "platform": platform.platform(),
+            "rows": env.rows,
+        },
+        "results": results,
+    }
+
+
+def _is_coroutine(func) -> bool:
+    return asyncio.iscoroutinefunction(func)
+
+
+def format_time(seconds: float) -> str:
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return "%.3f %s" % (seconds / scale, unit)
+    return "%.1f ns" % (seconds / 1e-9)
+
+
+def format_line(name: str, res: dict, ratio: Optional[float] = None) -> str:
+    line = "%-24s %11s  min %11s  +-%5.1f%%  %7d loops  %8.1f KiB  %5d blocks"
+    line = line % (
+        name,
+        format_time(res["median"]),
+        format_time(res["min"]),
+        res["stdev"] / res["median"] * 100 if res["median"] else 0.0,
+        res["loops"],
+        res["peak_bytes"] / 1024,
+        res["blocks"],
+    )
+    if ratio is not None:
+        line += "  x%.3f" % ratio
+    return line
+
+
+def compare(
+        current: dict,
+        baseline: dict,
+        threshold: float = 0.1,
+) -> Dict[str, dict]:
+    """
+    与基线比较每项的最小值，超过 1 + threshold 倍记为退化，
+    最小值受机器上其他负载的影响最小
+
+    :return: {name: {"ratio": 倍数, "regression": bool}}
+    """
+    res = {}
+    base_results = baseline.get("results", {})
+    for name, item in current.get("results", {}).items():
+        base = base_results.get(name)
+        if base is None or not base.get("min"):
+            continue
+        ratio = item["min"] / base["min"]
+        res[name] = {
+            "ratio": ratio,
+            "regression": ratio > 1 + threshold,
+        }
+    return res
+
+
+def report(current: dict, diff: Dict[str, dict], threshold: float):
+    """
+    比较结果的文本行和退化项的名字
+    """
+    lines = []
+    regressions = []
+    for name, item in current["results"].items():
+        d = diff.get(name)
+        if d is None:
+            lines.append(format_line(name, item) + "  (new)")
+            continue
+        line = format_line(name, item, d["ratio"])
+        if d["regression"]:
+            line += "  REGRESSION"
+            regressions.append(name)
+        lines.append(line)
+    lines.append("%d regression(s), threshold %.0f%%" % (
+        len(regressions),
+        threshold * 100,
+    ))
+    return lines, regressions
+
+
+def load(path: str) -> dict:
+    with open(path, "rt", encoding="utf8") as f:
+        return json.load(f)
+
+
+def dump(data: dict, path: str) -> None:
+    with open(path, "wt", encoding="utf8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
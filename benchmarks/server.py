@@ -0,0 +1,170 @@
+"""
+压测用的 sanic 和 tornado 应用，数据库为本地 sqlite 文件
+
+在子进程中通过 serve() 启动，sanic 和 tornado 只在对应的函数内导入
+"""
+import os
+import asyncio
+
+import sqlalchemy as sa
+
+from restful_model import DataBase
+from tests.model import metadata, User, Article
+from .cases import make_users, make_articles
+
+__all__ = ["ADAPTERS", "prepare_db", "serve"]
+
+ADAPTERS = ("sanic", "tornado")
+
+
+def prepare_db(path: str, rows: int) -> None:
+    """
+    同步写入生成的数据并开启 WAL，多个 worker 读写同一个文件
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    engine = sa.create_engine("sqlite:///%s" % path)
+    try:
+        with engine.begin() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            metadata.create_all(conn, tables=[User, Article])
+            conn.execute(User.insert(), make_users(rows))
+            conn.execute(Article.insert(), make_articles(rows, rows))
+    finally:
+        engine.dispose()
+
+
+def use_loop(name: str) -> None:
+    if name == "uvloop":
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif name == "asyncio":
+        # 新版 sanic 读取该变量，不自动使用 uvloop
+        os.environ["SANIC_NO_UVLOOP"] = "true"
+
+
+def serve(
+        adapter: str,
+        path: str,
+        host: str,
+        port: int,
+        workers: int = 1,
+        loop: str = "auto",
+) -> None:
+    """
+    启动服务直到进程被结束
+
+    :param loop: auto 使用框架默认的事件循环，asyncio 或 uvloop
+    """
+    use_loop(loop)
+    if adapter == "sanic":
+        serve_sanic(path, host, port, workers)
+    elif adapter == "tornado":
+        serve_tornado(path, host, port, workers)
+    else:
+        raise ValueError("unknown adapter: %s" % adapter)
+
+
+def serve_sanic(path: str, host: str, port: int, workers: int) -> None:
+    from sanic import Sanic
+    from sanic.constants import HTTP_METHODS
+    from restful_model.extend.sanic import ApiView, PolymerizationView
+
+    class UserView(ApiView):
+        __model__ = User
+
+    class ArticleView(ApiView):
+        __model__ = Article
+
+    app = Sanic("restful_model_bench")
+    db = DataBase("sqlite:///%s" % path)
+
+    @app.listener("before_server_start")
+    async def setup_db(app, loop):
+        db.loop = loop
+        db.engine = await db.create_engine()
+
+    @app.listener("after_server_stop")
+    async def close_db(app, loop):
+        await db.close()
+
+    user_view = UserView.as_view(db)
+    article_view = ArticleView.as_view(db)
+    polymerization = PolymerizationView(db)
+    polymerization.add_view(user_view.view)
+    polymerization.add_view(article_view.view)
+    app.add_route(user_view, "/user", HTTP_METHODS)
+    app.add_route(user_view, "/user/<id:int>", HTTP_METHODS)
+    app.add_route(article_view, "/article", HTTP_METHODS)
+    app.add_route(article_view, "/article/<id:int>", HTTP_METHODS)
+    app.add_route(
+        polymerization.as_view("post"),
+        "/polymerization/post",
+        ["POST"],
+    )
+    app.run(
+        host=host,
+        port=port,
+        workers=workers,
+        debug=False,
+        access_log=False,
+    )
+
+
+def serve_tornado(path: str, host: str, port: int, workers: int) -> None:
+    import tornado.web
+    import tornado.ioloop
+    import tornado.netutil
+    import tornado.process
+    import tornado.httpserver
+    from restful_model import BasePolymerization, Context
+    from restful_model.extend.tornado import ApiView
+    from restful_model.extend.tornado.view import write_response
+
+    class UserView(ApiView):
+        __model__ = User
+
+    class ArticleView(ApiView):
+        __model__ = Article
+
+    sockets = tornado.netutil.bind_sockets(port, host)
+    if workers > 1:
+        # 在创建事件循环和连接池之前 fork
+        tornado.process.fork_processes(workers)
+
+    async def make_app():
+        db = DataBase("sqlite:///%s" % path, asyncio.get_event_loop())
+        db.engine = await db.create_engine()
+        user_handler = UserView.as_view(db)
+        article_handler = ArticleView.as_view(db)
+        polymerization = BasePolymerization(db)
+        polymerization.add_view(user_handler.view)
+        polymerization.add_view(article_handler.view)
+
+        class PolymerizationHandler(tornado.web.RequestHandler):
+            """
+            tornado 扩展没有聚合视图，直接调用 BasePolymerization
+            """
+            async def post(self):
+                context = Context.from_raw(
+                    "post",
+                    self.request.path,
+                    self.request.headers,
+                    body=self.request.body,
+                )
+                resp = await polymerization.dispatch_request(context)
+                await write_response(self, resp)
+
+        return tornado.web.Application([
+            ("/user", user_handler),
+            (r"/user/(?P<id>\d+)", user_handler),
+            ("/article", article_handler),
+            (r"/article/(?P<id>\d+)", article_handler),
+            ("/polymerization/post", PolymerizationHandler),
+        ])
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    app = io_loop.run_sync(make_app)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    io_loop.start()
@@ -1,7 +1,8 @@
 from sanic import Sanic
 from sanic.constants import HTTP_METHODS
 from restful_model import DataBase
-from restful_model.extend.sanic import ApiView, PolymerizationView
+from restful_model.extend.sanic import ApiView, PolymerizationView, metrics_view
+from restful_model.metrics import Metrics
 from .model import User, UserConfig
 import logging
 from datetime import datetime, timezone, timedelta
@@ -29,8 +30,12 @@ def get_offset_timestamp(zone=None, **kwargs) -> int:
     return to_timestamp(datetime.now(zone).replace(tzinfo=timezone.utc) + timedelta(**kwargs))
 
 
+metrics = Metrics()
+
+
 class UserView(ApiView):
     __model__ = User
+    __metrics__ = metrics
     __methods__ = {"post", "get", "put", "delete"}
     __filter_keys__ = {
         "post": ({"id",},),
@@ -76,6 +81,7 @@ app.add_route(pView.as_view("post"), "/polymerization/post", HTTP_METHODS)
 app.add_route(pView.as_view("delete"), "/polymerization/delete", HTTP_METHODS)
 app.add_route(pView.as_view("put"), "/polymerization/put", HTTP_METHODS)
 app.add_route(pView.as_view("patch"), "/polymerization/patch", HTTP_METHODS)
+app.add_route(metrics_view(metrics), "/metrics")
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
@@ -0,0 +1,383 @@
+"""
+asyncpg 的 sa 风格封装，接口与 aiopg.sa 一致
+
+engine.acquire() -> SAConnection
+conn.execute(sql, params) -> ResultProxy
+conn.begin() -> Transaction
+
+语句编译为 $1 形式的位置参数，由 asyncpg 在每个连接上缓存服务端预处理语句，
+结果使用 asyncpg 的二进制协议解码
+"""
+import json
+import logging
+import asyncpg
+import sqlalchemy as sa
+from sqlalchemy.sql import ClauseElement
+from sqlalchemy.sql.compiler import DDLCompiler
+from sqlalchemy.dialects.postgresql.base import PGDialect, PGCompiler
+
+__all__ = ["create_engine", "Engine", "SAConnection", "ResultProxy", "Row"]
+
+LOGGER = logging.getLogger(__package__)
+
+
+class Row(asyncpg.Record):
+    """
+    支持 row.name 访问字段
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class AsyncpgCompiler(PGCompiler):
+    """
+    展开参数(bindparam(..., expanding=True))不按值的个数展开，
+    作为一个数组参数绑定: x IN (...) 编译为 x = ANY($1)，
+    NOT IN 编译为 x != ALL($1)，语句不随列表长度变化
+    """
+    def bindparam_string(self, name, **kw):
+        super().bindparam_string(name, **kw)
+        # numeric 风格编译完成后 [_POSITION] 替换为序号
+        return "$[_POSITION]"
+
+    def visit_in_op_binary(self, binary, operator, **kw):
+        if getattr(binary.right, "expanding", False):
+            return self.array_binary(binary, "= ANY", **kw)
+        return self._generate_generic_binary(binary, " IN ", **kw)
+
+    def visit_notin_op_binary(self, binary, operator, **kw):
+        if getattr(binary.right, "expanding", False):
+            return self.array_binary(binary, "!= ALL", **kw)
+        return self._generate_generic_binary(binary, " NOT IN ", **kw)
+
+    def array_binary(self, binary, opstring: str, **kw) -> str:
+        return "%s %s(%s)" % (
+            binary.left._compiler_dispatch(self, **kw),
+            opstring,
+            binary.right._compiler_dispatch(self, **kw),
+        )
+
+
+class AsyncpgDialect(PGDialect):
+    """
+    不连接数据库初始化，服务端特性与 aiopg.sa 的设置一致
+    """
+    driver = "asyncpg"
+    statement_compiler = AsyncpgCompiler
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault("paramstyle", "numeric")
+        kwargs.setdefault("json_serializer", json.dumps)
+        super().__init__(**kwargs)
+        # 单行插入带 RETURNING 主键
+        self.implicit_returning = True
+        self.supports_native_enum = True
+        self.supports_smallserial = True
+        self._backslash_escapes = False
+        self.supports_sane_multi_rowcount = True
+        self._has_native_hstore = True
+
+
+def distill_params(multiparams, params) -> list:
+    """
+    统一执行参数为 dict 列表，多个时逐条执行
+    """
+    if multiparams:
+        zero = multiparams[0]
+        if isinstance(zero, (list, tuple)):
+            return list(zero) or [{}]
+        if isinstance(zero, dict):
+            return [zero]
+    return [params]
+
+
+def bind_args(compiled, data: dict) -> list:
+    """
+    按位置生成执行参数，展开参数的每个值分别经过类型处理
+    """
+    values = compiled.construct_params(data)
+    processors = compiled._bind_processors
+    binds = compiled.binds
+    args = []
+    for name in compiled.positiontup:
+        value = values[name]
+        processor = processors.get(name)
+        if binds[name].expanding:
+            value = list(value)
+            if processor is not None:
+                value = [processor(v) for v in value]
+        elif processor is not None:
+            value = processor(value)
+        args.append(value)
+    return args
+
+
+def parse_status(status: str) -> int:
+    """
+    从 INSERT 0 5 / UPDATE 3 / DELETE 2 中取出影响行数
+    """
+    if status:
+        count = status.rsplit(" ", 1)[-1]
+        if count.isdigit():
+            return int(count)
+    return -1
+
+
+class ResultProxy(object):
+    """
+    一次性取回的结果集
+    """
+    __slots__ = ("_rows", "_index", "_keys", "rowcount", "returns_rows")
+
+    lastrowid = None
+
+    def __init__(self, rows, keys, rowcount: int, returns_rows: bool):
+        self._rows = rows
+        self._index = 0
+        self._keys = keys
+        self.rowcount = rowcount
+        self.returns_rows = returns_rows
+
+    def keys(self):
+        # text 语句没有编译出的字段名，从结果取
+        if self._keys or not self._rows:
+            return self._keys
+        return list(self._rows[0].keys())
+
+    async def first(self):
+        rows = self._rows
+        self._index = len(rows)
+        return rows[0] if rows else None
+
+    async def fetchone(self):
+        rows = self._rows
+        if self._index < len(rows):
+            self._index += 1
+            return rows[self._index - 1]
+        return None
+
+    async def fetchmany(self, size: int = 1):
+        start = self._index
+        self._index = min(start + size, len(self._rows))
+        return self._rows[start:self._index]
+
+    async def fetchall(self):
+        start = self._index
+        self._index = len(self._rows)
+        return self._rows[start:]
+
+    def close(self):
+        self._rows = []
+
+
+class _ContextManager(object):
+    """
+    既可以 await 也可以 async with
+    """
+    __slots__ = ("_coro", "_obj", "_exit")
+
+    def __init__(self, coro, exit=None):
+        self._coro = coro
+        self._obj = None
+        self._exit = exit
+
+    def __await__(self):
+        return self._coro.__await__()
+
+    async def __aenter__(self):
+        self._obj = await self._coro
+        return self._obj
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._exit is not None:
+            await self._exit(self._obj, exc_type)
+        self._obj = None
+
+
+async def _close_result(result, exc_type):
+    result.close()
+
+
+async def _end_transaction(transaction, exc_type):
+    if exc_type is not None:
+        await transaction.rollback()
+    else:
+        await transaction.commit()
+
+
+class Transaction(object):
+    __slots__ = ("_transaction", "is_active")
+
+    def __init__(self, transaction):
+        self._transaction = transaction
+        self.is_active = True
+
+    async def commit(self):
+        if self.is_active:
+            self.is_active = False
+            await self._transaction.commit()
+
+    async def rollback(self):
+        if self.is_active:
+            self.is_active = False
+            await self._transaction.rollback()
+
+
+class SAConnection(object):
+    __slots__ = ("connection", "engine")
+
+    def __init__(self, connection, engine: "Engine"):
+        self.connection = connection
+        self.engine = engine
+
+    def execute(self, query, *multiparams, **params) -> _ContextManager:
+        return _ContextManager(
+            self._execute(query, multiparams, params),
+            _close_result,
+        )
+
+    async def _execute(self, query, multiparams, params) -> ResultProxy:
+        if isinstance(query, str):
+            query = sa.text(query)
+        if not isinstance(query, ClauseElement):
+            raise TypeError("not support query: %r" % query)
+        engine = self.engine
+        compiled = query.compile(dialect=engine.dialect)
+        sql = compiled.string
+        if engine.echo:
+            LOGGER.info(sql)
+        if isinstance(compiled, DDLCompiler):
+            status = await self.connection.execute(sql)
+            return ResultProxy([], [], parse_status(status), False)
+        is_dml = compiled.isinsert or compiled.isupdate or compiled.isdelete
+        returns_rows = not is_dml or bool(compiled.returning)
+        keys = [c[0] for c in compiled._result_columns]
+        rows = []
+        rowcount = 0
+        for data in distill_params(multiparams, params):
+            args = bind_args(compiled, data)
+            if returns_rows:
+                records = await self.connection.fetch(sql, *args)
+                rows.extend(records)
+                rowcount += len(records)
+            else:
+                status = await self.connection.execute(sql, *args)
+                rowcount += parse_status(status)
+        return ResultProxy(rows, keys, rowcount, returns_rows)
+
+    def begin(self) -> _ContextManager:
+        return _ContextManager(self._begin(), _end_transaction)
+
+    async def _begin(self) -> Transaction:
+        transaction = self.connection.transaction()
+        await transaction.start()
+        return Transaction(transaction)
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.connection.is_in_transaction()
+
+
+async def _release(conn, exc_type):
+    await conn.engine.release(conn)
+
+
+async def _init_connection(connection):
+    # 与 psycopg2 一致，json 查询结果解码为对象，参数已由 sa 编码
+    for name in ("json", "jsonb"):
+        await connection.set_type_codec(
+            name,
+            encoder=str,
+            decoder=json.loads,
+            schema="pg_catalog",
+        )
+
+
+class Engine(object):
+    """
+    asyncpg 连接池
+    """
+    def __init__(self, pool, dialect, echo=False):
+        self._pool = pool
+        self.dialect = dialect
+        self.echo = echo
+        self.closed = False
+
+    @property
+    def name(self):
+        return self.dialect.name
+
+    @property
+    def driver(self):
+        return self.dialect.driver
+
+    @property
+    def minsize(self):
+        return self._pool.get_min_size()
+
+    @property
+    def maxsize(self):
+        return self._pool.get_max_size()
+
+    @property
+    def size(self):
+        return self._pool.get_size()
+
+    @property
+    def freesize(self):
+        return self._pool.get_idle_size()
+
+    def acquire(self) -> _ContextManager:
+        return _ContextManager(self._acquire(), _release)
+
+    async def _acquire(self) -> SAConnection:
+        if self.closed:
+            raise RuntimeError("engine is closed")
+        return SAConnection(await self._pool.acquire(), self)
+
+    async def release(self, conn: SAConnection):
+        await self._pool.release(conn.connection)
+
+    def close(self):
+        """
+        不再获取新连接，wait_closed 时等待连接归还后关闭
+        """
+        self.closed = True
+
+    def terminate(self):
+        self.closed = True
+        self._pool.terminate()
+
+    async def wait_closed(self):
+        await self._pool.close()
+
+
+async def create_engine(
+        dsn=None,
+        *,
+        minsize=1,
+        maxsize=10,
+        loop=None,
+        echo=False,
+        statement_cache_size=100,
+        **kwargs,
+) -> Engine:
+    """
+    创建 asyncpg 连接池，参数名与 aiopg.sa.create_engine 保持一致
+
+    :param statement_cache_size: 每个连接缓存的预处理语句数
+    """
+    pool = await asyncpg.create_pool(
+        dsn,
+        min_size=minsize,
+        max_size=maxsize,
+        loop=loop,
+        record_class=Row,
+        statement_cache_size=statement_cache_size,
+        init=_init_connection,
+        **kwargs,
+    )
+    return Engine(pool, AsyncpgDialect(), echo)
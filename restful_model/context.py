@@ -1,15 +1,49 @@
+import json
+from types import MappingProxyType
+from urllib.parse import parse_qs
 from typing import Dict, List, Union, Any, Optional
+from .metrics import NULL_TIMER
+from .utils import fingerprint, LOGGER
 
 
 NAMES = ("form_data", "args")
+# GET 时从查询参数 json 解析到 form_data 的字段
+QUERY_ARGS = ("keys", "where", "limit", "order", "group", "include")
+# 不需要 json 解析的查询参数
+RAW_QUERY_ARGS = ("cursor", "count", "stream", "format")
+# 共享的空请求头，不可修改
+EMPTY_HEADERS = MappingProxyType({})
 
 
 class Context(object):
+    """
+    请求上下文
+
+    form_data、args、raw_args 在第一次访问时才解析并缓存，
+    只用到 url 参数的请求不会解析查询参数和请求体
+    """
+    __slots__ = (
+        "method",
+        "url_path",
+        "header",
+        "url_param",
+        "sessions",
+        "has_param",
+        "filter_keys",
+        "timer",
+        "_form_data",
+        "_built",
+        "_args",
+        "_raw_args",
+        "_query_string",
+        "_body",
+    )
+
     def __init__(
             self,
             method: str,
             url_path: str = "",
-            headers: Dict[str, Union[str, List[str]]] = {},
+            headers: Dict[str, Union[str, List[str]]] = EMPTY_HEADERS,
             url_param: Optional[Dict[str, Any]] = None,
             form_data: Optional[Dict[str, Any]] = None,
             args: Optional[Dict[str, Any]] = None,
@@ -18,27 +52,135 @@ class Context(object):
     ):
         self.method = method
         self.url_path = url_path
-        self.form_data: Optional[Dict[str, Any]] = (form_data or {})
-        self.has_param = False
-        if url_param and len(url_param) > 0:
-            if method != "delete":
-                where = self.form_data.get("where", {})
-                where.update(url_param)
-                self.form_data["where"] = where
-            else:
-                self.form_data.update(url_param)
-            self.has_param = True
-        self.header: Optional[Dict[str, Any]] = headers
-        self.args: Optional[Dict[str, Any]] = args
-        self.raw_args: Optional[Dict[str, Any]] = raw_args
+        self.header = headers
+        self.url_param = url_param or None
         self.sessions: Optional[Dict[str, Any]] = sessions
+        self.has_param = self.url_param is not None
         self.filter_keys = None
-        # self.cache = None
+        # 分段计时，开启 __metrics__ 时由 dispatch_request 设置
+        self.timer = NULL_TIMER
+        self._form_data = form_data
+        self._built = False
+        self._args = args
+        self._raw_args = raw_args
+        self._query_string = None
+        self._body = None
 
-    def __repr__(self):
-        return "<Context %s>" % hash(
-            "%s, %s" % (
-                repr(self.form_data),
-                repr(self.args)
-            )
+    @classmethod
+    def from_raw(
+            cls,
+            method: str,
+            url_path: str = "",
+            headers=EMPTY_HEADERS,
+            url_param: Optional[Dict[str, Any]] = None,
+            query_string: Union[str, bytes, None] = None,
+            body: Optional[bytes] = None,
+            sessions: Optional[Dict[str, Any]] = None,
+    ) -> "Context":
+        """
+        由框架的原始查询字符串和请求体创建，用到时才解析
+
+        :param body: json 请求体，GET 忽略
+        """
+        self = cls(method, url_path, headers, url_param, sessions=sessions)
+        self._query_string = query_string or None
+        self._body = body if body and method != "get" else None
+        return self
+
+    @property
+    def args(self) -> Optional[Dict[str, List[str]]]:
+        if self._args is None and self._query_string is not None:
+            query_string = self._query_string
+            if isinstance(query_string, bytes):
+                query_string = query_string.decode("latin-1")
+            self._args = parse_qs(query_string)
+            self._query_string = None
+        return self._args
+
+    @property
+    def raw_args(self) -> Optional[Dict[str, str]]:
+        if self._raw_args is None:
+            args = self.args
+            if args:
+                self._raw_args = {k: v[0] for k, v in args.items()}
+        return self._raw_args
+
+    @property
+    def form_data(self):
+        if not self._built:
+            self._form_data = self.build_form_data()
+            self._built = True
+        return self._form_data
+
+    @form_data.setter
+    def form_data(self, value) -> None:
+        self._form_data = value
+        self._built = True
+
+    def build_form_data(self):
+        """
+        合并请求体、GET 查询参数和 url 参数
+        """
+        form_data = self._form_data
+        if self._body is not None:
+            body, self._body = self._body, None
+            form_data = json.loads(body)
+        if not form_data:
+            form_data = {}
+        args = self.args
+        if args and self.method == "get":
+            for k in QUERY_ARGS:
+                if k in args:
+                    try:
+                        form_data[k] = json.loads(args[k][0])
+                    except ValueError as e:
+                        LOGGER.warning("context: query arg %s error: %s", k, e)
+            for k in RAW_QUERY_ARGS:
+                if k in args:
+                    form_data[k] = args[k][0]
+        url_param = self.url_param
+        if url_param is not None and isinstance(form_data, dict):
+            if self.method != "delete":
+                where = form_data.get("where") or {}
+                where.update(url_param)
+                form_data["where"] = where
+            else:
+                form_data.update(url_param)
+        return form_data
+
+    @property
+    def keys(self):
+        return self.form_data.get("keys")
+
+    @property
+    def where(self):
+        return self.form_data.get("where")
+
+    @property
+    def limit(self):
+        return self.form_data.get("limit")
+
+    @property
+    def order(self):
+        return self.form_data.get("order")
+
+    @property
+    def group(self):
+        return self.form_data.get("group")
+
+    def fingerprint(self, *extra) -> str:
+        """
+        请求的稳定摘要，form_data 中 dict 的 key 顺序不影响结果
+
+        :param extra: 一起计算摘要的其他 json 数据
+        """
+        return fingerprint(
+            self.method,
+            self.has_param,
+            self.form_data,
+            self.args,
+            *extra
         )
+
+    def __repr__(self):
+        return "<Context %s>" % self.fingerprint()
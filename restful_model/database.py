@@ -1,33 +1,471 @@
+import os
+import time
 import asyncio
+import sqlite3
 import sqlalchemy as sa
 from sqlalchemy.sql.ddl import CreateTable, DropTable
-from typing import List, Optional, cast
+from typing import Dict, List, Optional, Union, cast
 from urllib.parse import unquote_plus
+from .utils import LOGGER
+from .pool_metrics import InstrumentedEngine
+from .slow_query import SlowQueryLog, TimedEngine, slow_query_log
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # python3.6 没有 contextvars，不支持快照事务
+    contextvars = None
 
 DRIVER_NAME = (
     "sqlite",
     "mysql",
     "postgresql"
 )
+# 各个驱动单条语句的参数个数上限
+MAX_PARAMS = {
+    "sqlite": 999,
+    "mysql": 65535,
+    "postgresql": 32767,
+}
+# 会话中最近一次写入的时间，读写分离时用于把会话固定到主库
+SESSION_WRITE_AT = "_db_write_at"
+# 视为连接故障的异常，出现时把副本移出轮询
+CONNECTION_ERRORS = ("OperationalError", "InterfaceError")
+# sqlite 每执行多少条虚拟机指令检查一次超时
+SQLITE_PROGRESS_STEPS = 1000
+# 触发器维护的表版本号，用于发现绕过本库的写入
+VERSION_TABLE = sa.Table(
+    "restful_model_version",
+    sa.MetaData(),
+    sa.Column("name", sa.String(64), primary_key=True),
+    sa.Column("version", sa.BigInteger, nullable=False),
+)
+# 快照事务的连接，由 DataBase.snapshot 设置，acquire_read 直接使用
+SNAPSHOT_CONN = contextvars.ContextVar(
+    "restful_model_snapshot",
+    default=None,
+) if contextvars is not None else None
+
+
+def make_url(database: str):
+    url = sa.engine.url.make_url(database)
+    if url.database and "%" in url.database:
+        url.database = unquote_plus(url.database)
+    return url
+
+
+def is_connection_error(error: BaseException) -> bool:
+    if isinstance(error, (OSError, asyncio.TimeoutError)):
+        return True
+    return type(error).__name__ in CONNECTION_ERRORS
+
+
+def is_unsupported_function(error: BaseException) -> bool:
+    """
+    数据库不支持语句中使用的函数
+    """
+    message = str(error).lower()
+    if "no such function" in message:
+        # sqlite
+        return True
+    return "function" in message and (
+        "does not exist" in message or "undefined" in message
+    )
+
+
+class Replica(object):
+    """
+    只读副本
+    """
+    __slots__ = ("url", "engine", "outstanding", "down_until", "lag")
+
+    def __init__(self, url) -> None:
+        self.url = url
+        self.engine = None
+        # 正在使用的连接数
+        self.outstanding = 0
+        # 移出轮询直到该时间
+        self.down_until = 0.0
+        self.lag: Optional[float] = None
+
+    @property
+    def available(self) -> bool:
+        return self.engine is not None and \
+            self.down_until <= time.monotonic()
+
+
+def sqlite_connection(conn):
+    """
+    取出驱动包装下的 sqlite3.Connection
+    """
+    while conn is not None and not isinstance(conn, sqlite3.Connection):
+        conn = getattr(conn, "_conn", None) or \
+            getattr(conn, "connection", None)
+    return conn
+
+
+class StatementTimeout(object):
+    """
+    限制连接上语句的执行时间，退出时恢复
+
+    postgresql 设置 statement_timeout，事务内使用 SET LOCAL 随事务结束；
+    mysql 设置 MAX_EXECUTION_TIME，只对 SELECT 生效；
+    sqlite 通过 progress handler 在超时后中断执行
+    """
+    __slots__ = ("driver", "conn", "timeout", "local", "_raw")
+
+    def __init__(
+            self,
+            driver: str,
+            conn,
+            timeout: Optional[float],
+            local: bool = False,
+    ) -> None:
+        self.driver = driver
+        self.conn = conn
+        self.timeout = timeout
+        self.local = local
+        self._raw = None
+
+    async def __aenter__(self):
+        if not self.timeout:
+            return self.conn
+        ms = max(int(self.timeout * 1000), 1)
+        if self.driver == "postgresql":
+            await self.conn.execute("SET %sstatement_timeout = %d" % (
+                "LOCAL " if self.local else "",
+                ms,
+            ))
+        elif self.driver == "mysql":
+            await self.conn.execute(
+                "SET SESSION MAX_EXECUTION_TIME = %d" % ms,
+            )
+        elif self.driver == "sqlite":
+            raw = sqlite_connection(self.conn)
+            if raw is not None:
+                deadline = time.monotonic() + self.timeout
+                raw.set_progress_handler(
+                    lambda: time.monotonic() > deadline,
+                    SQLITE_PROGRESS_STEPS,
+                )
+                self._raw = raw
+        return self.conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if not self.timeout:
+            return
+        try:
+            if self.driver == "postgresql" and not self.local:
+                await self.conn.execute("RESET statement_timeout")
+            elif self.driver == "mysql":
+                await self.conn.execute(
+                    "SET SESSION MAX_EXECUTION_TIME = DEFAULT",
+                )
+            elif self._raw is not None:
+                self._raw.set_progress_handler(None, 0)
+                self._raw = None
+        except Exception as e:
+            if exc is None:
+                raise
+            LOGGER.warning("database.StatementTimeout reset error: %s", e)
+
+
+class ReadAcquire(object):
+    """
+    获取读连接，副本获取连接失败时回退到主库
+
+    传入 conn 时直接使用该连接，退出时不释放
+    """
+    __slots__ = ("db", "replica", "timeout", "conn", "_ctx", "_timeout")
+
+    def __init__(
+            self,
+            db: "DataBase",
+            replica: Optional[Replica],
+            timeout: Optional[float] = None,
+            conn=None,
+    ) -> None:
+        self.db = db
+        self.replica = replica
+        self.timeout = timeout
+        self.conn = conn
+        self._ctx = None
+        self._timeout = None
+
+    async def __aenter__(self):
+        conn = await self._acquire()
+        if not self.timeout:
+            return conn
+        self._timeout = self.db.statement_timeout(conn, self.timeout)
+        try:
+            return await self._timeout.__aenter__()
+        except BaseException as e:
+            self._timeout = None
+            await self.__aexit__(type(e), e, e.__traceback__)
+            raise
+
+    async def _acquire(self):
+        if self.conn is not None:
+            return self.conn
+        replica = self.replica
+        if replica is not None:
+            replica.outstanding += 1
+            try:
+                self._ctx = replica.engine.acquire()
+                return await self._ctx.__aenter__()
+            except Exception as e:
+                replica.outstanding -= 1
+                self.replica = None
+                self.db.eject_replica(replica, e)
+        self._ctx = self.db.engine.acquire()
+        return await self._ctx.__aenter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        timeout, self._timeout = self._timeout, None
+        if timeout is not None:
+            try:
+                await timeout.__aexit__(exc_type, exc, tb)
+            except BaseException:
+                await self._release(exc_type, exc, tb)
+                raise
+        return await self._release(exc_type, exc, tb)
+
+    async def _release(self, exc_type, exc, tb):
+        if self.conn is not None:
+            return
+        replica = self.replica
+        try:
+            return await self._ctx.__aexit__(exc_type, exc, tb)
+        finally:
+            if replica is not None:
+                replica.outstanding -= 1
+                if exc is not None and is_connection_error(exc):
+                    self.db.eject_replica(replica, exc)
+
+
+class Snapshot(object):
+    """
+    主库上的只读快照事务，退出时回滚
+
+    postgresql 使用 REPEATABLE READ READ ONLY；
+    mysql 使用 REPEATABLE READ，快照从第一次读取开始；
+    sqlite 的事务本身就是一致的快照
+    """
+    __slots__ = ("db", "_ctx", "_trans", "_token")
+
+    def __init__(self, db: "DataBase") -> None:
+        self.db = db
+        self._ctx = None
+        self._trans = None
+        self._token = None
+
+    async def __aenter__(self):
+        if SNAPSHOT_CONN is None:
+            raise RuntimeError("snapshot needs contextvars (python 3.7+)")
+        driver = self.db.drivername()
+        self._ctx = self.db.engine.acquire()
+        conn = await self._ctx.__aenter__()
+        try:
+            if driver == "mysql":
+                await conn.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ",
+                )
+            self._trans = await conn.begin()
+            if driver == "postgresql":
+                await conn.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ "
+                    "READ ONLY",
+                )
+        except BaseException as e:
+            await self._release(type(e), e, e.__traceback__)
+            raise
+        self._token = SNAPSHOT_CONN.set(conn)
+        return conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        SNAPSHOT_CONN.reset(self._token)
+        self._token = None
+        await self._release(exc_type, exc, tb)
+
+    async def _release(self, exc_type, exc, tb):
+        trans, self._trans = self._trans, None
+        try:
+            if trans is not None:
+                await trans.rollback()
+        finally:
+            ctx, self._ctx = self._ctx, None
+            await ctx.__aexit__(exc_type, exc, tb)
 
 
 class DataBase(object):
     """
     orm 统一数据库切换器，支持 sqlite, mysql, pg
+
+    pg 默认使用 aiopg，地址为 postgresql+asyncpg:// 时使用 asyncpg
     """
-    def __init__(self, database: str, loop=None) -> None:
-        self._url = sa.engine.url.make_url(database)
-        if "%" in self._url.database:
-            self._url.database = unquote_plus(self._url.database)
+    def __init__(
+            self,
+            database: str,
+            loop=None,
+            replicas: Optional[List[str]] = None,
+            replica_policy: str = "round_robin",
+            read_your_writes: float = 5.0,
+            max_lag: float = 10.0,
+            replica_retry: float = 30.0,
+            pool_metrics: bool = False,
+            slow_query: Optional[Union[float, SlowQueryLog]] = None,
+    ) -> None:
+        """
+        :param replicas: 只读副本地址，GET 查询从副本读取
+        :param replica_policy: 副本选择方式 round_robin, least_outstanding
+        :param read_your_writes: 会话写入后多少秒内固定读主库
+        :param max_lag: 副本延迟超过该秒数时移出轮询
+        :param replica_retry: 副本故障后多少秒再重新加入轮询
+        :param pool_metrics: 统计连接池的等待和占用时间，见 pool_stats
+        :param slow_query: 慢查询阈值秒数或 SlowQueryLog，记录慢语句和执行计划
+        """
+        self._url = make_url(database)
         self._driver: Optional[str] = None
         self._load_driver()
         self.loop = cast(asyncio.AbstractEventLoop, loop)
         # self._tables = tables
         self.engine = None
+        # mysql 自增主键是否连续，None 为未检测
+        self._autoinc_step: Optional[int] = None
+        # 表版本号，写入后递增，查询结果缓存据此失效
+        self.table_versions: Dict[str, int] = {}
+        # 区分进程的前缀，各进程的版本号互不相干
+        self.epoch = os.urandom(4).hex()
+        self.replicas = [Replica(make_url(url)) for url in replicas or ()]
+        self.replica_policy = replica_policy
+        self.read_your_writes = read_your_writes
+        self.max_lag = max_lag
+        self.replica_retry = replica_retry
+        self._replica_index = 0
+        self.pool_metrics = pool_metrics
+        self.slow_query = slow_query_log(slow_query)
 
     def drivername(self):
         return self._driver
 
+    @property
+    def labeled(self) -> bool:
+        """
+        是否需要在请求上下文中记录 view 和 method
+        """
+        return self.pool_metrics or self.slow_query is not None
+
+    def table_version(self, name: str) -> int:
+        return self.table_versions.get(name, 0)
+
+    def bump_version(self, *names: str) -> None:
+        """
+        表数据变更后递增版本号
+        """
+        versions = self.table_versions
+        for name in names:
+            versions[name] = versions.get(name, 0) + 1
+
+    async def data_version(self, name: str, probe=None) -> str:
+        """
+        表数据的版本，用于生成 ETag
+
+        :param probe: None 只使用本进程写入的版本号，看不到其他进程的写入，
+            只适合单进程部署；
+            trigger 读取 create_version_trigger 创建的触发器维护的版本号；
+            字段名读取该字段的最大值和行数，与本进程的版本号一起使用
+        """
+        local = "%s.%d" % (self.epoch, self.table_version(name))
+        if probe is None:
+            return local
+        if probe == "trigger":
+            sql = sa.select([VERSION_TABLE.c.version]).where(
+                VERSION_TABLE.c.name == name,
+            )
+        else:
+            table = sa.table(name, sa.column(probe))
+            sql = sa.select([
+                sa.func.max(table.c[probe]),
+                sa.func.count(),
+            ]).select_from(table)
+        # 从主库读取，副本的延迟可能让版本号回退
+        async with self.engine.acquire() as conn:
+            async with conn.execute(sql) as cursor:
+                row = await cursor.first()
+        if row is None:
+            return local
+        values = ".".join(str(v) for v in row.values())
+        if probe == "trigger":
+            return "t" + values
+        return "%s.%s" % (local, values)
+
+    def version_trigger_sql(self, name: str) -> List[str]:
+        """
+        表写入后递增版本号的触发器语句
+        """
+        update = "UPDATE restful_model_version SET version = version + 1 " \
+            "WHERE name = '%s'" % name
+        sqls = []
+        if self._driver == "postgresql":
+            sqls.append(
+                "CREATE OR REPLACE FUNCTION restful_model_version_%s() "
+                "RETURNS trigger AS $$ BEGIN %s; RETURN NULL; END; $$ "
+                "LANGUAGE plpgsql" % (name, update)
+            )
+            sqls.append(
+                "DROP TRIGGER IF EXISTS restful_model_version "
+                "ON \"%s\"" % name
+            )
+            sqls.append(
+                "CREATE TRIGGER restful_model_version "
+                "AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                "ON \"%s\" FOR EACH STATEMENT "
+                "EXECUTE PROCEDURE restful_model_version_%s()" % (name, name)
+            )
+            return sqls
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            trigger = "restful_model_version_%s_%s" % (name, op.lower())
+            if self._driver == "mysql":
+                sqls.append("DROP TRIGGER IF EXISTS `%s`" % trigger)
+                sqls.append(
+                    "CREATE TRIGGER `%s` AFTER %s ON `%s` "
+                    "FOR EACH ROW %s" % (trigger, op, name, update)
+                )
+            else:
+                sqls.append(
+                    "CREATE TRIGGER IF NOT EXISTS \"%s\" AFTER %s "
+                    "ON \"%s\" BEGIN %s; END" % (trigger, op, name, update)
+                )
+        return sqls
+
+    async def create_version_trigger(self, table: 'sa.Table') -> None:
+        """
+        为表创建维护版本号的触发器，
+        之后 view 设置 __etag_probe__ = "trigger" 可以发现其他程序的写入
+        """
+        name = table.name
+        async with self.engine.acquire() as conn:
+            if not await self.exists_table(VERSION_TABLE.name, conn):
+                await conn.execute(CreateTable(VERSION_TABLE))
+            async with conn.begin():
+                async with conn.execute(sa.select([
+                    VERSION_TABLE.c.version,
+                ]).where(VERSION_TABLE.c.name == name)) as cursor:
+                    exists = await cursor.first() is not None
+                if not exists:
+                    await conn.execute(VERSION_TABLE.insert().values(
+                        name=name,
+                        version=0,
+                    ))
+                for sql in self.version_trigger_sql(name):
+                    await conn.execute(sql)
+
+    def max_params(self) -> int:
+        """
+        单条语句的参数个数上限
+        """
+        return MAX_PARAMS.get(self._driver, 999)
+
     def _load_driver(self) -> None:
         """
         加载driver
@@ -39,14 +477,71 @@ class DataBase(object):
 
     async def create_engine(self, *args, **kwargs) -> None:
         """
-        创建engine
+        创建engine，配置了只读副本时同时创建副本的连接池
+        """
+        for replica in self.replicas:
+            if replica.engine is None:
+                replica.engine = await self._create_engine(
+                    replica.url,
+                    *args,
+                    **kwargs,
+                )
+        return await self._create_engine(self._url, *args, **kwargs)
+
+    def engines(self) -> dict:
+        """
+        主库和副本的 engine
+        """
+        res = {"primary": self.engine}
+        for index, replica in enumerate(self.replicas):
+            res["replica%d" % index] = replica.engine
+        return res
+
+    def pool_stats(self) -> dict:
+        """
+        各连接池的统计，需要开启 pool_metrics
+
+        acquire 等待时间，按 view.method 的占用时间，
+        占用中/空闲/最大连接数，占用最久的连接及获取时的调用栈
+        """
+        return {
+            name: engine.metrics.snapshot(engine)
+            for name, engine in self.engines().items()
+            if isinstance(engine, InstrumentedEngine)
+        }
+
+    async def warmup(self) -> int:
+        """
+        预先打开每个连接池的 minsize 个连接并执行 SELECT 1 校验，
+        校验失败时抛出异常
+
+        :returns: 校验的连接数
         """
+        count = 0
+        for engine in self.engines().values():
+            if engine is None:
+                continue
+            ctxs = []
+            try:
+                # 同时占用才会打开不同的连接
+                for _ in range(max(engine.minsize, 1)):
+                    ctx = engine.acquire()
+                    conn = await ctx.__aenter__()
+                    ctxs.append(ctx)
+                    await conn.execute("SELECT 1")
+                    count += 1
+            finally:
+                for ctx in ctxs:
+                    await ctx.__aexit__(None, None, None)
+        return count
+
+    async def _create_engine(self, url, *args, **kwargs):
         loop = self.loop
         if self._driver == "sqlite":
             from aiosqlite3.sa import create_engine as sqlite_create_engine
-            # init = os.path.exists(self._url.database)
+            # init = os.path.exists(url.database)
             engine = await sqlite_create_engine(
-                self._url.database,
+                url.database,
                 loop=loop,
                 *args,
                 **kwargs,
@@ -54,11 +549,24 @@ class DataBase(object):
         elif self._driver == "mysql":
             from aiomysql.sa import create_engine as mysql_create_engine
             engine = await mysql_create_engine(
-                user=self._url.username,
-                db=self._url.database,
-                host=self._url.host,
-                password=self._url.password,
-                port=self._url.port,
+                user=url.username,
+                db=url.database,
+                host=url.host,
+                password=url.password,
+                port=url.port,
+                loop=loop,
+                *args,
+                **kwargs,
+            )
+        elif self._driver == "postgresql" and \
+                url.drivername.endswith("+asyncpg"):
+            from .asyncpg_sa import create_engine as asyncpg_create_engine
+            engine = await asyncpg_create_engine(
+                user=url.username,
+                database=url.database,
+                host=url.host,
+                port=url.port,
+                password=url.password,
                 loop=loop,
                 *args,
                 **kwargs,
@@ -66,17 +574,164 @@ class DataBase(object):
         elif self._driver == "postgresql":
             from aiopg.sa import create_engine as pg_create_engine
             engine = await pg_create_engine(
-                user=self._url.username,
-                database=self._url.database,
-                host=self._url.host,
-                port=self._url.port,
-                password=self._url.password,
+                user=url.username,
+                database=url.database,
+                host=url.host,
+                port=url.port,
+                password=url.password,
                 loop=loop,
                 *args,
                 **kwargs,
             )
+        if self.slow_query is not None:
+            engine = TimedEngine(engine, self.slow_query)
+        if self.pool_metrics:
+            engine = InstrumentedEngine(engine)
         return engine
 
+    async def close(self) -> None:
+        """
+        关闭主库和副本的连接池
+        """
+        for engine in self.engines().values():
+            if engine is not None:
+                engine.close()
+                await engine.wait_closed()
+
+    def pinned(self, sessions) -> bool:
+        """
+        会话是否在写入后的读主库窗口内
+        """
+        if not sessions:
+            return False
+        write_at = sessions.get(SESSION_WRITE_AT)
+        return write_at is not None and \
+            time.time() - write_at < self.read_your_writes
+
+    def mark_write(self, sessions) -> None:
+        """
+        记录会话的写入时间
+        """
+        if sessions is not None and self.replicas:
+            sessions[SESSION_WRITE_AT] = time.time()
+
+    def select_replica(self) -> Optional[Replica]:
+        """
+        按 replica_policy 选择可用副本，没有时返回 None
+        """
+        available = [r for r in self.replicas if r.available]
+        if not available:
+            return None
+        if self.replica_policy == "least_outstanding":
+            return min(available, key=lambda r: r.outstanding)
+        self._replica_index += 1
+        return available[self._replica_index % len(available)]
+
+    def acquire_read(
+            self,
+            sessions=None,
+            timeout: Optional[float] = None,
+    ) -> ReadAcquire:
+        """
+        获取只读连接，没有副本或会话刚写入时使用主库
+
+            async with db.acquire_read(context.sessions) as conn:
+                ...
+
+        :param timeout: 连接上语句的执行超时秒数
+        """
+        conn = self.snapshot_conn()
+        if conn is not None:
+            return ReadAcquire(self, None, timeout, conn)
+        replica = None
+        if self.replicas and not self.pinned(sessions):
+            replica = self.select_replica()
+        return ReadAcquire(self, replica, timeout)
+
+    def snapshot(self) -> Snapshot:
+        """
+        在 async with 内 acquire_read 都使用同一个快照事务的连接，
+        多个查询读到同一时刻的数据；连接只有一个，查询需要依次执行
+
+            async with db.snapshot():
+                ...
+        """
+        return Snapshot(self)
+
+    def snapshot_conn(self):
+        """
+        当前快照事务的连接，不在快照中时返回 None
+        """
+        if SNAPSHOT_CONN is None:
+            return None
+        return SNAPSHOT_CONN.get()
+
+    def statement_timeout(
+            self,
+            conn,
+            timeout: Optional[float],
+            local: bool = False,
+    ) -> StatementTimeout:
+        """
+        在 async with 内限制连接上语句的执行时间
+
+        :param local: 在事务内，postgresql 使用 SET LOCAL
+        """
+        return StatementTimeout(self._driver, conn, timeout, local)
+
+    def eject_replica(self, replica: Replica, reason) -> None:
+        """
+        副本移出轮询 replica_retry 秒
+        """
+        LOGGER.warning(
+            "database.DataBase replica %s ejected: %s",
+            replica.url.host or replica.url.database,
+            reason,
+        )
+        replica.down_until = time.monotonic() + self.replica_retry
+
+    async def replica_lag(self, conn) -> Optional[float]:
+        """
+        副本复制延迟秒数，不是副本时返回 None
+        """
+        if self._driver == "postgresql":
+            sql = "SELECT CASE WHEN pg_is_in_recovery() THEN "\
+                "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"\
+                " END AS lag"
+            async with conn.execute(sql) as cursor:
+                lag = (await cursor.first()).lag
+            return None if lag is None else float(lag)
+        if self._driver == "mysql":
+            async with conn.execute("SHOW SLAVE STATUS") as cursor:
+                row = await cursor.first()
+            if row is None:
+                return None
+            lag = row["Seconds_Behind_Master"]
+            # 复制线程停止
+            return float("inf") if lag is None else float(lag)
+        return None
+
+    async def check_replicas(self) -> None:
+        """
+        检查副本，延迟超过 max_lag 或连接失败的移出轮询，恢复的重新加入
+
+        需要定时调用
+        """
+        for replica in self.replicas:
+            if replica.engine is None:
+                continue
+            try:
+                async with replica.engine.acquire() as conn:
+                    lag = await self.replica_lag(conn)
+            except Exception as e:
+                self.eject_replica(replica, e)
+                continue
+            replica.lag = lag
+            if lag is not None and lag > self.max_lag:
+                self.eject_replica(replica, "lag %.1fs" % lag)
+            else:
+                replica.down_until = 0.0
+
     def create_table_sql(self, table: 'sa.Table') -> CreateTable:
         """
         生成创建表的 sql
@@ -155,6 +810,46 @@ class DataBase(object):
             first = await result.first()
         return first is not None
 
+    async def estimate_count(self, table_name: str, conn=None):
+        """
+        从各个数据库的统计信息读取表的估算行数，没有统计信息时返回 None
+
+        sqlite 需要执行过 ANALYZE 才有 sqlite_stat1
+        """
+        sql = None
+        if self._driver == "sqlite":
+            sql = sa.text(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = :name"
+            ).bindparams(name=table_name)
+        elif self._driver == "mysql":
+            sql = sa.text(
+                "SELECT TABLE_ROWS AS stat FROM information_schema.TABLES "
+                "WHERE TABLE_NAME = :name AND TABLE_SCHEMA = :schema"
+            ).bindparams(name=table_name, schema=self._url.database)
+        elif self._driver == "postgresql":
+            sql = sa.text(
+                "SELECT reltuples AS stat FROM pg_class "
+                "WHERE relname = :name AND relkind = 'r'"
+            ).bindparams(name=table_name)
+        if conn is None:
+            async with self.engine.acquire() as conn:
+                return await self.estimate_count(table_name, conn)
+        try:
+            async with conn.execute(sql) as cursor:
+                first = await cursor.first()
+        except Exception:
+            # sqlite 未 ANALYZE 时没有 sqlite_stat1 表
+            return None
+        if first is None or first.stat is None:
+            return None
+        stat = first.stat
+        if isinstance(stat, str):
+            # sqlite_stat1.stat 第一个数字为行数
+            stat = stat.split(" ", 1)[0]
+        stat = int(float(stat))
+        # pg 未 analyze 时 reltuples 为 -1
+        return stat if stat >= 0 else None
+
     # async def get_last_id(self, key="id", conn=None, cursor=None):
     #     """
     #     获取最后的id, pg需要传入cursor
@@ -178,34 +873,40 @@ class DataBase(object):
     #             cursor = await conn.execute(sql)
     #             return getattr((await cursor.first()), key)
 
-    async def execute_dml(self, sql, data=None, conn=None):
+    async def execute_dml(self, sql, data=None, conn=None, timeout=None):
         """
         执行DML语句
+
+        :param sql: 语句或语句列表，列表元素可为 (语句, 参数) 元组
+        :param data: 参数，为 dict 列表时走 executemany
+        :param timeout: 未传入连接时，事务内语句的执行超时秒数
         """
-        engine = self.engine
         if conn is None:
-            async with engine.acquire() as conn:
+            async with self.engine.acquire() as conn:
                 async with conn.begin():
-                    if isinstance(sql, list):
-                        count = 0
-                        for s in sql:
-                            async with conn.execute(s) as cursor:
-                                count += cursor.rowcount
-                    else:
-                        async with conn.execute(sql, data) as cursor:
-                            count = cursor.rowcount
-                return count
+                    async with self.statement_timeout(conn, timeout, True):
+                        return await self.execute_dml(sql, data, conn)
         if isinstance(sql, list):
             count = 0
             for s in sql:
-                async with conn.execute(s) as cursor:
+                if isinstance(s, tuple):
+                    count += await self.execute_dml(*s, conn=conn)
+                else:
+                    async with conn.execute(s) as cursor:
+                        count += cursor.rowcount
+            return count
+        if isinstance(data, list) and len(data) > 1 and \
+                self._driver == "postgresql":
+            # aiopg 不支持 executemany，同一连接上逐条执行
+            count = 0
+            for d in data:
+                async with conn.execute(sql, d) as cursor:
                     count += cursor.rowcount
-        else:
-            async with conn.execute(sql, data) as cursor:
-                count = cursor.rowcount
-        return count
+            return count
+        async with conn.execute(sql, data) as cursor:
+            return cursor.rowcount
 
-    async def execute_insert(self, sql, conn=None):
+    async def execute_insert(self, sql, conn=None, data=None):
         """
         执行插入语句
         """
@@ -213,16 +914,88 @@ class DataBase(object):
             engine = self.engine
             async with engine.acquire() as conn:
                 async with conn.begin():
-                    async with conn.execute(sql) as cursor:
-                        if cursor.rowcount > 1:
-                            return cursor.rowcount, 0
-                        if self._driver == "postgresql":
-                            return cursor.rowcount, (await cursor.first())[0]
-                        return cursor.rowcount, cursor.lastrowid
-        else:
-            async with conn.execute(sql) as cursor:
-                if cursor.rowcount > 1:
-                    return cursor.rowcount, 0
-                if self._driver == "postgresql":
-                    return cursor.rowcount, (await cursor.first())[0]
-                return cursor.rowcount, cursor.lastrowid
+                    return await self.execute_insert(sql, conn, data)
+        async with conn.execute(sql, data or {}) as cursor:
+            if cursor.rowcount > 1:
+                return cursor.rowcount, 0
+            if self._driver == "postgresql":
+                return cursor.rowcount, (await cursor.first())[0]
+            return cursor.rowcount, cursor.lastrowid
+
+    async def autoinc_step(self, conn) -> int:
+        """
+        mysql 多行插入的自增主键步长，
+        innodb_autoinc_lock_mode 为 2 时同一语句的主键不保证连续，返回 0
+        """
+        if self._autoinc_step is None:
+            sql = "SELECT @@innodb_autoinc_lock_mode AS mode, "\
+                "@@auto_increment_increment AS step"
+            try:
+                async with conn.execute(sql) as cursor:
+                    first = await cursor.first()
+                step = int(first.step) if int(first.mode) in (0, 1) else 0
+            except Exception:
+                step = 0
+            self._autoinc_step = step
+        return self._autoinc_step
+
+    async def insert_rowids(self, cursor, conn):
+        """
+        获取多行插入生成的主键
+
+        postgresql 需要语句带 RETURNING 主键，
+        mysql 的 lastrowid 为第一行，sqlite 的 lastrowid 为最后一行，
+        同一条语句插入的主键连续时用 rowcount 推算
+        """
+        count = cursor.rowcount
+        if self._driver == "postgresql":
+            if not cursor.returns_rows:
+                return None
+            return [row[0] for row in await cursor.fetchall()]
+        lastrowid = cursor.lastrowid
+        if not lastrowid or count <= 0:
+            return None
+        if self._driver == "sqlite":
+            return list(range(lastrowid - count + 1, lastrowid + 1))
+        if self._driver == "mysql":
+            step = await self.autoinc_step(conn)
+            if step > 0:
+                return list(range(lastrowid, lastrowid + count * step, step))
+        return None
+
+    async def execute_bulk_insert(
+        self,
+        sqls,
+        conn=None,
+        commit_each=False,
+    ):
+        """
+        分批执行插入语句，默认在一个事务中执行
+
+        :param sqls: [(sql, params)]
+        :param commit_each: 每批单独提交，适用于超大量导入
+        :returns: (count, rowids) 无法获取主键时 rowids 为 None
+        """
+        if conn is None:
+            async with self.engine.acquire() as conn:
+                if commit_each:
+                    return await self.execute_bulk_insert(sqls, conn, True)
+                async with conn.begin():
+                    return await self.execute_bulk_insert(sqls, conn)
+        count = 0
+        rowids: Optional[list] = []
+        for sql, params in sqls:
+            if commit_each:
+                async with conn.begin():
+                    async with conn.execute(sql, params) as cursor:
+                        ids = await self.insert_rowids(cursor, conn)
+                        count += cursor.rowcount
+            else:
+                async with conn.execute(sql, params) as cursor:
+                    ids = await self.insert_rowids(cursor, conn)
+                    count += cursor.rowcount
+            if rowids is not None and ids is not None:
+                rowids.extend(ids)
+            else:
+                rowids = None
+        return count, rowids
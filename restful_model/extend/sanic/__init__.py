@@ -1,5 +1,6 @@
 
-__all__ = ["ApiView", "PolymerizationView"]
+__all__ = ["ApiView", "PolymerizationView", "metrics_view"]
 from .view import ApiView
 
 from .polymerization import PolymerizationView
+from .metrics import metrics_view
@@ -0,0 +1,19 @@
+from restful_model.metrics import Metrics, CONTENT_TYPE
+from sanic import response
+
+
+__all__ = ["metrics_view"]
+
+
+def metrics_view(metrics: Metrics):
+    """
+    生成 prometheus 拉取统计的 view
+
+        app.add_route(metrics_view(metrics), "/metrics")
+    """
+    async def view(request):
+        return response.raw(
+            metrics.render().encode("utf-8"),
+            content_type=CONTENT_TYPE,
+        )
+    return view
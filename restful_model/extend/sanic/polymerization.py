@@ -1,4 +1,5 @@
 
+import json
 from restful_model import BasePolymerization, Context
 from sanic import response
 
@@ -8,16 +9,24 @@ class PolymerizationView(BasePolymerization):
 
     async def sanic_dispatch_request(self, request, method, *args, **kwargs):
         session = request["session"] if "session" in request else None
-        content = Context(
+        content = Context.from_raw(
             method,
             request.path,
             request.headers,
             kwargs,
-            request.json,
-            request.args,
-            request.raw_args,
+            request.query_string,
+            request.body,
             session,
         )
+        if method == "get" and request.body:
+            # 聚合查询的查询列表在请求体中
+            try:
+                content.form_data = json.loads(request.body)
+            except json.JSONDecodeError as e:
+                return response.json(
+                    {"status": 400, "message": "Bad Request: %s" % e},
+                    status=400,
+                )
         resp = await self.dispatch_request(content)
         if isinstance(resp, tuple):
             h = None
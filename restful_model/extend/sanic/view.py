@@ -1,44 +1,96 @@
-from restful_model.view import BaseView
+from restful_model.view import BaseView, NDJSON
 from restful_model.context import Context
+from restful_model.utils import encode_stream, encode_json_data
 from sanic import response
 
 
 __all__ = ["ApiView"]
 
 
+def stream_response(resp):
+    """
+    分块写出流式响应，await write 等待缓冲区写出
+    """
+    if resp.get("ndjson"):
+        content_type = NDJSON + ";charset=utf-8"
+    else:
+        content_type = "application/json;charset=utf-8"
+
+    async def streaming_fn(res):
+        async for chunk in encode_stream(resp):
+            await res.write(chunk)
+    return response.stream(
+        streaming_fn,
+        status=resp["status"],
+        content_type=content_type,
+    )
+
+
+def make_response(resp):
+    """
+    把 dispatch_request 的结果编码为 sanic 响应
+    """
+    if isinstance(resp, dict) and "stream" in resp:
+        return stream_response(resp)
+    headers = resp.get("headers") if isinstance(resp, dict) else None
+    if headers is not None:
+        if resp["status"] == 304:
+            return response.raw(b"", status=304, headers=headers)
+        resp = {k: v for k, v in resp.items() if k != "headers"}
+    if isinstance(resp, dict) and "body" in resp:
+        return response.raw(
+            resp["body"],
+            status=resp["status"],
+            headers=headers,
+            content_type="application/json;charset=utf-8",
+        )
+    if isinstance(resp, dict) and "data_json" in resp:
+        return response.raw(
+            encode_json_data(resp),
+            status=resp["status"],
+            headers=headers,
+            content_type="application/json;charset=utf-8",
+        )
+    if isinstance(resp, tuple):
+        h = None
+        status = 200
+        res = None
+        for i in resp:
+            if res is None:
+                res = i
+            elif isinstance(i, int):
+                status = i
+            elif isinstance(i, dict):
+                h = i
+        return response.json(res, headers=h, status=status)
+    headers = dict(headers or {})
+    headers["Content-Type"] = "application/json;charset=utf-8"
+    return response.json(
+        resp,
+        headers=headers,
+        status=resp["status"],
+    )
+
+
 class ApiView(BaseView):
     decorators = None
 
     async def sanic_dispatch_request(self, request, *args, **kwargs):
         session = request["session"] if "session" in request else None
-        content = Context(
+        content = Context.from_raw(
             request.method.lower(),
             request.path,
             request.headers,
             kwargs,
-            request.json,
-            request.args,
-            request.raw_args,
+            request.query_string,
+            request.body,
             session,
         )
         resp = await self.dispatch_request(content)
-        if isinstance(resp, tuple):
-            h = None
-            status = 200
-            res = None
-            for i in resp:
-                if res is None:
-                    res = i
-                elif isinstance(i, int):
-                    status = i
-                elif isinstance(i, dict):
-                    h = i
-            return response.json(res, headers=h, status=status)
-        return response.json(
-            resp,
-            headers={"Content-Type": "application/json;charset=utf-8"},
-            status=resp["status"],
-        )
+        res = make_response(resp)
+        content.timer.lap("encode")
+        content.timer.finish()
+        return res
 
     @classmethod
     def as_view(cls, *class_args, **class_kwargs):
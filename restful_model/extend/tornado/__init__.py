@@ -1,3 +1,4 @@
 
-__all__ = ["ApiView"]
+__all__ = ["ApiView", "metrics_handler"]
 from .view import ApiView
+from .metrics import metrics_handler
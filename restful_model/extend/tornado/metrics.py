@@ -0,0 +1,18 @@
+import tornado.web
+from restful_model.metrics import Metrics, CONTENT_TYPE
+
+
+__all__ = ["metrics_handler"]
+
+
+def metrics_handler(metrics: Metrics):
+    """
+    生成 prometheus 拉取统计的请求响应类
+
+        ("/metrics", metrics_handler(metrics))
+    """
+    class MetricsHandler(tornado.web.RequestHandler):
+        def get(self):
+            self.set_header("Content-Type", CONTENT_TYPE)
+            self.write(metrics.render().encode("utf-8"))
+    return MetricsHandler
@@ -1,7 +1,8 @@
 import json
 import tornado.web
-from restful_model.view import BaseView
+from restful_model.view import BaseView, NDJSON
 from restful_model.context import Context
+from restful_model.utils import encode_stream, encode_json_data
 
 
 async def tornado_dispatch_request(self: "ApiView", *path_args, **kwargs):
@@ -9,28 +10,36 @@ async def tornado_dispatch_request(self: "ApiView", *path_args, **kwargs):
     分发请求
     """
     request = self.request
-    args = {}
-    raw_args = {}
-    for k, v in request.query_arguments.items():
-        val = [vv.decode() for vv in v]
-        args[k] = val
-        raw_args[k] = val[0]
-    method = request.method.lower()
-    if method != "get" and request.body and request.body != b"":
-        form_data = json.loads(request.body)
-    else:
-        form_data = {}
-    context = Context(
-        method,
+    context = Context.from_raw(
+        request.method.lower(),
         request.path,
         request.headers,
         kwargs,
-        form_data,
-        args,
-        raw_args,
+        request.query,
+        request.body,
         self.session if hasattr(self, "session") else None,
     )
     resp = await self.view.dispatch_request(context)
+    await write_response(self, resp)
+    context.timer.lap("encode")
+    context.timer.finish()
+
+
+async def write_response(self: "ApiView", resp):
+    """
+    把 dispatch_request 的结果写入响应
+    """
+    if isinstance(resp, dict) and "stream" in resp:
+        if resp.get("ndjson"):
+            self.set_header("Content-Type", NDJSON + "; charset=utf-8")
+        else:
+            self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.set_status(resp["status"])
+        # 每块 flush 后等待写出，保证内存只占用一个块
+        async for chunk in encode_stream(resp):
+            self.write(chunk)
+            await self.flush()
+        return
     self.set_header("Content-Type", "application/json; charset=utf-8")
     if isinstance(resp, tuple):
         h = None
@@ -49,7 +58,19 @@ async def tornado_dispatch_request(self: "ApiView", *path_args, **kwargs):
         self.set_status(status)
         self.write(json.dumps(res, ensure_ascii=False).encode("utf-8"))
         return
+    for k, v in (resp.get("headers") or {}).items():
+        self.set_header(k, v)
     self.set_status(resp["status"])
+    if resp["status"] == 304:
+        return
+    if "headers" in resp:
+        resp = {k: v for k, v in resp.items() if k != "headers"}
+    if "body" in resp:
+        self.write(resp["body"])
+        return
+    if "data_json" in resp:
+        self.write(encode_json_data(resp))
+        return
     self.write(json.dumps(resp, ensure_ascii=False).encode("utf-8"))
 
 
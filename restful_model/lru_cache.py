@@ -0,0 +1,177 @@
+import time
+from collections import OrderedDict, namedtuple
+from typing import Any, Hashable, Optional
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class LRUCache(object):
+    """
+    有界的 LRU 缓存，带命中统计
+
+    只在事件循环内使用，所有操作都是同步的，所以不需要锁
+    """
+    __slots__ = ("maxsize", "hits", "misses", "_data")
+
+    def __init__(self, maxsize: int = 128) -> None:
+        if not isinstance(maxsize, int) or maxsize <= 0:
+            raise TypeError("Expected maxsize to be a positive integer")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """
+        读取缓存，命中时移动到队尾
+        """
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+            self.hits += 1
+            return data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """
+        写入缓存，超出容量时淘汰最久未使用的
+        """
+        data = self._data
+        if key in data:
+            data.move_to_end(key)
+        data[key] = value
+        if len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        return self._data.pop(key, default)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def cache_info(self) -> CacheInfo:
+        """
+        缓存统计
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+    def cache_clear(self) -> None:
+        """
+        清空缓存和统计
+        """
+        self._data.clear()
+        self.hits = self.misses = 0
+
+
+ResultCacheInfo = namedtuple("ResultCacheInfo", [
+    "hits",
+    "misses",
+    "maxsize",
+    "currsize",
+    "maxbytes",
+    "nbytes",
+    "hit_rate",
+])
+
+
+class ResultCache(object):
+    """
+    查询结果缓存，保存编码后的响应
+
+    条目记录写入时的表版本号和过期时间，版本变化或过期都视为未命中，
+    超出条数或字节上限时淘汰最久未使用的
+    """
+    __slots__ = (
+        "ttl",
+        "maxsize",
+        "maxbytes",
+        "hits",
+        "misses",
+        "nbytes",
+        "_data",
+    )
+
+    def __init__(
+        self,
+        ttl: float = 60,
+        maxsize: int = 1024,
+        maxbytes: int = 16 * 1024 * 1024,
+    ) -> None:
+        if not isinstance(maxsize, int) or maxsize <= 0:
+            raise TypeError("Expected maxsize to be a positive integer")
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable, version: Any) -> Optional[bytes]:
+        """
+        读取缓存，版本不一致或过期时删除并返回 None
+        """
+        data = self._data
+        entry = data.get(key)
+        if entry is not None:
+            expires, entry_version, body = entry
+            if entry_version == version and expires > time.monotonic():
+                data.move_to_end(key)
+                self.hits += 1
+                return body
+            self.pop(key)
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, version: Any, body: bytes) -> None:
+        """
+        写入缓存，单条超过字节上限时不缓存
+        """
+        if len(body) > self.maxbytes:
+            return
+        self.pop(key)
+        data = self._data
+        data[key] = (time.monotonic() + self.ttl, version, body)
+        self.nbytes += len(body)
+        while len(data) > self.maxsize or self.nbytes > self.maxbytes:
+            _, entry = data.popitem(last=False)
+            self.nbytes -= len(entry[2])
+
+    def pop(self, key: Hashable) -> Optional[bytes]:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return None
+        self.nbytes -= len(entry[2])
+        return entry[2]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def cache_info(self) -> ResultCacheInfo:
+        """
+        缓存统计，hit_rate 为命中率
+        """
+        total = self.hits + self.misses
+        return ResultCacheInfo(
+            self.hits,
+            self.misses,
+            self.maxsize,
+            len(self._data),
+            self.maxbytes,
+            self.nbytes,
+            self.hits / total if total else 0.0,
+        )
+
+    def cache_clear(self) -> None:
+        """
+        清空缓存和统计
+        """
+        self._data.clear()
+        self.nbytes = self.hits = self.misses = 0
@@ -0,0 +1,218 @@
+import time
+from bisect import bisect_left
+from typing import Dict, Tuple
+
+__all__ = ["Metrics", "RequestTimer", "NULL_TIMER", "CONTENT_TYPE"]
+
+# prometheus 默认的延迟分桶，单位秒
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace(
+        "\n", "\\n"
+    ).replace('"', '\\"')
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    labels = ",".join(
+        '%s="%s"' % (name, escape_label(value))
+        for name, value in zip(names, values)
+    )
+    if extra:
+        labels = labels + "," + extra if labels else extra
+    return "{%s}" % labels if labels else ""
+
+
+class Histogram(object):
+    """
+    按标签分组的直方图，记录时只累加所在的桶，输出时再累计
+    """
+    __slots__ = ("buckets", "label_names", "counts", "sums")
+
+    def __init__(self, label_names: Tuple[str, ...], buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.label_names = label_names
+        self.counts: Dict[tuple, list] = {}
+        self.sums: Dict[tuple, float] = {}
+
+    def observe(self, labels: tuple, value: float) -> None:
+        counts = self.counts.get(labels)
+        if counts is None:
+            counts = self.counts[labels] = [0] * (len(self.buckets) + 1)
+            self.sums[labels] = 0.0
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[labels] += value
+
+    def render(self, name: str, doc: str) -> list:
+        lines = [
+            "# HELP %s %s" % (name, doc),
+            "# TYPE %s histogram" % name,
+        ]
+        bounds = [repr(float(b)) for b in self.buckets] + ["+Inf"]
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                lines.append("%s_bucket%s %d" % (
+                    name,
+                    format_labels(
+                        self.label_names,
+                        labels,
+                        'le="%s"' % bound,
+                    ),
+                    total,
+                ))
+            label_str = format_labels(self.label_names, labels)
+            lines.append("%s_sum%s %r" % (name, label_str, self.sums[labels]))
+            lines.append("%s_count%s %d" % (name, label_str, total))
+        return lines
+
+
+class Metrics(object):
+    """
+    请求统计: 各阶段耗时直方图，请求总耗时，状态码和行数计数
+
+    阶段: args 查询参数解析, filter 中间件, sql 生成语句,
+    execute 执行, convert 结果转换, cache 读缓存, encode 编码响应
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix: str = "restful_model"):
+        self.prefix = prefix
+        self.phases = Histogram(("view", "method", "phase"), buckets)
+        self.requests = Histogram(("view", "method"), buckets)
+        self.responses: Dict[tuple, int] = {}
+        self.rows: Dict[tuple, int] = {}
+
+    def timer(self, view: str, method: str) -> "RequestTimer":
+        return RequestTimer(self, view, method)
+
+    def record_response(self, view: str, method: str, resp) -> None:
+        status, rows = response_summary(resp)
+        key = (view, method, status)
+        self.responses[key] = self.responses.get(key, 0) + 1
+        if rows is not None:
+            key = (view, method)
+            self.rows[key] = self.rows.get(key, 0) + rows
+
+    def render(self) -> str:
+        """
+        prometheus 文本格式
+        """
+        prefix = self.prefix
+        lines = self.phases.render(
+            prefix + "_phase_seconds",
+            "Time spent in each request phase.",
+        )
+        lines += self.requests.render(
+            prefix + "_request_seconds",
+            "Time spent in dispatch_request.",
+        )
+        lines += render_counter(
+            prefix + "_responses_total",
+            "Responses by status code.",
+            ("view", "method", "status"),
+            self.responses,
+        )
+        lines += render_counter(
+            prefix + "_rows_total",
+            "Rows returned or affected.",
+            ("view", "method"),
+            self.rows,
+        )
+        return "\n".join(lines) + "\n"
+
+
+def render_counter(name, doc, label_names, values: dict) -> list:
+    lines = ["# HELP %s %s" % (name, doc), "# TYPE %s counter" % name]
+    for labels, value in values.items():
+        lines.append("%s%s %d" % (
+            name,
+            format_labels(label_names, labels),
+            value,
+        ))
+    return lines
+
+
+def response_summary(resp):
+    """
+    取出响应的状态码和行数，行数未知时为 None
+    """
+    if isinstance(resp, tuple):
+        status = 200
+        for i in resp[1:]:
+            if isinstance(i, int):
+                status = i
+        return status, None
+    if not isinstance(resp, dict):
+        return 200, None
+    status = resp.get("status", 200)
+    meta = resp.get("meta")
+    if isinstance(meta, dict) and isinstance(meta.get("count"), int):
+        return status, meta["count"]
+    data = resp.get("data")
+    if isinstance(data, list):
+        return status, len(data)
+    if isinstance(data, dict):
+        return status, 1
+    return status, None
+
+
+class RequestTimer(object):
+    """
+    分段计时，lap 记录距上一次 lap 的耗时
+    """
+    __slots__ = ("metrics", "view", "method", "start", "last", "laps")
+
+    def __init__(self, metrics: Metrics, view: str, method: str):
+        self.metrics = metrics
+        self.view = view
+        self.method = method
+        self.start = self.last = time.perf_counter()
+        self.laps = []
+
+    def set_method(self, method: str) -> None:
+        self.method = method
+
+    def lap(self, phase: str) -> None:
+        now = time.perf_counter()
+        self.laps.append((phase, now - self.last))
+        self.last = now
+
+    def finish(self, resp=None) -> None:
+        """
+        写入已记录的阶段，传入响应时同时记录总耗时、状态码和行数
+        """
+        metrics = self.metrics
+        view, method = self.view, self.method
+        for phase, seconds in self.laps:
+            metrics.phases.observe((view, method, phase), seconds)
+        self.laps = []
+        if resp is not None:
+            metrics.requests.observe(
+                (view, method),
+                time.perf_counter() - self.start,
+            )
+            metrics.record_response(view, method, resp)
+
+
+class NullTimer(object):
+    """
+    关闭统计时使用，什么都不做
+    """
+    __slots__ = ()
+
+    def set_method(self, method: str) -> None:
+        pass
+
+    def lap(self, phase: str) -> None:
+        pass
+
+    def finish(self, resp=None) -> None:
+        pass
+
+
+NULL_TIMER = NullTimer()
@@ -1,13 +1,24 @@
-from typing import Dict
+import json
+import asyncio
+from typing import Dict, List
 from .context import Context
 from .view import BaseView
 from .utils import LOGGER, inject_value
+from .pool_metrics import set_label, reset_label
 
 
-async def execute_request(self, method: str, form_data):
+async def execute_request(self, method: str, form_data, sessions=None):
     """
     集中处理
     """
+    try:
+        return await _execute_request(self, method, form_data)
+    finally:
+        self.db.bump_version(*self.write_tables(form_data))
+        self.db.mark_write(sessions)
+
+
+async def _execute_request(self, method: str, form_data):
     all_count = 0
     async with self.db.engine.acquire() as conn:
         async with conn.begin() as t:
@@ -39,10 +50,76 @@ async def execute_request(self, method: str, form_data):
     }
 
 
+def parse_reference(value, names) -> str:
+    """
+    解析 $name.field 或 $name.index.field 引用
+
+    :param names: 请求中存在的 view 名
+    :returns: 引用的 view 名，不是引用时返回 None
+    """
+    if not isinstance(value, str) or not value.startswith("$"):
+        return None
+    arr = value[1:].split(".")
+    if len(arr) not in (2, 3) or arr[0] not in names:
+        return None
+    if len(arr) == 3 and not arr[1].isdigit():
+        return None
+    return arr[0]
+
+
+def item_rows(data) -> list:
+    """
+    把单条或多条数据统一为行列表
+    """
+    return data if isinstance(data, list) else [data]
+
+
+def insert_plan(items) -> tuple:
+    """
+    解析引用建立依赖，按原列表顺序返回可合并插入的分组
+
+    引用指向前面最近一个同名项，前面没有时不替换，与逐项插入一致；
+    相邻的同一 view 且字段相同的项合并，引用了组内前面的项时另起一组
+
+    :param items: [(view_name, data)]
+    :returns: (groups, deps)，groups 为 [[同一语句插入的项下标]]，
+        deps 为每项的 {view_name: 依赖项下标}
+    """
+    last: Dict[str, int] = {}
+    deps = []
+    groups: List[List[int]] = []
+    group_key = None
+    for index, (name, data) in enumerate(items):
+        rows = item_rows(data)
+        dep = {}
+        for row in rows:
+            for v in row.values():
+                ref = parse_reference(v, last)
+                if ref is not None and ref not in dep:
+                    dep[ref] = last[ref]
+        deps.append(dep)
+        keys = {tuple(sorted(row)) for row in rows}
+        key = (name, keys.pop()) if len(rows) > 0 and len(keys) == 1 \
+            else None
+        if key is not None and key == group_key and \
+                all(i < groups[-1][0] for i in dep.values()):
+            groups[-1].append(index)
+        else:
+            groups.append([index])
+            group_key = key
+        last[name] = index
+    return groups, deps
+
+
 class BasePolymerization(object):
     """
     聚合
     """
+    # get 请求同时执行的查询数，每个查询占用一个连接
+    __get_parallel__ = 4
+    # get 请求一次最多的查询数，None 不限制
+    __get_max_queries__ = 20
+
     def __init__(self, db):
         self.db = db
         self.views: Dict[str, BaseView] = {}
@@ -53,14 +130,32 @@ class BasePolymerization(object):
         """
         self.views[view.name] = view
 
+    def write_tables(self, form_data) -> set:
+        """
+        请求中涉及的表，写入后递增版本号使结果缓存失效
+        """
+        return {
+            self.views[item["name"]].name
+            for item in form_data
+            if item["name"] in self.views
+        }
+
     async def dispatch_request(self, context):
         """
         分发请求
         """
         request_method_name = context.method + "_request"
         if hasattr(self, request_method_name):
+            token = None
+            if self.db.labeled:
+                token = set_label("polymerization", context.method)
             try:
                 return await getattr(self, request_method_name)(context)
+            except json.JSONDecodeError as e:
+                return {
+                    "status": 400,
+                    "message": "Bad Request: %s" % e,
+                }
             except Exception as e:
                 LOGGER.error(
                     "view.BaseView.dispatch_request Error",
@@ -71,75 +166,266 @@ class BasePolymerization(object):
                     "status": 500,
                     "message": "polymerization dispatch_request: " + error,
                 }
+            finally:
+                reset_label(token)
         return {"status": 405, "message": "Method Not Allowed!"}
 
+    async def get_request(self, context):
+        """
+        多表查询
+
+        form_data 为 [{"name", "data"}, ...] 时结果按下标返回列表，
+        为 {key: {"name", "data"}} 时按 key 返回；
+        查询参数 snapshot 开启时在同一个快照事务中依次执行，
+        否则各自获取连接并发执行，同时最多 __get_parallel__ 个；
+        查询数超过 __get_max_queries__ 时返回 400
+        """
+        form_data = context.form_data
+        if isinstance(form_data, dict):
+            keys = list(form_data)
+            items = list(form_data.values())
+        elif isinstance(form_data, list):
+            keys = None
+            items = form_data
+        else:
+            return {
+                "status": 400,
+                "message": "polymerization get: queries must be list or dict",
+            }
+        max_queries = self.__get_max_queries__
+        if max_queries is not None and len(items) > max_queries:
+            return {
+                "status": 400,
+                "message": "polymerization get: queries %d exceeds the "
+                "limit %d" % (len(items), max_queries),
+            }
+        raw_args = context.raw_args
+        snapshot = raw_args.get("snapshot") if raw_args else None
+        if snapshot and snapshot != "0":
+            results = []
+            async with self.db.snapshot():
+                for item in items:
+                    results.append(await self.get_item(context, item))
+        else:
+            semaphore = asyncio.Semaphore(self.__get_parallel__)
+
+            async def get_item(item):
+                async with semaphore:
+                    return await self.get_item(context, item)
+            results = await asyncio.gather(*[
+                get_item(item) for item in items
+            ])
+        return {
+            "status": 200,
+            "message": "polymerization get ok!",
+            "data": list(results) if keys is None else dict(
+                zip(keys, results),
+            ),
+        }
+
+    async def get_item(self, context, item):
+        """
+        通过 view 的 dispatch_request 执行一个查询，过滤器和字段过滤都生效
+        """
+        name = item.get("name") if isinstance(item, dict) else None
+        view = self.views.get(name) if isinstance(name, str) else None
+        if view is None:
+            return {
+                "status": 404,
+                "message": "polymerization get: view not found: %s" % name,
+            }
+        ctx = Context(
+            "get",
+            context.url_path,
+            context.header,
+            form_data=item.get("data") or {},
+            sessions=context.sessions,
+        )
+        if view.stream_mode(ctx) is not None:
+            return {
+                "status": 400,
+                "message": "polymerization get: stream is not supported",
+            }
+        resp = await view.dispatch_request(ctx)
+        # 结果缓存返回编码好的 body，数据库生成的 json 为字符串
+        if "body" in resp:
+            return json.loads(resp["body"])
+        if "data_json" in resp:
+            resp = dict(resp)
+            resp["data"] = json.loads(resp.pop("data_json"))
+        return resp
+
     async def post_request(self, context):
         """
         多表创建或连接表创建
+
+        按列表顺序插入，$name.index.field 引用前面已插入的项，
+        相邻的同一 view 且字段相同的项合并为一条多行插入
         """
         form_data = context.form_data
-        cache = {}
+        items = [
+            (item["name"], item["data"])
+            for item in form_data
+            if item["name"] in self.views
+        ]
+        groups, deps = insert_plan(items)
+        try:
+            return await self._post_request(items, groups, deps)
+        finally:
+            self.db.bump_version(*self.write_tables(form_data))
+            self.db.mark_write(context.sessions)
+
+    async def _post_request(self, items, groups, deps):
+        depended = {i for dep in deps for i in dep.values()}
         all_count = 0
         async with self.db.engine.acquire() as conn:
             async with conn.begin() as t:
-                # 也许需要进行两次循环一次做依赖处理循环并根据依赖关系排序
-                # 第二次直接开启事务并缓存之前插入的数据
-                for item in form_data:
-                    view_name = item["name"]
-                    if view_name not in self.views:
-                        continue
-                    view: BaseView = self.views[view_name]
-                    data = item["data"]
-                    if isinstance(data, list):
-                        for i in data:
-                            for k, v in i.items():
-                                if isinstance(v, str) and v[0] == "$":
-                                    i[k] = inject_value(v, cache)
-                    else:
-                        for k, v in data.items():
-                            if isinstance(v, str) and v[0] == "$":
-                                data[k] = inject_value(v, cache)
-                    ctx = Context("post", form_data=data)
-                    sql = await view.dispatch_request(
-                        ctx,
-                        generate_sql=True,
-                    )
-                    if isinstance(sql, (dict, tuple)):
-                        await t.rollback()
-                        return sql
-                    count, rowid = await self.db.execute_insert(
-                        sql,
+                for group in groups:
+                    for index in group:
+                        for row in item_rows(items[index][1]):
+                            self.inject_row(row, items, deps[index])
+                    view: BaseView = self.views[items[group[0]][0]]
+                    if len(group) > 1 and await self.can_merge(
+                        view,
                         conn,
-                    )
-                    has_rowid = count == 1 and rowid > 0
-                    all_count += count
-                    primary_key = view.get_primary()
-                    if has_rowid and primary_key is not None:
-                        if isinstance(data, list):
-                            data[0][primary_key.name] = rowid
-                        else:
-                            data[primary_key.name] = rowid
-                    cache[view.name] = data
+                        depended.isdisjoint(group),
+                    ):
+                        res = await self.insert_group(
+                            view,
+                            [items[i][1] for i in group],
+                            conn,
+                        )
+                        if isinstance(res, (dict, tuple)):
+                            await t.rollback()
+                            return res
+                        all_count += res
+                        continue
+                    for index in group:
+                        res = await self.insert_item(
+                            view,
+                            items[index][1],
+                            conn,
+                        )
+                        if isinstance(res, (dict, tuple)):
+                            await t.rollback()
+                            return res
+                        all_count += res
         return {
             "status": 201,
             "message": "Inserts Ok!",
             "meta": {"count": all_count}
         }
 
+    @staticmethod
+    def inject_row(row: dict, items, dep: dict):
+        """
+        用依赖项已插入的数据替换引用
+        """
+        for k, v in row.items():
+            name = parse_reference(v, dep)
+            if name is not None:
+                row[k] = inject_value(v, {name: items[dep[name]][1]})
+
+    async def can_merge(self, view: BaseView, conn, leaf: bool) -> bool:
+        """
+        是否可以合并插入，
+        有 auth_filter 或 post_filter 的 view 需要逐项处理，
+        被引用的项需要能取回多行插入的主键
+        """
+        if hasattr(view, "auth_filter") or hasattr(view, "post_filter"):
+            return False
+        if leaf or view.get_primary() is None:
+            return True
+        if self.db.drivername() == "mysql":
+            return await self.db.autoinc_step(conn) > 0
+        return True
+
+    async def insert_item(self, view: BaseView, data, conn):
+        """
+        单项插入，回填主键
+
+        :returns: 插入行数或错误响应
+        """
+        ctx = Context("post", form_data=data)
+        sql = await view.dispatch_request(
+            ctx,
+            generate_sql=True,
+        )
+        if isinstance(sql, (dict, tuple)):
+            return sql
+        count, rowid = await self.db.execute_insert(
+            sql,
+            conn,
+        )
+        has_rowid = count == 1 and rowid > 0
+        primary_key = view.get_primary()
+        if has_rowid and primary_key is not None:
+            if isinstance(data, list):
+                data[0][primary_key.name] = rowid
+            else:
+                data[primary_key.name] = rowid
+        return count
+
+    async def insert_group(self, view: BaseView, datas: list, conn):
+        """
+        多项合并为多行插入，按参数上限分批，回填主键
+
+        :returns: 插入行数或错误响应
+        """
+        rows = [row for data in datas for row in item_rows(data)]
+        primary = view.get_primary()
+        returning = primary is not None and \
+            self.db.drivername() == "postgresql"
+        batch = view.bulk_batch_size(rows)
+        sqls = []
+        for i in range(0, len(rows), batch):
+            ctx = Context("post", form_data=rows[i:i + batch])
+            sql = await view.dispatch_request(
+                ctx,
+                generate_sql=True,
+            )
+            if isinstance(sql, (dict, tuple)):
+                return sql
+            if returning:
+                sql = sql.returning(primary)
+            sqls.append((sql, {}))
+        count, rowids = await self.db.execute_bulk_insert(sqls, conn)
+        explicit = primary is None or primary.name in rows[0]
+        if not explicit and rowids is not None and \
+                len(rowids) == len(rows):
+            for row, rowid in zip(rows, rowids):
+                row[primary.name] = rowid
+        return count
+
     async def delete_request(self, context):
         """
         删除
         """
         form_data = context.form_data
-        return await execute_request(self, "delete", form_data)
+        return await execute_request(
+            self,
+            "delete",
+            form_data,
+            context.sessions,
+        )
 
     async def put_request(self, context):
         """
         修改
         """
         form_data = context.form_data
-        return await execute_request(self, "put", form_data)
+        return await execute_request(
+            self,
+            "put",
+            form_data,
+            context.sessions,
+        )
 
     async def patch_request(self, context):
         form_data = context.form_data
-        return await execute_request(self, "patch", form_data)
+        return await execute_request(
+            self,
+            "patch",
+            form_data,
+            context.sessions,
+        )
@@ -0,0 +1,223 @@
+import time
+import traceback
+from typing import Dict, List, Optional
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    # python3.6 没有 contextvars，占用时间不区分 view
+    contextvars = None
+
+__all__ = [
+    "PoolMetrics",
+    "InstrumentedEngine",
+    "set_label",
+    "reset_label",
+    "current_label",
+    "current_filter",
+]
+
+# 当前请求的 (view.method, 字段过滤函数)，由 dispatch_request 设置
+CURRENT_LABEL = contextvars.ContextVar(
+    "restful_model_label",
+    default=None,
+) if contextvars is not None else None
+
+
+def set_label(name: str, method: str, filter_keys=None):
+    """
+    设置当前请求的统计标签，返回用于 reset_label 的 token
+
+    :param filter_keys: 字段过滤函数，被过滤的字段在慢查询日志中隐藏值
+    """
+    if CURRENT_LABEL is None:
+        return None
+    return CURRENT_LABEL.set(("%s.%s" % (name, method), filter_keys))
+
+
+def reset_label(token) -> None:
+    if token is not None:
+        CURRENT_LABEL.reset(token)
+
+
+def current_label() -> str:
+    if CURRENT_LABEL is None:
+        return "-"
+    value = CURRENT_LABEL.get()
+    return "-" if value is None else value[0]
+
+
+def current_filter():
+    if CURRENT_LABEL is None:
+        return None
+    value = CURRENT_LABEL.get()
+    return None if value is None else value[1]
+
+
+class PoolMetrics(object):
+    """
+    连接池统计: acquire 等待时间，按 view.method 的连接占用时间，
+    当前占用中的连接和占用最久的连接及获取时的调用栈
+    """
+    def __init__(self, capture_stack: bool = True, longest: int = 10):
+        self.capture_stack = capture_stack
+        self.longest_size = longest
+        self.acquires = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        # label: [次数, 总时间, 最长时间]
+        self.hold: Dict[str, list] = {}
+        # id(上下文): (开始时间, label, 调用栈)
+        self.active: Dict[int, tuple] = {}
+        # [(占用时间, label, 调用栈)]，按占用时间倒序
+        self.longest: List[tuple] = []
+
+    def acquired(self, key: int, wait: float, now: float) -> None:
+        self.acquires += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+        stack = None
+        if self.capture_stack:
+            # 去掉统计自身的两层
+            stack = traceback.extract_stack(limit=18)[:-2]
+        self.active[key] = (now, current_label(), stack)
+
+    def released(self, key: int, now: float) -> None:
+        entry = self.active.pop(key, None)
+        if entry is None:
+            return
+        start, label, stack = entry
+        held = now - start
+        stats = self.hold.get(label)
+        if stats is None:
+            stats = self.hold[label] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += held
+        if held > stats[2]:
+            stats[2] = held
+        longest = self.longest
+        if len(longest) < self.longest_size or held > longest[-1][0]:
+            longest.append((held, label, stack))
+            longest.sort(key=lambda item: item[0], reverse=True)
+            del longest[self.longest_size:]
+
+    def leaks(self, threshold: float) -> List[dict]:
+        """
+        占用超过 threshold 秒仍未释放的连接
+        """
+        now = time.monotonic()
+        return [
+            item for item in self.held(now)
+            if item["age"] >= threshold
+        ]
+
+    def held(self, now: Optional[float] = None) -> List[dict]:
+        now = time.monotonic() if now is None else now
+        res = [
+            {
+                "age": now - start,
+                "label": label,
+                "stack": format_stack(stack),
+            }
+            for start, label, stack in self.active.values()
+        ]
+        res.sort(key=lambda item: item["age"], reverse=True)
+        return res
+
+    def snapshot(self, engine=None) -> dict:
+        """
+        统计快照，传入 engine 时附带连接池的空闲数和容量
+        """
+        res = {
+            "acquires": self.acquires,
+            "wait_avg": self.wait_total / self.acquires
+            if self.acquires else 0.0,
+            "wait_max": self.wait_max,
+            "in_use": len(self.active),
+            "hold": {
+                label: {
+                    "count": count,
+                    "avg": total / count,
+                    "max": max_time,
+                }
+                for label, (count, total, max_time) in self.hold.items()
+            },
+            "longest": [
+                {
+                    "hold": held,
+                    "label": label,
+                    "stack": format_stack(stack),
+                }
+                for held, label, stack in self.longest
+            ],
+            "held": self.held(),
+        }
+        if engine is not None:
+            res["idle"] = engine.freesize
+            res["size"] = engine.size
+            res["minsize"] = engine.minsize
+            res["maxsize"] = engine.maxsize
+        return res
+
+    def reset(self) -> None:
+        """
+        清空累计的统计，不影响占用中的连接
+        """
+        self.acquires = 0
+        self.wait_total = self.wait_max = 0.0
+        self.hold.clear()
+        self.longest.clear()
+
+
+def format_stack(stack) -> Optional[str]:
+    if stack is None:
+        return None
+    return "".join(traceback.format_list(stack))
+
+
+class AcquireContext(object):
+    """
+    统计 acquire 等待和连接占用时间的上下文
+    """
+    __slots__ = ("engine", "metrics", "_ctx")
+
+    def __init__(self, engine, metrics: PoolMetrics) -> None:
+        self.engine = engine
+        self.metrics = metrics
+        self._ctx = None
+
+    def __await__(self):
+        # await engine.acquire() 需要自己 release，不统计
+        return self.engine.acquire().__await__()
+
+    async def __aenter__(self):
+        start = time.monotonic()
+        self._ctx = self.engine.acquire()
+        conn = await self._ctx.__aenter__()
+        now = time.monotonic()
+        self.metrics.acquired(id(self), now - start, now)
+        return conn
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self._ctx.__aexit__(exc_type, exc, tb)
+        finally:
+            self.metrics.released(id(self), time.monotonic())
+
+
+class InstrumentedEngine(object):
+    """
+    包装 engine，acquire 时记录统计，其余属性透传
+    """
+    __slots__ = ("engine", "metrics")
+
+    def __init__(self, engine, metrics: Optional[PoolMetrics] = None):
+        self.engine = engine
+        self.metrics = metrics or PoolMetrics()
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def acquire(self) -> AcquireContext:
+        return AcquireContext(self.engine, self.metrics)
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+__all__ = ["SingleFlight"]
+
+
+class Flight(object):
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(object):
+    """
+    合并并发的相同请求，同一 key 同时只执行一次，结果返回给所有等待者
+
+    执行放在独立的 task 中，某个等待者被取消(例如客户端断开)不影响其他等待者，
+    所有等待者都取消后才取消执行
+    """
+    def __init__(self) -> None:
+        self.flights: Dict[Hashable, Flight] = {}
+        # 执行次数，共享结果的次数
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]):
+        """
+        :param func: 没有进行中的相同请求时调用，返回 awaitable
+        :returns: (结果, 是否为共享的结果)
+        """
+        flight = self.flights.get(key)
+        shared = flight is not None
+        if shared:
+            self.shared += 1
+        else:
+            self.calls += 1
+            flight = Flight(asyncio.ensure_future(func()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(
+                lambda _: self.forget(key, flight),
+            )
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # 最后一个等待者也取消了
+                self.forget(key, flight)
+                flight.task.cancel()
+
+    def forget(self, key: Hashable, flight: Flight) -> None:
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def __len__(self) -> int:
+        return len(self.flights)
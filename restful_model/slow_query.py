@@ -0,0 +1,399 @@
+import time
+import random
+import asyncio
+from collections import deque
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy.sql import ClauseElement, visitors
+from sqlalchemy.sql.compiler import SQLCompiler
+from sqlalchemy.sql.elements import BindParameter, ColumnClause
+
+from .utils import LOGGER
+from .pool_metrics import current_label, current_filter
+
+__all__ = ["SlowQueryLog", "TimedEngine"]
+
+# 各数据库查看执行计划的前缀
+EXPLAIN_PREFIX = {
+    "sqlite": "EXPLAIN QUERY PLAN ",
+    "mysql": "EXPLAIN ",
+    "postgresql": "EXPLAIN (FORMAT JSON) ",
+}
+REDACTED = "***"
+
+
+def bind_columns(statement) -> Dict[BindParameter, str]:
+    """
+    语句中与字段比较的 bindparam 对应的字段名
+    """
+    res = {}
+
+    def visit_binary(binary):
+        left = binary.left
+        if not isinstance(left, ColumnClause):
+            return
+        for elem in visitors.iterate(binary.right, {}):
+            if isinstance(elem, BindParameter):
+                res[elem] = left.name
+    visitors.traverse(statement, {}, {"binary": visit_binary})
+    return res
+
+
+def first_params(multiparams, params) -> dict:
+    """
+    executemany 时只记录第一组参数
+    """
+    if multiparams:
+        zero = multiparams[0]
+        if isinstance(zero, (list, tuple)) and zero and \
+                isinstance(zero[0], dict):
+            return zero[0]
+        if isinstance(zero, dict):
+            return zero
+    return params
+
+
+def format_plan(rows) -> str:
+    lines = []
+    for row in rows:
+        # RowProxy 迭代的是字段名
+        values = list(row.values()) if hasattr(row, "values") else list(row)
+        if len(values) == 4 and isinstance(values[3], str):
+            # sqlite: id, parent, notused, detail
+            lines.append(values[3])
+        elif len(values) == 1:
+            lines.append(str(values[0]))
+        else:
+            lines.append(" | ".join(str(v) for v in values))
+    return "\n".join(lines)
+
+
+class SlowQueryLog(object):
+    """
+    慢查询日志，超过 threshold 秒的语句记录 sql、参数、view 和 method，
+    并在另一个连接上执行 EXPLAIN 取得执行计划
+
+    sample_rate 为慢语句的采样比例，每 period 秒最多记录 limit 条，
+    超出的只计数，下一条日志带上被丢弃的数量
+    """
+    def __init__(
+            self,
+            threshold: float = 0.5,
+            sample_rate: float = 1.0,
+            limit: int = 10,
+            period: float = 60.0,
+            explain: bool = True,
+            redact: Iterable[str] = ("password",),
+            maxlen: int = 100,
+            logger=LOGGER,
+    ) -> None:
+        """
+        :param redact: 总是隐藏值的字段，view 查询时过滤掉的字段同样隐藏
+        :param maxlen: entries 保留的最近记录数
+        """
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.limit = limit
+        self.period = period
+        self.explain = explain
+        self.redact = set(redact)
+        self.logger = logger
+        self.entries = deque(maxlen=maxlen)
+        self.slow = 0
+        self.dropped = 0
+        self._window_start = 0.0
+        self._window_count = 0
+        self._dropped_since = 0
+        self._pending = set()
+
+    def allow(self) -> bool:
+        """
+        采样和限流
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return False
+        now = time.monotonic()
+        if now - self._window_start >= self.period:
+            self._window_start = now
+            self._window_count = 0
+        if self._window_count >= self.limit:
+            return False
+        self._window_count += 1
+        return True
+
+    def record(
+            self,
+            engine,
+            query,
+            multiparams,
+            params,
+            seconds: float,
+            error: Optional[BaseException] = None,
+    ):
+        """
+        执行耗时超过阈值时记录，由 TimedConnection 调用
+
+        :param error: 语句执行失败或被取消(超时)时的异常
+        """
+        if seconds < self.threshold:
+            return
+        self.slow += 1
+        if not self.allow():
+            self.dropped += 1
+            self._dropped_since += 1
+            return
+        try:
+            entry = self.make_entry(
+                engine,
+                query,
+                multiparams,
+                params,
+                seconds,
+            )
+        except Exception as e:
+            # 日志出错不影响语句的执行结果
+            LOGGER.error("slow_query.SlowQueryLog.record Error", exc_info=e)
+            return
+        entry["error"] = None if error is None else repr(error)
+        entry["dropped"] = self._dropped_since
+        self._dropped_since = 0
+        self.entries.append(entry)
+        if self.explain and entry["explain"]:
+            task = asyncio.ensure_future(self._explain(engine, entry))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+        else:
+            self.log(entry)
+
+    def make_entry(self, engine, query, multiparams, params, seconds):
+        data = first_params(multiparams, params)
+        filter_keys = current_filter()
+        if isinstance(query, ClauseElement):
+            compiled = query.compile(dialect=engine.dialect)
+            sql = compiled.string
+            explain = isinstance(compiled, SQLCompiler)
+            if explain:
+                values = compiled.construct_params(data)
+                columns = {
+                    compiled.bind_names[bind]: name
+                    for bind, name in bind_columns(
+                        compiled.statement,
+                    ).items()
+                    if bind in compiled.bind_names
+                }
+                if compiled.positional:
+                    args = tuple(
+                        values[name] for name in compiled.positiontup
+                    )
+                else:
+                    args = values
+                explain = not compiled.isinsert
+            else:
+                # DDL
+                values, columns, args = {}, {}, ()
+        else:
+            sql = str(query)
+            values = data if isinstance(data, dict) else {}
+            columns = {}
+            args = multiparams[0] if multiparams else data
+            explain = sql.lstrip()[:6].lower() in (
+                "select",
+                "update",
+                "delete",
+            )
+        redacted = {}
+        for key, val in values.items():
+            name = columns.get(key, key)
+            if name in self.redact or (
+                filter_keys is not None and not filter_keys(name)
+            ):
+                val = REDACTED
+            redacted[key] = val
+        return {
+            "seconds": seconds,
+            "label": current_label(),
+            "sql": sql,
+            "params": redacted,
+            "rows": len(multiparams[0])
+            if multiparams and isinstance(multiparams[0], list) else 1,
+            "explain": explain and engine.dialect.name in EXPLAIN_PREFIX,
+            "plan": None,
+            "_args": args,
+        }
+
+    async def _explain(self, engine, entry) -> None:
+        sql = EXPLAIN_PREFIX[engine.dialect.name] + entry["sql"]
+        args = entry["_args"]
+        try:
+            async with engine.acquire() as conn:
+                if getattr(engine, "driver", None) == "asyncpg":
+                    rows = await conn.connection.fetch(sql, *args)
+                else:
+                    async with conn.execute(sql, args) as cursor:
+                        rows = await cursor.fetchall()
+            entry["plan"] = format_plan(rows)
+        except Exception as e:
+            entry["plan"] = "explain failed: %s" % e
+        self.log(entry)
+
+    def log(self, entry) -> None:
+        entry.pop("_args", None)
+        self.logger.warning(
+            "slow query %.3fs [%s]%s%s\n%s\nparams: %r%s",
+            entry["seconds"],
+            entry["label"],
+            " (%d dropped)" % entry["dropped"] if entry["dropped"] else "",
+            " failed: %s" % entry["error"] if entry["error"] else "",
+            entry["sql"],
+            entry["params"],
+            "\nplan:\n%s" % entry["plan"] if entry["plan"] else "",
+        )
+
+    async def wait(self) -> None:
+        """
+        等待进行中的 EXPLAIN 完成
+        """
+        if self._pending:
+            await asyncio.gather(*self._pending)
+
+
+class TimedExecute(object):
+    """
+    包装 conn.execute 的返回值，既可以 await 也可以 async with，
+    计时到语句执行完成，不包括读取结果，
+    执行失败或被取消的语句同样记录
+    """
+    __slots__ = ("conn", "args", "_ctx")
+
+    def __init__(self, conn: "TimedConnection", args: tuple) -> None:
+        self.conn = conn
+        self.args = args
+        self._ctx = None
+
+    def __await__(self):
+        return self._execute().__await__()
+
+    async def _execute(self):
+        conn = self.conn
+        query, multiparams, params = self.args
+        start = time.perf_counter()
+        error = None
+        try:
+            return await conn.connection.execute(
+                query,
+                *multiparams,
+                **params,
+            )
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            conn.log.record(
+                conn.engine,
+                query,
+                multiparams,
+                params,
+                time.perf_counter() - start,
+                error,
+            )
+
+    async def __aenter__(self):
+        conn = self.conn
+        query, multiparams, params = self.args
+        start = time.perf_counter()
+        error = None
+        try:
+            self._ctx = conn.connection.execute(
+                query,
+                *multiparams,
+                **params,
+            )
+            return await self._ctx.__aenter__()
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            conn.log.record(
+                conn.engine,
+                query,
+                multiparams,
+                params,
+                time.perf_counter() - start,
+                error,
+            )
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._ctx.__aexit__(exc_type, exc, tb)
+
+
+class TimedConnection(object):
+    """
+    包装连接，execute 计时，其余属性透传
+    """
+    __slots__ = ("connection", "engine", "log")
+
+    def __init__(self, connection, engine, log: SlowQueryLog) -> None:
+        self.connection = connection
+        self.engine = engine
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute(self, query, *multiparams, **params) -> TimedExecute:
+        return TimedExecute(self, (query, multiparams, params))
+
+
+class TimedAcquire(object):
+    __slots__ = ("engine", "log", "_ctx")
+
+    def __init__(self, engine, log: SlowQueryLog) -> None:
+        self.engine = engine
+        self.log = log
+        self._ctx = None
+
+    def __await__(self):
+        return self._acquire().__await__()
+
+    async def _acquire(self):
+        conn = await self.engine.acquire()
+        return TimedConnection(conn, self.engine, self.log)
+
+    async def __aenter__(self):
+        self._ctx = self.engine.acquire()
+        conn = await self._ctx.__aenter__()
+        return TimedConnection(conn, self.engine, self.log)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self._ctx.__aexit__(exc_type, exc, tb)
+
+
+class TimedEngine(object):
+    """
+    包装 engine，获取的连接执行语句时计时，其余属性透传
+    """
+    __slots__ = ("engine", "log")
+
+    def __init__(self, engine, log: SlowQueryLog) -> None:
+        self.engine = engine
+        self.log = log
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def acquire(self) -> TimedAcquire:
+        return TimedAcquire(self.engine, self.log)
+
+    def release(self, conn):
+        if isinstance(conn, TimedConnection):
+            conn = conn.connection
+        return self.engine.release(conn)
+
+
+def slow_query_log(value) -> Optional[SlowQueryLog]:
+    """
+    DataBase 的 slow_query 参数，可以是阈值秒数或 SlowQueryLog
+    """
+    if value is None or isinstance(value, SlowQueryLog):
+        return value
+    return SlowQueryLog(threshold=float(value))
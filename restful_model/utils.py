@@ -1,8 +1,13 @@
 import ast
+import json
+import base64
+import hashlib
 import logging
 import sqlalchemy as sa
 from sqlalchemy.sql import dml
 from sqlalchemy.sql.expression import bindparam
+from datetime import date, datetime, time
+from decimal import Decimal
 from typing import Union, List, Set
 
 
@@ -158,6 +163,187 @@ def handle_where_param(
         return sa.or_(*data) if is_or else sa.and_(*data)
 
 
+def freeze(value):
+    """
+    把 json 数据转换为可 hash 的结构，用于缓存的 key
+    """
+    if isinstance(value, dict):
+        return (dict,) + tuple((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return (list,) + tuple(freeze(v) for v in value)
+    return value.__class__, value
+
+
+def copy_json(value):
+    """
+    复制 json 数据中的 dict 和 list，其余的值共享
+    """
+    if isinstance(value, dict):
+        return {k: copy_json(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_json(v) for v in value]
+    return value
+
+
+def fingerprint(*parts) -> str:
+    """
+    json 数据的稳定摘要，dict 按 key 排序，不同进程间结果一致
+    """
+    data = json.dumps(
+        parts,
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def get_header(headers, name: str):
+    """
+    读取请求头，兼容不区分大小写的 headers 和普通 dict
+    """
+    if not headers:
+        return None
+    value = headers.get(name)
+    if value is None:
+        lower = name.lower()
+        for key, val in headers.items():
+            if key.lower() == lower:
+                value = val
+                break
+    if isinstance(value, list):
+        value = ", ".join(value)
+    return value
+
+
+def etag_match(header, etag: str) -> bool:
+    """
+    If-None-Match 是否包含 etag，按弱比较忽略 W/ 前缀
+    """
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for item in header.split(","):
+        item = item.strip()
+        if item.startswith("W/"):
+            item = item[2:]
+        if item == etag:
+            return True
+    return False
+
+
+def lift_value(params, value, column=None):
+    """
+    把字面量替换为 bindparam, 值放入 params
+    """
+    name = "_p%d" % len(params)
+    params[name] = value
+    return bindparam(name, type_=None if column is None else column.type)
+
+
+def lift_param(column, data, params):
+    """
+    提升单个比较条件中的字面量
+
+    :returns: (形状, 条件)，形状为 None 时无法缓存
+    """
+    if not isinstance(data, dict):
+        if data is None:
+            return (None,), data
+        return ("?",), lift_value(params, data, column)
+    opt = data.get('opt', '$te')
+    if 'val' not in data or opt == '$bind':
+        return freeze(data), data
+    value = data['val']
+    if opt == '$raw':
+        return None, data
+    if opt == '$in' or opt == '$nin':
+        if not isinstance(value, list):
+            return None, data
+        value = [lift_value(params, v, column) for v in value]
+        return (opt, len(value)), {'opt': opt, 'val': value}
+    if value is None:
+        return freeze(data), data
+    return (opt,), {'opt': opt, 'val': lift_value(params, value, column)}
+
+
+def lift_where_param(columns, form_data, params):
+    """
+    把 where 条件中的字面量替换为 bindparam, 同时生成条件的形状
+
+    形状只包含字段、比较符和结构，值相同与否不影响形状，
+    用于缓存生成的语句
+
+    :param columns: 表的字段
+    :param form_data: where 条件
+    :param params: 收集被替换的值
+    :returns: (形状, 替换后的 where)，形状为 None 时无法缓存
+    """
+    if form_data is None:
+        return (), None
+    shape = []
+    data = {}
+    for key, val in form_data.items():
+        if key == "$or" or key == "$and":
+            val_shape, val = lift_where_param(columns, val, params)
+        elif key in columns:
+            column = columns[key]
+            if isinstance(val, list):
+                val_shape = []
+                rows = []
+                for row in val:
+                    row_shape, row = lift_param(column, row, params)
+                    if row_shape is None:
+                        return None, form_data
+                    val_shape.append(row_shape)
+                    rows.append(row)
+                val_shape = tuple(val_shape)
+                val = rows
+            else:
+                val_shape, val = lift_param(column, val, params)
+        else:
+            val_shape = ()
+        if val_shape is None:
+            return None, form_data
+        shape.append((key, val_shape))
+        data[key] = val
+    return tuple(shape), data
+
+
+class CachedStatement(sa.sql.ClauseElement):
+    """
+    语句缓存的条目，保存语句和各方言的编译结果，
+    驱动执行时调用 compile 直接返回同一个编译结果，值通过执行参数传入
+
+    语句本身不做修改，需要生成新语句时使用 statement
+    """
+    def __init__(self, statement) -> None:
+        self.statement = statement
+        self.compiled = {}
+
+    def compile(self, bind=None, dialect=None, **kw):
+        if bind is not None or dialect is None or kw:
+            return self.statement.compile(bind, dialect, **kw)
+        compiled = self.compiled.get(dialect)
+        if compiled is None:
+            compiled = self.statement.compile(dialect=dialect)
+            self.compiled[dialect] = compiled
+        return compiled
+
+
+def cache_statement(sql):
+    """
+    包装为语句缓存的条目，分页时为 (查询, 统计) 元组
+    """
+    if isinstance(sql, tuple):
+        return tuple(CachedStatement(s) for s in sql)
+    return CachedStatement(sql)
+
+
 def inject_value(value: str, cache):
     arr = value[1:].split(".")
     table = arr[0]
@@ -177,15 +363,25 @@ def inject_value(value: str, cache):
     return value
 
 
-def insert_sql(model: sa.Table, data, filter_list=return_true) -> dml.Insert:
+def insert_sql(
+    model: sa.Table,
+    data,
+    filter_list=return_true,
+    returning=None,
+) -> dml.Insert:
     """
     生成插入语句对象
+
+    :param returning: 需要返回的字段
     """
     if isinstance(data, list):
         data = [{k: v for k, v in m.items() if filter_list(k)} for m in data]
     else:
         data = {k: v for k, v in data.items() if filter_list(k)}
-    return model.insert().values(data)
+    sql = model.insert().values(data)
+    if returning is not None:
+        sql = sql.returning(returning)
+    return sql
 
 
 def delete_sql(model: sa.Table, data, filter_list=return_true) -> dml.Delete:
@@ -243,6 +439,38 @@ def update_sql(
     return sql.values(values_data)
 
 
+def case_update_sql(
+            model: sa.Table,
+            column: sa.Column,
+            keys: list,
+            values: List[dict]
+        ) -> dml.Update:
+    """
+    单条语句批量更新
+    UPDATE t SET a = CASE id WHEN 1 THEN .. END WHERE id IN (..)
+
+    :param column: 条件字段
+    :param keys: 每行的条件值
+    :param values: 每行要更新的值，字段需一致
+    """
+    values_data = {}
+    for name in values[0]:
+        if name not in model.columns:
+            continue
+        target = model.columns[name]
+        values_data[name] = sa.case(
+            [
+                (k, sa.literal(v[name], type_=target.type))
+                for k, v in zip(keys, values)
+            ],
+            value=column,
+            else_=target,
+        )
+    if len(values_data) == 0:
+        raise UPDATE_NOT_VALUES
+    return model.update().where(column.in_(keys)).values(values_data)
+
+
 def handle_orders(columns, orders, filter_list):
     """
     处理排序
@@ -265,6 +493,277 @@ def handle_orders(columns, orders, filter_list):
         return order_by
 
 
+# 可以使用索引的比较符
+INDEX_OPTS = ("$te", "$lt", "$lte", "$gt", "$gte", "$in", "$bind")
+
+
+def index_columns(model: sa.Table) -> set:
+    """
+    能走索引的字段: 主键、索引和唯一约束的第一个字段
+    """
+    res = set()
+    groups = [model.primary_key.columns]
+    groups.extend(index.columns for index in model.indexes)
+    groups.extend(
+        constraint.columns
+        for constraint in model.constraints
+        if isinstance(constraint, sa.UniqueConstraint)
+    )
+    for columns in groups:
+        for column in columns:
+            res.add(column.name)
+            break
+    return res
+
+
+def param_index(data):
+    """
+    单个比较条件是否能走索引
+
+    :returns: (True/False/None, 原因)，None 为不生成条件
+    """
+    if not isinstance(data, dict):
+        return True, None
+    if "val" not in data:
+        return None, None
+    opt = data.get("opt", "$te")
+    if opt == "$like":
+        value = data["val"]
+        if isinstance(value, str) and value[:1] in ("%", "_"):
+            return False, "$like leading wildcard"
+        return True, None
+    if opt in INDEX_OPTS:
+        return True, None
+    return False, opt
+
+
+def where_index(
+        columns,
+        indexed: set,
+        form_data,
+        filter_list=return_true,
+        is_or=False,
+        missing=None,
+):
+    """
+    与 handle_where_param 相同的方式遍历条件，判断是否有条件命中索引
+
+    and 中任一条件命中即可，or 需要每个分支都命中
+
+    :param missing: 收集未命中的 (字段, 原因)
+    :returns: True 命中，False 未命中，None 没有条件
+    """
+    if form_data is None:
+        return None
+    if missing is None:
+        missing = []
+    res = []
+    for key, val in form_data.items():
+        if key == "$or" or key == "$and":
+            hit = where_index(
+                columns,
+                indexed,
+                val,
+                filter_list,
+                key == "$or",
+                missing,
+            )
+        elif key in columns and filter_list(key):
+            hit = None
+            for row in val if isinstance(val, list) else (val,):
+                row_hit, reason = param_index(row)
+                if row_hit is None:
+                    continue
+                if row_hit and key not in indexed:
+                    row_hit, reason = False, "not indexed"
+                if not row_hit:
+                    missing.append((key, reason))
+                hit = hit or row_hit
+        else:
+            continue
+        if hit is not None:
+            res.append(hit)
+    if len(res) == 0:
+        return None
+    return all(res) if is_or else any(res)
+
+
+def index_guard(model: sa.Table, indexed: set, where, orders, filter_list):
+    """
+    检查查询条件和排序是否能走索引
+
+    有条件时需要至少一个条件命中索引的第一个字段，
+    没有条件时第一个排序字段需要有索引，
+    没有条件也没有排序(全表扫描或全表写入)同样不满足
+
+    :returns: 不满足时返回说明，满足时返回 None
+    """
+    columns = model.columns
+    missing = []
+    hit = where_index(columns, indexed, where, filter_list, missing=missing)
+    if hit:
+        return None
+    if hit is None:
+        order = None
+        if orders:
+            order = orders[0][1:] if orders[0][:1] == "-" else orders[0]
+        if order is None or order not in columns or not filter_list(order):
+            missing.append(("where", "no condition"))
+        elif order in indexed:
+            return None
+        else:
+            missing.append((order, "order not indexed"))
+    return "Query needs an index on %s: %s; indexed columns: %s" % (
+        model.name,
+        ", ".join("%s (%s)" % item for item in missing),
+        ", ".join(sorted(indexed)) or "none",
+    )
+
+
+def where_cost(columns, form_data, depth: int = 1):
+    """
+    统计 where 的开销，遍历方式与 handle_where_param 一致
+
+    :returns: (条件个数, 嵌套层数, 最长的 $in/$nin 列表长度)
+    """
+    predicates = 0
+    max_depth = depth
+    max_in = 0
+    if not isinstance(form_data, dict):
+        return predicates, max_depth, max_in
+    for key, val in form_data.items():
+        if key == "$or" or key == "$and":
+            sub = where_cost(columns, val, depth + 1)
+            predicates += sub[0]
+            max_depth = max(max_depth, sub[1])
+            max_in = max(max_in, sub[2])
+        elif key in columns:
+            for row in val if isinstance(val, list) else (val,):
+                predicates += 1
+                if isinstance(row, dict) and \
+                        row.get("opt") in ("$in", "$nin") and \
+                        isinstance(row.get("val"), list):
+                    max_in = max(max_in, len(row["val"]))
+    return predicates, max_depth, max_in
+
+
+def count_funcs(keys) -> int:
+    """
+    keys 中的函数调用个数
+    """
+    count = 0
+    for key in keys or ():
+        if isinstance(key, dict):
+            if key.get("func"):
+                count += 1
+        elif isinstance(key, str) and "(" in key:
+            count += 1
+    return count
+
+
+def handle_cursor_orders(model: sa.Table, orders, filter_list):
+    """
+    生成游标分页的排序字段，末尾补上主键保证排序唯一
+
+    :returns: [(column, is_desc)]
+    """
+    columns = model.columns
+    order_by = []
+    names = set()
+    for order in orders or ():
+        is_desc = order[:1] == "-"
+        name = order[1:] if is_desc else order
+        if name not in columns or not filter_list(name):
+            raise ValueError("cursor order not support: %s" % order)
+        if name not in names:
+            names.add(name)
+            order_by.append((columns[name], is_desc))
+    for column in model.primary_key.columns:
+        if column.name not in names:
+            if not filter_list(column.name):
+                raise ValueError(
+                    "cursor primary key is filtered: %s" % column.name
+                )
+            order_by.append((column, False))
+    if len(order_by) == 0:
+        raise ValueError("cursor need order or primary key")
+    return order_by
+
+
+def cursor_where(order_by, values):
+    """
+    生成游标分页的 seek 条件，方向一致时使用行值比较 (a, id) > (?, ?)
+    """
+    directions = {is_desc for _, is_desc in order_by}
+    if len(directions) == 1:
+        is_desc = directions.pop()
+        if len(order_by) == 1:
+            left = order_by[0][0]
+            right = values[0]
+        else:
+            left = sa.tuple_(*[column for column, _ in order_by])
+            right = sa.tuple_(*values)
+        return left < right if is_desc else left > right
+    clauses = []
+    for i, (column, is_desc) in enumerate(order_by):
+        params = [c == v for (c, _), v in zip(order_by[:i], values)]
+        params.append(column < values[i] if is_desc else column > values[i])
+        clauses.append(sa.and_(*params))
+    return sa.or_(*clauses)
+
+
+def encode_cursor(order_by, row) -> str:
+    """
+    用最后一行的排序字段生成游标
+    """
+    fields = [
+        "-" + column.name if is_desc else column.name
+        for column, is_desc in order_by
+    ]
+    values = [row[column.name] for column, _ in order_by]
+    data = json.dumps([fields, values], default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def _cursor_value(column, value):
+    """
+    还原游标中被序列化为字符串的值
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type in (datetime, date, time):
+        return python_type.fromisoformat(value)
+    if python_type is Decimal:
+        return Decimal(value)
+    return value
+
+
+def decode_cursor(order_by, cursor: str) -> list:
+    """
+    解析游标，排序字段和请求不一致时报错
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        fields, values = json.loads(data)
+        values = [
+            _cursor_value(column, value)
+            for (column, _), value in zip(order_by, values)
+        ]
+    except Exception:
+        raise ValueError("cursor is invalid")
+    expect = [
+        "-" + column.name if is_desc else column.name
+        for column, is_desc in order_by
+    ]
+    if fields != expect or len(values) != len(order_by):
+        raise ValueError("cursor not match order")
+    return values
+
+
 def handle_func_args(columns, args, filter_list):
     argv = []
     flag = False
@@ -368,19 +867,24 @@ def select_sql(
     orders=None,
     limit=None,
     group=None,
-    drivername=None
+    drivername=None,
+    default_select=None,
 ):
     """
     生成查询语句对象
+
+    :param default_select: 没有 keys 时使用的查询语句，由 view 预先生成
     """
     where_data = handle_where_param(model.columns, data, filter_list)
     if keys:
         columns = handle_keys(model.columns, keys, filter_list, drivername)
+        sql = sa.sql.select(columns)
+    elif default_select is not None:
+        sql = default_select
     else:
-        columns = [
+        sql = sa.sql.select([
             column for column in model.columns if filter_list(column.name)
-        ]
-    sql = sa.sql.select(columns)
+        ])
     if where_data is not None:
         sql = sql.where(where_data)
     if group:
@@ -409,8 +913,136 @@ def select_sql(
     return sql
 
 
+def json_agg_sql(sql, drivername, has_order=False):
+    """
+    把查询包装为由数据库生成 json 数组的语句，结果为一个字符串
+
+    postgresql 使用 json_agg(row), mysql 使用 JSON_ARRAYAGG(JSON_OBJECT()),
+    sqlite 使用 json_group_array(json_object())
+
+    :param has_order: mysql 的 JSON_ARRAYAGG 不保证顺序，有排序时不支持
+    :returns: 不支持时返回 None
+    """
+    rows = sql.alias("_rows")
+    if drivername == "postgresql":
+        data = sa.cast(
+            sa.func.coalesce(
+                sa.func.json_agg(sa.literal_column(rows.name)),
+                sa.literal_column("'[]'"),
+            ),
+            sa.Text,
+        )
+    elif drivername == "mysql" and not has_order or drivername == "sqlite":
+        args = []
+        for column in rows.c:
+            args.append(sa.literal(column.key))
+            args.append(column)
+        if drivername == "mysql":
+            data = sa.func.ifnull(
+                sa.func.JSON_ARRAYAGG(sa.func.JSON_OBJECT(*args)),
+                "[]",
+            )
+        else:
+            data = sa.func.json_group_array(sa.func.json_object(*args))
+    else:
+        return None
+    return sa.sql.select([data.label("data")]).select_from(rows)
+
+
+def encode_json_data(resp) -> bytes:
+    """
+    把数据库生成的 json 字符串直接拼接到响应中，不再解析
+    """
+    # 不修改 resp，合并的请求共享同一个响应
+    head = {k: v for k, v in resp.items() if k != "data_json"}
+    text = json.dumps(head, ensure_ascii=False)[:-1]
+    if len(head) > 0:
+        text += ", "
+    return (text + '"data": ' + resp["data_json"] + "}").encode("utf-8")
+
+
+async def encode_stream(resp):
+    """
+    把流式响应编码为 bytes 块
+
+    ndjson 时每行一条数据，否则输出与普通响应相同结构的 json，
+    data 部分边读边写，结束或中断时关闭数据库迭代器释放连接
+    """
+    chunks = resp.pop("stream")
+    ndjson = resp.pop("ndjson", False)
+    try:
+        if ndjson:
+            async for rows in chunks:
+                yield "".join(
+                    json.dumps(row, ensure_ascii=False) + "\n" for row in rows
+                ).encode("utf-8")
+        else:
+            head = json.dumps(resp, ensure_ascii=False)[:-1]
+            if len(resp) > 0:
+                head += ", "
+            yield (head + '"data": [').encode("utf-8")
+            sep = ""
+            async for rows in chunks:
+                if len(rows) == 0:
+                    continue
+                yield (sep + ", ".join(
+                    json.dumps(row, ensure_ascii=False) for row in rows
+                )).encode("utf-8")
+                sep = ", "
+            yield b"]}"
+    finally:
+        await chunks.aclose()
+
+
 def model_to_dict(row):
     """
     把model查询出的row转换为dict
     """
     return {key: val for key, val in row.items()}
+
+
+def rows_to_list(rows) -> list:
+    """
+    把查询出的 rows 转换为值的列表，类型处理函数整个结果集只取一次，
+    不再每个字段查一次 keymap
+    """
+    if len(rows) == 0:
+        return []
+    processors = getattr(rows[0], "_processors", None)
+    if processors is None:
+        return [[val for _, val in row.items()] for row in rows]
+    processors = [(i, p) for i, p in enumerate(processors) if p is not None]
+    if len(processors) == 0:
+        return [list(row._row) for row in rows]
+    res = []
+    for row in rows:
+        values = list(row._row)
+        for i, processor in processors:
+            values[i] = processor(values[i])
+        res.append(values)
+    return res
+
+
+def rows_to_dict(keys, rows) -> list:
+    """
+    用结果集的字段名元组 zip 每行的值生成 dict
+    """
+    if len(rows) == 0:
+        return []
+    processors = getattr(rows[0], "_processors", None)
+    if processors is None:
+        return [model_to_dict(row) for row in rows]
+    keys = tuple(keys)
+    if not any(processors):
+        return [dict(zip(keys, row._row)) for row in rows]
+    return [dict(zip(keys, values)) for values in rows_to_list(rows)]
+
+
+def rows_to_columns(keys, rows) -> dict:
+    """
+    列式格式，字段名只出现一次
+    """
+    return {
+        "columns": list(keys),
+        "rows": rows_to_list(rows),
+    }
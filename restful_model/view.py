@@ -1,28 +1,107 @@
 import json
+import time
+import weakref
 import asyncio
 import sqlalchemy as sa
+from functools import partial
+from typing import Dict, Optional
+from collections import namedtuple
 
-from .database import DataBase
+from .database import DataBase, is_unsupported_function
 from .utils import (
     select_sql,
     model_to_dict,
+    rows_to_dict,
+    rows_to_columns,
+    json_agg_sql,
     insert_sql,
     delete_sql,
     update_sql,
+    case_update_sql,
     get_filter_list,
     return_true,
+    freeze,
+    copy_json,
+    lift_value,
+    lift_where_param,
+    CachedStatement,
+    cache_statement,
+    handle_cursor_orders,
+    cursor_where,
+    encode_cursor,
+    decode_cursor,
+    encode_json_data,
+    index_columns,
+    index_guard,
+    where_cost,
+    count_funcs,
+    get_header,
+    etag_match,
     LOGGER,
 )
 from .context import Context
-# from .lru_cache import lru_cache
+from .lru_cache import LRUCache, ResultCache
+from .single_flight import SingleFlight
+from .pool_metrics import set_label, reset_label
+from .metrics import NULL_TIMER
 
-QUERY_ARGS = ("keys", "where", "limit", "order", "group")
+NDJSON = "application/x-ndjson"
+COUNT_MODES = ("exact", "estimate", "cached", "none")
+METHODS = ("get", "post", "put", "delete", "patch", "options")
+# 影响请求方法计划的配置
+PLAN_CONFIG = ("__filter_keys__", "__methods__")
+# 超过该行数的批量插入不进入语句缓存
+SQL_CACHE_MAX_ROWS = 100
 UNAUTH = {
     "status": 401,
     "message": "Default Unauthorized",
 }
 
 
+# 字段过滤函数对应的可见字段名、字段和默认查询语句
+Projection = namedtuple("Projection", ["names", "columns", "select"])
+
+
+class Plan(object):
+    """
+    请求方法预先解析好的中间件链和字段过滤函数
+    """
+    __slots__ = ("handles", "filter_keys", "label_filter")
+
+    def __init__(self, handles: tuple, filter_keys, label_filter) -> None:
+        self.handles = handles
+        self.filter_keys = filter_keys
+        self.label_filter = label_filter
+
+
+class Relation(object):
+    """
+    include 可以展开的关联 view
+
+    many 为 True 时一行对应多个关联行(一对多)，否则对应一个(多对一)
+    """
+    __slots__ = ("view", "local", "remote", "many")
+
+    def __init__(self, view: "BaseView", local: str, remote: str, many: bool):
+        self.view = view
+        self.local = local
+        self.remote = remote
+        self.many = many
+
+
+def foreign_key_relation(model, related):
+    """
+    从外键推断 (local, remote, many)，两个表之间没有外键时返回 None
+    """
+    for fk in related.foreign_keys:
+        if fk.column.table is model:
+            return fk.column.name, fk.parent.name, True
+    for fk in model.foreign_keys:
+        if fk.column.table is related:
+            return fk.parent.name, fk.column.name, False
+    return None
+
+
 class BaseView(object):
     """
     基本视图
@@ -30,6 +109,53 @@ class BaseView(object):
     __model__ = None
     __methods__ = None
     __filter_keys__ = None
+    # 语句缓存容量，为 0 或 None 时关闭
+    __sql_cache__ = 128
+    # 分页总数的统计方式: exact, estimate, cached, none
+    __count__ = "exact"
+    # cached 模式下总数的缓存秒数和容量
+    __count_ttl__ = 60
+    __count_cache__ = 1024
+    # 流式响应每次从数据库读取的行数
+    __stream_chunk__ = 1000
+    # 列表查询由数据库生成 json，响应中为 data_json 字符串
+    __db_json__ = False
+    # 批量插入每批最多的行数，以及是否每批单独提交
+    __bulk_batch__ = 500
+    __bulk_commit__ = False
+    # 列表更新的执行方式: executemany, case
+    __bulk_update__ = "executemany"
+    # 查询结果缓存，例如 {"ttl": 60, "maxsize": 1024, "maxbytes": 1 << 24}
+    # 开启后 GET 返回编码好的 body，写入操作按表版本号失效
+    __cache__ = None
+    # 分阶段耗时统计，Metrics 实例，None 关闭
+    __metrics__ = None
+    # 索引检查，条件和排序都没有命中索引时: reject 返回 400，
+    # limit 限制查询的行数(写入仍然拒绝)，None 关闭
+    __index_guard__ = None
+    __index_guard_limit__ = 20
+    # 查询限制，None 为不限制
+    # GET 不带 limit 时的默认每页行数，每页最大行数
+    __page_size__ = None
+    __max_page_size__ = None
+    # $in/$nin 列表长度，条件个数，$or/$and 嵌套层数，keys 中的函数个数
+    __max_in__ = None
+    __max_predicates__ = None
+    __max_depth__ = None
+    __max_funcs__ = None
+    # 语句执行超时秒数，流式响应不限制
+    __statement_timeout__ = None
+    # 合并并发的相同 GET，只执行一次查询，结果共享
+    __single_flight__ = False
+    # GET 响应带 ETag，If-None-Match 命中时不查询直接返回 304
+    __etag__ = False
+    # 数据版本的来源，见 DataBase.data_version:
+    # None 只用本进程写入的版本号，只适合单进程部署，多个 worker 时
+    # 没看到其他 worker 写入的进程会对过期数据继续返回 304；
+    # 多进程或有绕过本库的写入时使用 trigger 或者字段名(例如 updated_at)
+    __etag_probe__ = None
+    # include 展开时每行最多的关联行数，请求中的 limit 不能超过它
+    __include_limit__ = 100
 
     """
     通用请求响应处理器
@@ -37,14 +163,157 @@ class BaseView(object):
     def __init__(self, db: DataBase=None):
         self.db = db
         self.cache = {}
+        self.sql_cache = LRUCache(
+            self.__sql_cache__
+        ) if self.__sql_cache__ else None
+        self.count_cache = LRUCache(self.__count_cache__)
+        self.db_json = self.__db_json__
+        # 语句缓存淘汰时对应的 json 包装语句一起释放
+        self.json_agg_cache = weakref.WeakKeyDictionary()
+        self.result_cache = ResultCache(
+            **self.__cache__
+        ) if self.__cache__ else None
+        self.index_columns = index_columns(
+            self.model
+        ) if self.__index_guard__ else None
+        self.single_flight = SingleFlight() if self.__single_flight__ else None
+        self.primary = None
+        for column in self.model.columns:
+            if column.primary_key and isinstance(column.type, sa.Integer):
+                self.primary = column
+                break
+        self.projections = {}
+        self.plans = {}
+        self.relations: Dict[str, Relation] = {}
+        self.compile()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self.reset_plans(name)
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        self.reset_plans(name)
+
+    def reset_plans(self, name: str) -> None:
+        """
+        实例上替换了处理方法、过滤器或配置时重新生成请求方法的计划
+        """
+        plans = self.__dict__.get("plans")
+        if plans is None:
+            return
+        if name in PLAN_CONFIG:
+            # 字段过滤函数随配置变化，可见字段一起重新生成
+            self.cache.clear()
+            self.projections.clear()
+            plans.clear()
+        elif name in METHODS or name.endswith(("_filter", "_sql")):
+            plans.clear()
+
+    def compile(self) -> None:
+        """
+        预先生成各请求方法的计划，请求时只做字典查找
+        """
+        for method in self.__methods__ or METHODS:
+            self.plan(method, True, False)
+
+    def plan(self, method: str, decorator_filter, generate_sql) -> Plan:
+        """
+        请求方法的中间件链和字段过滤函数
+        """
+        key = (method, decorator_filter, generate_sql)
+        plan = self.plans.get(key)
+        if plan is not None:
+            return plan
+        handles = self.generate_filter(method, decorator_filter, generate_sql)
+        plan = Plan(
+            tuple(handles),
+            self.key_filter(method),
+            self.key_filter("get"),
+        )
+        for filter_keys in (plan.filter_keys, plan.label_filter, return_true):
+            if filter_keys not in self.projections:
+                self.projections[filter_keys] = self.build_projection(
+                    filter_keys,
+                )
+        # 不存在的方法不缓存，避免任意的 method 参数占用内存
+        if plan.handles[-1][0] is not None:
+            self.plans[key] = plan
+        return plan
+
+    def build_projection(self, filter_keys) -> Projection:
+        columns = tuple(
+            column for column in self.model.columns
+            if filter_keys(column.name)
+        )
+        return Projection(
+            [column.name for column in columns],
+            columns,
+            sa.sql.select(columns),
+        )
+
+    def projection(self, filter_keys) -> Projection:
+        """
+        字段过滤函数对应的可见字段，view 自身的过滤函数预先生成，
+        auth_filter 等设置的其他过滤函数每次生成
+        """
+        res = self.projections.get(filter_keys)
+        if res is None:
+            res = self.build_projection(filter_keys or return_true)
+        return res
 
     def get_primary(self):
         """
         获取主键
         """
-        for column in self.model.columns:
-            if column.primary_key and isinstance(column.type, sa.Integer):
-                return column
+        return self.primary
+
+    def read_conn(self, sessions=None):
+        """
+        获取读连接，带 __statement_timeout__ 超时
+        """
+        return self.db.acquire_read(sessions, self.__statement_timeout__)
+
+    def written(self, context: Context):
+        """
+        写入后使结果缓存失效，读写分离时把会话固定到主库
+        """
+        self.db.bump_version(self.name)
+        self.db.mark_write(context.sessions)
+
+    def add_include(
+            self,
+            view: "BaseView",
+            name: Optional[str] = None,
+            local: Optional[str] = None,
+            remote: Optional[str] = None,
+            many: Optional[bool] = None,
+    ):
+        """
+        添加 GET 的 include 可以展开的关联 view
+
+        不指定 local、remote 时从两个表的外键推断，
+        指定时 remote 不是关联表的主键或唯一字段即为一对多
+        """
+        if local is None and remote is None:
+            relation = foreign_key_relation(self.model, view.model)
+            if relation is None:
+                raise ValueError(
+                    "include: no foreign key between %s and %s" % (
+                        self.name,
+                        view.name,
+                    )
+                )
+            local, remote, inferred = relation
+        else:
+            column = view.model.columns[remote]
+            inferred = not (column.primary_key or column.unique)
+        self.relations[name or view.name] = Relation(
+            view,
+            local,
+            remote,
+            inferred if many is None else many,
+        )
 
     @property
     def name(self):
@@ -54,87 +323,993 @@ class BaseView(object):
     def model(self):
         return self.__model__
 
-    def get_sql(self, context: Context):
+    def cache_sql(self, key, build):
+        """
+        按请求形状缓存生成的语句，编译结果保存在同一个缓存条目中
+        """
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            sql = cache_statement(build())
+            self.sql_cache.set(key, sql)
+        return sql
+
+    def get_sql(self, context: Context, params=None):
         """
         分析请求生成sql
+
+        :param params: 传入时把字面量提升为执行参数并使用语句缓存
         """
         filter_keys = context.filter_keys
         form_data = context.form_data
         keys = form_data.get("keys")
         where = form_data.get("where")
-        limit = form_data.get("limit")
+        limit = None if context.has_param else form_data.get("limit")
         orders = form_data.get("order")
         group = form_data.get("group")
+        drivername = self.db.drivername()
+        # none 模式多取一行判断是否还有下一页
+        has_more = int(bool(limit) and self.count_mode(context) == "none")
+        if params is not None and self.sql_cache is not None:
+            where_shape, where = lift_where_param(
+                self.model.columns,
+                where,
+                params,
+            )
+            if where_shape is not None:
+                if limit:
+                    limit = (
+                        lift_value(params, limit[0]),
+                        lift_value(params, limit[1] + has_more),
+                    )
+                key = (
+                    "get",
+                    filter_keys,
+                    drivername,
+                    where_shape,
+                    freeze(keys),
+                    freeze(orders),
+                    freeze(group),
+                    bool(limit),
+                )
+                return self.cache_sql(key, lambda: select_sql(
+                    self.model,
+                    where,
+                    filter_keys,
+                    keys,
+                    orders,
+                    limit,
+                    group,
+                    drivername,
+                    self.projection(filter_keys).select,
+                ))
+            params.clear()
+        if has_more:
+            limit = (limit[0], limit[1] + 1)
         return select_sql(
             self.model,
             where,
             filter_keys,
             keys,
             orders,
-            None if context.has_param else limit,
+            limit,
             group,
-            self.db.drivername()
+            drivername,
+            self.projection(filter_keys).select,
+        )
+
+    def count_mode(self, context: Context) -> str:
+        """
+        分页总数的统计方式，请求的 count 参数优先
+        """
+        mode = context.form_data.get("count") or self.__count__
+        if mode not in COUNT_MODES:
+            raise ValueError("count mode not support: %s" % mode)
+        return mode
+
+    async def execute_count(
+            self,
+            sql_count,
+            params,
+            conn=None,
+            sessions=None,
+    ) -> int:
+        """
+        执行统计总数
+
+        :param sessions: 未传入连接时用于选择读库
+        """
+        if conn is None:
+            async with self.read_conn(sessions) as conn:
+                return await self.execute_count(sql_count, params, conn)
+        async with conn.execute(sql_count, params) as cursor:
+            return (await cursor.first())._count
+
+    async def execute_rows(self, sql, params, conn=None, sessions=None):
+        """
+        执行查询
+
+        :returns: (字段名, rows)
+        """
+        if conn is None:
+            async with self.read_conn(sessions) as conn:
+                return await self.execute_rows(sql, params, conn)
+        async with conn.execute(sql, params) as cursor:
+            keys = cursor.keys()
+            return keys, await cursor.fetchall()
+
+    def format_rows(self, context: Context, keys, rows):
+        """
+        转换查询结果，format 为 columns 时使用列式格式
+        {"columns": [...], "rows": [[...], ...]}
+        """
+        if context.form_data.get("format") == "columns":
+            return rows_to_columns(keys, rows)
+        return rows_to_dict(keys, rows)
+
+    async def page_get(self, context: Context, sql, sql_count, params):
+        """
+        分页查询，按统计方式获取总数
+        """
+        form_data = context.form_data
+        limit = form_data.get("limit")
+        mode = self.count_mode(context)
+        extra = {}
+        total = None
+        if mode == "none":
+            keys, rows = await self.execute_rows(
+                sql,
+                params,
+                sessions=context.sessions,
+            )
+            extra["has_more"] = len(rows) > limit[1]
+            rows = rows[:limit[1]]
+        else:
+            where = form_data.get("where")
+            if mode == "estimate" and not where:
+                total = await self.db.estimate_count(self.name)
+                if total is not None:
+                    extra["estimated"] = True
+            elif mode == "cached":
+                key = (context.filter_keys, freeze(where))
+                cached = self.count_cache.get(key)
+                if cached is not None and cached[0] > time.monotonic():
+                    total = cached[1]
+                else:
+                    total = await self.execute_count(
+                        sql_count,
+                        params,
+                        sessions=context.sessions,
+                    )
+                    self.count_cache.set(
+                        key,
+                        (time.monotonic() + self.__count_ttl__, total),
+                    )
+            if total is not None:
+                keys, rows = await self.execute_rows(
+                    sql,
+                    params,
+                    sessions=context.sessions,
+                )
+            elif self.db.drivername() == "sqlite" or \
+                    self.db.snapshot_conn() is not None:
+                # sqlite 并发查询没有收益，
+                # 且 :memory: 库的每个连接都是独立的数据库；
+                # 快照事务只有一个连接，不能并发
+                async with self.read_conn(context.sessions) as conn:
+                    total = await self.execute_count(sql_count, params, conn)
+                    keys, rows = await self.execute_rows(sql, params, conn)
+            else:
+                total, (keys, rows) = await asyncio.gather(
+                    self.execute_count(
+                        sql_count,
+                        params,
+                        sessions=context.sessions,
+                    ),
+                    self.execute_rows(
+                        sql,
+                        params,
+                        sessions=context.sessions,
+                    ),
+                )
+        context.timer.lap("execute")
+        data = self.format_rows(context, keys, rows)
+        context.timer.lap("convert")
+        pagination = {} if total is None else {"total": total}
+        pagination["count"] = len(rows)
+        pagination["skip"] = limit[0]
+        pagination["limit"] = limit[1]
+        pagination.update(extra)
+        return {
+            'status': 200,
+            'message': "Query ok!",
+            'data': data,
+            "meta": {
+                "pagination": pagination,
+            }
+        }
+
+    def cursor_sql(self, context: Context, params=None):
+        """
+        游标分页，根据上一页最后一行的排序字段和主键生成 seek 条件，
+        代替 OFFSET 扫描，多取一行用于判断是否有下一页
+
+        排序字段不支持 NULL 值
+
+        :param params: 传入时把字面量提升为执行参数并使用语句缓存
+        :returns: (sql, 排序字段)
+        """
+        filter_keys = context.filter_keys
+        form_data = context.form_data
+        keys = form_data.get("keys")
+        where = form_data.get("where")
+        group = form_data.get("group")
+        limit = form_data.get("limit")
+        cursor = form_data.get("cursor")
+        drivername = self.db.drivername()
+        if isinstance(limit, (list, tuple)):
+            limit = limit[1]
+        if not isinstance(limit, int) or limit <= 0:
+            raise ValueError("cursor need limit")
+        order_by = handle_cursor_orders(
+            self.model,
+            form_data.get("order"),
+            filter_keys,
+        )
+        orders = [
+            "-" + column.name if is_desc else column.name
+            for column, is_desc in order_by
+        ]
+        values = decode_cursor(order_by, cursor) if cursor else None
+        limit += 1
+
+        def build():
+            sql = select_sql(
+                self.model,
+                where,
+                filter_keys,
+                keys,
+                orders,
+                None,
+                group,
+                drivername,
+                self.projection(filter_keys).select,
+            )
+            if values is not None:
+                sql = sql.where(cursor_where(order_by, values))
+            return sql.limit(limit)
+        if params is not None and self.sql_cache is not None:
+            where_shape, where = lift_where_param(
+                self.model.columns,
+                where,
+                params,
+            )
+            if where_shape is not None:
+                if values is not None:
+                    values = [
+                        lift_value(params, value, column)
+                        for (column, _), value in zip(order_by, values)
+                    ]
+                limit = lift_value(params, limit)
+                key = (
+                    "cursor",
+                    filter_keys,
+                    drivername,
+                    where_shape,
+                    freeze(keys),
+                    tuple(orders),
+                    freeze(group),
+                    values is not None,
+                )
+                return self.cache_sql(key, build), order_by
+            params.clear()
+        return build(), order_by
+
+    async def cursor_get(self, context: Context):
+        """
+        游标分页查询
+        """
+        params = {}
+        try:
+            sql, order_by = self.cursor_sql(context, params)
+        except ValueError as e:
+            return {
+                "status": 400,
+                "message": str(e),
+            }
+        context.timer.lap("sql")
+        keys, rows = await self.execute_rows(
+            sql,
+            params,
+            sessions=context.sessions,
+        )
+        context.timer.lap("execute")
+        limit = context.form_data["limit"]
+        if isinstance(limit, (list, tuple)):
+            limit = limit[1]
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            for column, _ in order_by:
+                if column.name not in last:
+                    return {
+                        "status": 400,
+                        "message": "cursor need key: %s" % column.name,
+                    }
+            next_cursor = encode_cursor(order_by, last)
+        data = self.format_rows(context, keys, rows)
+        context.timer.lap("convert")
+        return {
+            'status': 200,
+            'message': "Query ok!",
+            'data': data,
+            "meta": {
+                "pagination": {
+                    "count": len(rows),
+                    "limit": limit,
+                    "next": next_cursor,
+                }
+            }
+        }
+
+    def stream_mode(self, context: Context):
+        """
+        流式响应的格式，stream 参数或 Accept: application/x-ndjson 开启
+
+        :returns: None, "json" 或 "ndjson"
+        """
+        header = context.header
+        accept = header.get("Accept") if header else None
+        if accept and NDJSON in accept:
+            return "ndjson"
+        stream = context.form_data.get("stream")
+        if stream and stream != "0":
+            return "json"
+
+    async def iter_chunks(self, sql, params, chunk_size=None, sessions=None):
+        """
+        按块读取查询结果，内存占用只和块大小有关，
+        连接在迭代结束或关闭迭代器时释放
+        """
+        chunk_size = chunk_size or self.__stream_chunk__
+        async with self.db.acquire_read(sessions) as conn:
+            async with conn.execute(sql, params) as cursor:
+                keys = cursor.keys()
+                while True:
+                    rows = await cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows_to_dict(keys, rows)
+
+    def stream_get(self, context: Context, mode: str):
+        """
+        流式查询，返回的 stream 为按块输出 dict 的异步迭代器，
+        由 utils.encode_stream 编码后写出
+        """
+        params = {}
+        try:
+            sql = self.get_sql(context, params)
+        except ValueError as e:
+            return {
+                "status": 400,
+                "message": str(e),
+            }
+        if isinstance(sql, tuple):
+            sql = sql[0]
+        return {
+            'status': 200,
+            'message': "Query ok!",
+            'stream': self.iter_chunks(
+                sql,
+                params,
+                sessions=context.sessions,
+            ),
+            'ndjson': mode == "ndjson",
+        }
+
+    def check_cost(self, where, keys=None):
+        """
+        检查 where 和 keys 是否超出查询限制
+
+        :returns: 超出时的 400 响应
+        """
+        predicates, depth, max_in = where_cost(self.model.columns, where)
+        checks = (
+            ("$in list length", max_in, self.__max_in__),
+            ("where predicates", predicates, self.__max_predicates__),
+            ("where nesting depth", depth, self.__max_depth__),
+            ("keys functions", count_funcs(keys), self.__max_funcs__),
+        )
+        for name, value, limit in checks:
+            if limit is not None and value > limit:
+                return {
+                    "status": 400,
+                    "message": "%s %d exceeds the limit %d" % (
+                        name,
+                        value,
+                        limit,
+                    ),
+                }
+        return None
+
+    def check_get(self, context: Context):
+        """
+        GET 的查询限制，没有 limit 时使用默认每页行数，超出最大行数时截断
+        """
+        form_data = context.form_data
+        resp = self.check_cost(form_data.get("where"), form_data.get("keys"))
+        if resp is not None or context.has_param:
+            return resp
+        limit = form_data.get("limit")
+        max_size = self.__max_page_size__
+        if not limit:
+            if self.__page_size__ and self.stream_mode(context) is None:
+                form_data["limit"] = [0, self.__page_size__]
+        elif max_size is not None:
+            if isinstance(limit, int):
+                if limit > max_size:
+                    form_data["limit"] = max_size
+            elif limit[1] > max_size:
+                form_data["limit"] = [limit[0], max_size]
+        return None
+
+    def check_write(self, context: Context):
+        """
+        更新和删除的 where 限制
+        """
+        form_data = context.form_data
+        if context.method == "delete":
+            return self.check_cost(form_data)
+        if isinstance(form_data, list):
+            for item in form_data:
+                resp = self.check_cost(item.get("where"))
+                if resp is not None:
+                    return resp
+            return None
+        return self.check_cost(form_data.get("where"))
+
+    def guard_index(self, context: Context, where, orders=None):
+        """
+        __index_guard__ 开启时检查条件和排序是否命中索引
+
+        :returns: 未命中时的说明
+        """
+        if self.index_columns is None:
+            return None
+        return index_guard(
+            self.model,
+            self.index_columns,
+            where,
+            orders,
+            context.filter_keys or return_true,
+        )
+
+    def guard_get(self, context: Context):
+        """
+        GET 未命中索引时按 __index_guard__ 拒绝或限制行数
+        """
+        form_data = context.form_data
+        message = self.guard_index(
+            context,
+            form_data.get("where"),
+            form_data.get("order"),
         )
+        if message is None:
+            return None
+        if self.__index_guard__ != "limit":
+            return {"status": 400, "message": message}
+        guard_limit = self.__index_guard_limit__
+        limit = form_data.get("limit")
+        if isinstance(limit, int) and limit > 0:
+            # 游标分页的 limit 为行数
+            if limit > guard_limit:
+                form_data["limit"] = guard_limit
+        elif not limit or limit[1] > guard_limit:
+            form_data["limit"] = [limit[0] if limit else 0, guard_limit]
+        # 精确总数同样需要扫表
+        form_data["count"] = "none"
+        LOGGER.warning("%s, limit %d", message, guard_limit)
+        return None
+
+    def guard_write(self, context: Context):
+        """
+        更新和删除的条件未命中索引时拒绝
+        """
+        if self.index_columns is None:
+            return None
+        form_data = context.form_data
+        if context.method == "delete":
+            items = [form_data]
+        elif isinstance(form_data, list):
+            items = [item.get("where") for item in form_data]
+        else:
+            items = [form_data.get("where")]
+        for where in items:
+            message = self.guard_index(context, where)
+            if message is not None:
+                return {"status": 400, "message": message}
+        return None
 
     async def get(self, context: Context):
         """
         GET 查询请求的统一调用
         """
+        resp = self.check_get(context)
+        if resp is not None:
+            return resp
+        if self.index_columns is not None:
+            resp = self.guard_get(context)
+            if resp is not None:
+                return resp
+        if "include" in context.form_data:
+            return await self.include_get(context)
+        stream = not context.has_param and \
+            self.stream_mode(context) is not None
+        # 快照事务中的查询不使用缓存和合并，结果要来自同一个快照
+        snapshot = self.db.snapshot_conn() is not None
+        if self.result_cache is not None and not stream and not snapshot:
+            query = self.cached_get
+        else:
+            query = self.query_get
+        # 会话刚写入时不合并，避免读到写入前开始的查询结果
+        if self.single_flight is not None and not stream and \
+                not snapshot and not self.db.pinned(context.sessions):
+            query = partial(self.shared_get, query=query)
+        if self.__etag__ and not stream:
+            return await self.etag_get(context, query)
+        return await query(context)
+
+    def request_key(self, context: Context, *extra) -> str:
+        """
+        view、可见字段和请求的摘要
+        """
+        return context.fingerprint(
+            self.name,
+            self.projection(context.filter_keys).names,
+            *extra
+        )
+
+    async def etag_get(self, context: Context, query):
+        """
+        条件请求，ETag 由查询前的数据版本和请求摘要生成
+        """
+        version = await self.db.data_version(self.name, self.__etag_probe__)
+        etag = 'W/"%s"' % self.request_key(context, version)
+        if etag_match(get_header(context.header, "If-None-Match"), etag):
+            return {"status": 304, "headers": {"ETag": etag}}
+        resp = await query(context)
+        if resp.get("status") == 200:
+            resp = dict(resp, headers={"ETag": etag})
+        return resp
+
+    async def shared_get(self, context: Context, query):
+        """
+        合并进行中的相同查询
+
+        key 为 view、可见字段和请求的摘要加上表版本号，
+        查询期间有写入时之后的请求重新查询
+        """
+        key = (self.request_key(context), self.db.table_version(self.name))
+        resp, shared = await self.single_flight.do(
+            key,
+            lambda: query(context),
+        )
+        if shared:
+            context.timer.lap("shared")
+        # 每个请求一份拷贝(包括 data 中的每行)，
+        # 适配器或调用方修改响应时不影响其他等待者
+        return copy_json(resp)
+
+    async def cached_get(self, context: Context):
+        """
+        读取结果缓存，未命中时查询并缓存编码后的响应
+
+        查询前记录表版本号，查询期间有写入时缓存条目直接失效
+        """
+        cache = self.result_cache
+        key = (
+            context.filter_keys,
+            context.has_param,
+            freeze(context.form_data),
+        )
+        version = self.db.table_version(self.name)
+        body = cache.get(key, version)
+        if body is None:
+            context.timer.lap("cache")
+            resp = await self.query_get(context)
+            if resp.get("status") != 200:
+                return resp
+            if "data_json" in resp:
+                body = encode_json_data(resp)
+            else:
+                body = json.dumps(resp, ensure_ascii=False).encode("utf-8")
+            cache.set(key, version, body)
+            context.timer.lap("encode")
+        else:
+            context.timer.lap("cache")
+        return {
+            "status": 200,
+            "body": body,
+        }
+
+    def parse_include(self, include) -> list:
+        """
+        解析 include 参数: 关联名或
+        {"name", "keys", "where", "order", "limit", "include"}，以及它们的列表
+        """
+        if not isinstance(include, list):
+            include = [include]
+        specs = []
+        for item in include:
+            if isinstance(item, str):
+                item = {"name": item}
+            name = item.get("name") if isinstance(item, dict) else None
+            if not isinstance(name, str) or name not in self.relations:
+                raise ValueError("include not found: %s" % (name or item))
+            limit = item.get("limit", self.__include_limit__)
+            if not isinstance(limit, int) or isinstance(limit, bool) or \
+                    not 0 < limit <= self.__include_limit__:
+                raise ValueError(
+                    "include %s limit must be between 1 and %d" % (
+                        name,
+                        self.__include_limit__,
+                    )
+                )
+            specs.append(item)
+        return specs
+
+    async def include_get(self, context: Context):
+        """
+        查询后展开 include 的关联数据，每个关联一次批量 IN 查询，
+        总行数用完时关联行不足的父行再单独查询
+
+        关联表的写入不会使本表的结果缓存和 ETag 失效，所以不经过它们
+        """
+        form_data = context.form_data
+        try:
+            specs = self.parse_include(form_data["include"])
+        except ValueError as e:
+            return {
+                "status": 400,
+                "message": str(e),
+            }
+        if form_data.get("format") == "columns" or (
+            not context.has_param and self.stream_mode(context) is not None
+        ):
+            return {
+                "status": 400,
+                "message": "include does not support columns format or stream",
+            }
+        resp = await self.query_get(context)
+        if resp.get("status") != 200:
+            return resp
+        data = resp["data"]
+        rows = [data] if isinstance(data, dict) else data
+        for spec in specs:
+            error = await self.load_include(context, rows, spec)
+            if error is not None:
+                return error
+        context.timer.lap("include")
+        return resp
+
+    async def load_include(self, context: Context, rows: list, spec: dict):
+        """
+        通过关联 view 的 dispatch_request 批量查询关联行并放入每行，
+        关联 view 的过滤器和字段过滤同样生效
+
+        :returns: 出错时的响应
+        """
+        name = spec["name"]
+        relation = self.relations[name]
+        view = relation.view
+        local = relation.local
+        remote = relation.remote
+        ids = []
+        seen = set()
+        for row in rows:
+            if local not in row:
+                return {
+                    "status": 400,
+                    "message": "include %s needs key %s" % (name, local),
+                }
+            value = row[local]
+            if value is not None and value not in seen:
+                seen.add(value)
+                ids.append(value)
+        # 关联 view 隐藏的字段作为条件会被忽略，查出的是整张表
+        if not view.key_filter("get")(remote):
+            return {
+                "status": 400,
+                "message": "include %s: key %s is hidden" % (name, remote),
+            }
+        limit = spec.get("limit", self.__include_limit__) if relation.many \
+            else 1
+        children = {}
+        if ids:
+            base = {"count": "none"}
+            keys = spec.get("keys")
+            if isinstance(keys, list) and keys:
+                base["keys"] = keys if remote in keys else keys + [remote]
+            for k in ("order", "include"):
+                if k in spec:
+                    base[k] = spec[k]
+
+            def child_form(values: list) -> dict:
+                where = {remote: {"opt": "$in", "val": values}}
+                if spec.get("where"):
+                    where["$and"] = spec["where"]
+                return dict(
+                    base,
+                    where=where,
+                    limit=[0, limit * len(values)],
+                )
+            res = await self.include_rows(context, view, child_form(ids))
+            if isinstance(res, dict):
+                return res
+            items, has_more = res
+            for item in items:
+                children.setdefault(item.get(remote), []).append(item)
+            if has_more:
+                # 批量查询的总行数用完时，关联行多的父行会挤占其他父行，
+                # 不足 limit 行的父行可能缺少关联行，逐个重新查询
+                for value in ids:
+                    if len(children.get(value, ())) >= limit:
+                        continue
+                    res = await self.include_rows(
+                        context,
+                        view,
+                        child_form([value]),
+                    )
+                    if isinstance(res, dict):
+                        return res
+                    children[value] = res[0]
+        for row in rows:
+            items = children.get(row[local], ())
+            if relation.many:
+                row[name] = list(items[:limit])
+            else:
+                row[name] = items[0] if items else None
+
+    async def include_rows(self, context: Context, view, form_data: dict):
+        """
+        执行关联 view 的查询
+
+        :returns: (关联行, 是否还有更多)，出错时返回响应
+        """
+        resp = await view.dispatch_request(Context(
+            "get",
+            context.url_path,
+            context.header,
+            form_data=form_data,
+            sessions=context.sessions,
+        ))
+        if resp.get("status") != 200:
+            return resp
+        if "body" in resp:
+            resp = json.loads(resp["body"])
+        if "data_json" in resp:
+            items = json.loads(resp["data_json"])
+        else:
+            items = resp["data"]
+        pagination = resp.get("meta", {}).get("pagination", {})
+        return items, bool(pagination.get("has_more"))
+
+    async def query_get(self, context: Context):
+        """
+        执行查询
+        """
         # filter_keys = context.filter_keys
         form_data = context.form_data
-        limit = form_data.get("limit")
-        sql_arr = self.get_sql(context)
+        if not context.has_param:
+            if "cursor" in form_data:
+                return await self.cursor_get(context)
+            mode = self.stream_mode(context)
+            if mode is not None:
+                return self.stream_get(context, mode)
+        params = {}
+        try:
+            sql_arr = self.get_sql(context, params)
+        except ValueError as e:
+            return {
+                "status": 400,
+                "message": str(e),
+            }
+        context.timer.lap("sql")
         if isinstance(sql_arr, tuple):
             sql, sql_count = sql_arr
-            async with self.db.engine.acquire() as conn:
-                async with conn.execute(sql_count) as cursor:
-                    total = (await cursor.first())._count
-                async with conn.execute(sql) as cursor:
-                    data = await cursor.fetchall()
-                    data = [model_to_dict(row) for row in data]
-                return {
-                    'status': 200,
-                    'message': "Query ok!",
-                    'data': data,
-                    "meta": {
-                        "pagination": {
-                            "total": total,
-                            "count": len(data),
-                            'skip': limit[0],
-                            'limit': limit[1]
-                        }
-                    }
-                }
+            return await self.page_get(context, sql, sql_count, params)
         else:
             sql = sql_arr
-            async with self.db.engine.acquire() as conn:
-                async with conn.execute(sql) as cursor:
+            use_db_json = self.db_json and not context.has_param and \
+                form_data.get("format") != "columns" and \
+                "include" not in form_data
+            if use_db_json:
+                res = await self.db_json_get(context, sql, params)
+                if res is not None:
+                    return res
+            async with self.read_conn(context.sessions) as conn:
+                async with conn.execute(sql, params) as cursor:
                     if context.has_param:
-                        data = model_to_dict(await cursor.first())
+                        row = await cursor.first()
+                        context.timer.lap("execute")
+                        data = model_to_dict(row)
                     else:
-                        data = await cursor.fetchall()
-                        data = [model_to_dict(row) for row in data]
+                        keys = cursor.keys()
+                        rows = await cursor.fetchall()
+                        context.timer.lap("execute")
+                        data = self.format_rows(context, keys, rows)
+                    context.timer.lap("convert")
                     return {
                         'status': 200,
                         'message': "Query ok!",
                         'data': data
                     }
 
-    def post_sql(self, context: Context):
+    async def db_json_get(self, context: Context, sql, params):
+        """
+        由数据库生成 json 数组的列表查询
+
+        :returns: 数据库不支持时返回 None，使用普通查询
+        """
+        agg_sql = self.json_agg_cache.get(sql)
+        if agg_sql is None:
+            cached = isinstance(sql, CachedStatement)
+            agg_sql = json_agg_sql(
+                sql.statement if cached else sql,
+                self.db.drivername(),
+                bool(context.form_data.get("order")),
+            )
+            if agg_sql is None:
+                return None
+            if cached:
+                agg_sql = CachedStatement(agg_sql)
+            self.json_agg_cache[sql] = agg_sql
+        try:
+            async with self.read_conn(context.sessions) as conn:
+                async with conn.execute(agg_sql, params) as cursor:
+                    data = (await cursor.first()).data
+            context.timer.lap("execute")
+        except Exception as e:
+            # 只在数据库版本不支持 json 函数时关闭，连接故障、超时等照常抛出
+            if not is_unsupported_function(e):
+                raise
+            LOGGER.warning(
+                "view.BaseView.db_json_get disable: %s",
+                self.name,
+                exc_info=e,
+            )
+            self.db_json = False
+            return None
+        return {
+            'status': 200,
+            'message': "Query ok!",
+            'data_json': data,
+        }
+
+    def post_sql(
+            self,
+            context: Context,
+            params=None,
+            rows=None,
+            returning=None,
+    ):
         """
         分析请求生成sql
+
+        :param params: 传入时把字面量提升为执行参数并使用语句缓存
+        :param rows: 批量插入时的一批数据，代替 context.form_data
+        :param returning: pg 批量插入时返回的主键字段
         """
         filter_keys = context.filter_keys
-        form_data = context.form_data
-        return insert_sql(self.model, form_data, filter_keys)
+        form_data = context.form_data if rows is None else rows
+        if params is not None and self.sql_cache is not None:
+            columns = self.model.columns
+            if isinstance(form_data, list):
+                if len(form_data) <= SQL_CACHE_MAX_ROWS:
+                    data = [{
+                        k: lift_value(params, v, columns.get(k))
+                        for k, v in row.items()
+                    } for row in form_data]
+                    shape = tuple(tuple(row) for row in form_data)
+                else:
+                    data = None
+            else:
+                data = {
+                    k: lift_value(params, v, columns.get(k))
+                    for k, v in form_data.items()
+                }
+                shape = tuple(form_data)
+            if data is not None:
+                key = (
+                    "post",
+                    filter_keys,
+                    self.db.drivername(),
+                    isinstance(form_data, list),
+                    shape,
+                    returning is not None,
+                )
+                return self.cache_sql(key, lambda: insert_sql(
+                    self.model,
+                    data,
+                    filter_keys,
+                    returning,
+                ))
+            params.clear()
+        return insert_sql(self.model, form_data, filter_keys, returning)
+
+    def bulk_batch_size(self, rows) -> int:
+        """
+        每批插入的行数，不超过驱动单条语句的参数上限
+        """
+        columns = max(len(rows[0]), 1)
+        batch = min(self.__bulk_batch__, self.db.max_params() // columns)
+        return max(batch, 1)
+
+    async def bulk_post(self, context: Context):
+        """
+        批量插入，按驱动参数上限分批执行多行 VALUES，返回所有生成的主键
+
+        查询参数 commit=batch 或 __bulk_commit__ 时每批单独提交
+        """
+        rows = context.form_data
+        primary = self.get_primary()
+        explicit = primary is not None and all(
+            primary.name in row for row in rows
+        )
+        returning = primary is not None and not explicit and \
+            self.db.drivername() == "postgresql"
+        batch = self.bulk_batch_size(rows)
+        sqls = []
+        for i in range(0, len(rows), batch):
+            params = {}
+            sql = self.post_sql(
+                context,
+                params,
+                rows[i:i + batch],
+                primary if returning else None,
+            )
+            sqls.append((sql, params))
+        context.timer.lap("sql")
+        args = context.args
+        commit_each = self.__bulk_commit__ or bool(
+            args and args.get("commit", [None])[0] == "batch"
+        )
+        try:
+            count, rowids = await self.db.execute_bulk_insert(
+                sqls,
+                commit_each=commit_each,
+            )
+        finally:
+            self.written(context)
+        context.timer.lap("execute")
+        if explicit:
+            rowids = [row[primary.name] for row in rows]
+        meta = {"count": count}
+        if primary is not None and rowids is not None:
+            if count == 1:
+                meta["rowid"] = rowids[0]
+            meta["rowids"] = rowids
+        return {
+            'status': 201,
+            'message': "Insert ok!",
+            "meta": meta,
+        }
 
     async def post(self, context: Context):
         """
         插入
         """
         # filter_keys = context.filter_keyss
-        sql = self.post_sql(context)
-        count, rowid = await self.db.execute_insert(sql)
+        if isinstance(context.form_data, list) and len(context.form_data) > 0:
+            return await self.bulk_post(context)
+        params = {}
+        sql = self.post_sql(context, params)
+        context.timer.lap("sql")
+        try:
+            count, rowid = await self.db.execute_insert(sql, data=params)
+        finally:
+            self.written(context)
+        context.timer.lap("execute")
         res = {
             'status': 201,
             'message': "Insert ok!",
@@ -146,12 +1321,27 @@ class BaseView(object):
             res["meta"]["rowid"] = rowid
         return res
 
-    def delete_sql(self, context: Context):
+    def delete_sql(self, context: Context, params=None):
         """
         分析请求生成sql
+
+        :param params: 传入时把字面量提升为执行参数并使用语句缓存
         """
         # filter_keys = context.filter_keys
         form_data = context.form_data
+        if params is not None and self.sql_cache is not None:
+            where_shape, where = lift_where_param(
+                self.model.columns,
+                form_data,
+                params,
+            )
+            if where_shape is not None:
+                key = ("delete", self.db.drivername(), where_shape)
+                return self.cache_sql(
+                    key,
+                    lambda: delete_sql(self.model, where),
+                )
+            params.clear()
         return delete_sql(self.model, form_data)
 
     async def delete(self, context: Context):
@@ -159,8 +1349,21 @@ class BaseView(object):
         删除
         """
         # filter_keys = context.filter_keys
-        sql = self.delete_sql(context)
-        count = await self.db.execute_dml(sql)
+        resp = self.check_write(context) or self.guard_write(context)
+        if resp is not None:
+            return resp
+        params = {}
+        sql = self.delete_sql(context, params)
+        context.timer.lap("sql")
+        try:
+            count = await self.db.execute_dml(
+                sql,
+                params,
+                timeout=self.__statement_timeout__,
+            )
+        finally:
+            self.written(context)
+        context.timer.lap("execute")
         return {
             'status': 200,
             'message': "Delete ok!",
@@ -169,15 +1372,162 @@ class BaseView(object):
             },
         }
 
+    def lift_update(self, data, params: dict):
+        """
+        提升单条更新中的字面量
+
+        :returns: (缓存键, where, values)，无法提升时返回 None
+        """
+        if not isinstance(data, dict) or "data" in data or \
+                not isinstance(data.get("values"), dict):
+            return None
+        columns = self.model.columns
+        where_shape, where = lift_where_param(
+            columns,
+            data.get("where"),
+            params,
+        )
+        if where_shape is None:
+            params.clear()
+            return None
+        values_shape = []
+        values = {}
+        for k, v in data["values"].items():
+            if isinstance(v, str) and (
+                v.startswith("$bind.") or v.startswith("$incr.")
+            ):
+                values_shape.append((k, v))
+                values[k] = v
+            else:
+                values_shape.append((k,))
+                values[k] = lift_value(params, v, columns.get(k))
+        key = (
+            "put",
+            self.db.drivername(),
+            where_shape,
+            tuple(values_shape),
+        )
+        return key, where, values
+
+    def put_sql(self, context: Context, params=None):
+        """
+        分析请求生成sql
+
+        :param params: 传入时把字面量提升为执行参数并使用语句缓存
+        """
+        form_data = context.form_data
+        if params is not None and self.sql_cache is not None:
+            lifted = self.lift_update(form_data, params)
+            if lifted is not None:
+                key, where, values = lifted
+                return self.cache_sql(key, lambda: update_sql(
+                    self.model,
+                    {"where": where, "values": values},
+                ))
+        return update_sql(self.model, form_data)
+
+    def case_update_sqls(self, primary: str, items: list) -> list:
+        """
+        把只按主键等值更新的一组元素拼成 CASE 语句，按参数上限分批
+        """
+        column = self.model.columns[primary]
+        keys = [item["where"][primary] for item in items]
+        values = [item["values"] for item in items]
+        size = max(
+            self.db.max_params() // (len(values[0]) * 2 + 1),
+            1,
+        )
+        return [
+            case_update_sql(
+                self.model,
+                column,
+                keys[i:i + size],
+                values[i:i + size],
+            )
+            for i in range(0, len(items), size)
+        ]
+
+    def bulk_put_sqls(self, context: Context) -> list:
+        """
+        列表更新把相邻且语句形状相同的元素合并，每段一条语句 + 参数列表
+        (executemany)，各段按原列表的先后执行
+
+        查询参数 update=case 或 __bulk_update__ = "case" 时，
+        只按主键等值更新且主键不重复的段合并为单条 CASE 语句
+        """
+        args = context.args
+        mode = args.get("update", [None])[0] if args else None
+        mode = mode or self.__bulk_update__
+        primary = self.get_primary()
+        primary = primary.name if primary is not None else None
+        runs = []
+        for item in context.form_data:
+            params = {}
+            lifted = self.lift_update(item, params)
+            if lifted is None:
+                runs.append(update_sql(self.model, item))
+                continue
+            key, where, values = lifted
+            run = runs[-1] if runs else None
+            # 只合并相邻的元素，跨过其他形状的元素会改变执行顺序
+            if not isinstance(run, list) or run[0] != key:
+                run = [key, where, values, [], []]
+                runs.append(run)
+            run[3].append(params)
+            run[4].append(item)
+        res = []
+        for run in runs:
+            if not isinstance(run, list):
+                res.append(run)
+                continue
+            key, where, values, params, items = run
+            pk_only = key[2] == ((primary, ("?",)),) and \
+                all(len(k) == 1 for k in key[3])
+            if mode == "case" and pk_only and len(items) > 1:
+                keys = [item["where"][primary] for item in items]
+                if len(set(keys)) == len(keys):
+                    res.extend(self.case_update_sqls(primary, items))
+                    continue
+
+            def build(where=where, values=values):
+                return update_sql(
+                    self.model,
+                    {"where": where, "values": values},
+                )
+            if self.sql_cache is not None:
+                sql = self.cache_sql(key, build)
+            else:
+                sql = build()
+            res.append((sql, params))
+        return res
+
     async def put(self, context: Context):
         """
         更新
         """
         # filter_keys = context.filter_keys
+        resp = self.check_write(context) or self.guard_write(context)
+        if resp is not None:
+            return resp
         form_data = context.form_data
-        data = form_data.get("data")
-        sql = update_sql(self.model, form_data)
-        count = await self.db.execute_dml(sql, data)
+        if isinstance(form_data, list):
+            sql = self.bulk_put_sqls(context)
+            params = None
+        else:
+            params = {}
+            sql = self.put_sql(context, params)
+            if isinstance(form_data, dict) and "data" in form_data:
+                params = form_data["data"]
+        context.timer.lap("sql")
+        try:
+            count = await self.db.execute_dml(
+                sql,
+                params,
+                timeout=self.__statement_timeout__,
+            )
+        finally:
+            self.written(context)
+        context.timer.lap("execute")
         return {
             'status': 201,
             'message': "Update ok!",
@@ -197,19 +1547,40 @@ class BaseView(object):
         """
         分发请求
         """
+        metrics = self.__metrics__
+        if metrics is None or generate_sql or context.timer is not NULL_TIMER:
+            return await self._dispatch_request(
+                context,
+                method_filter,
+                decorator_filter,
+                key_filter,
+                generate_sql,
+            )
+        timer = context.timer = metrics.timer(self.name, context.method)
+        resp = await self._dispatch_request(
+            context,
+            method_filter,
+            decorator_filter,
+            key_filter,
+            generate_sql,
+        )
+        timer.finish(resp)
+        return resp
+
+    async def _dispatch_request(
+        self,
+        context: Context,
+        method_filter,
+        decorator_filter,
+        key_filter,
+        generate_sql,
+    ):
         method = context.method
-        if context.args and len(context.args) > 0:
-            if method == "get":
-                try:
-                    for k in QUERY_ARGS:
-                        if k in context.args:
-                            context.form_data[k] = json.loads(
-                                context.args[k][0]
-                            )
-                except Exception:
-                    pass
-            if "method" in context.args:
-                method = context.args["method"][0]
+        # 查询参数在 context.form_data 第一次访问时解析
+        args = context.args
+        if args and "method" in args:
+            method = args["method"][0]
+        context.timer.lap("args")
         flag = method_filter and self.__methods__ is not None
         if flag and method not in self.__methods__:
             return {
@@ -217,38 +1588,25 @@ class BaseView(object):
                 "message": "Method Not Allowed: %s" % method,
             }
         try:
-            decorator_filters = self.generate_filter(
-                method,
-                decorator_filter,
-                generate_sql,
-            )
-            filter_keys = return_true
-            if key_filter:
-                if method in self.cache:
-                    filter_keys = self.cache[method]
-                else:
-                    if self.__filter_keys__ is not None:
-                        if isinstance(self.__filter_keys__, list):
-                            filter_keys = get_filter_list(
-                                *self.__filter_keys__
-                            )
-                        elif method in self.__filter_keys__:
-                            filter_keys = get_filter_list(
-                                *self.__filter_keys__[method]
-                            )
-                    self.cache[method] = filter_keys
+            plan = self.plan(method, decorator_filter, generate_sql)
+            if plan.handles[-1][0] is None:
+                return {
+                    "status": 405,
+                    "message": "Method Not Allowed: %s" % method,
+                }
+            # 校验过的 method 才作为统计标签，避免任意参数产生新的标签
+            if method != context.method:
+                context.timer.set_method(method)
+            handles = iter(plan.handles)
+            filter_keys = plan.filter_keys if key_filter else return_true
 
             async def next_handle():
                 """
                 中间件模式
                 """
-                handle, ok = next(decorator_filters)
-                if handle is None:
-                    return {
-                        "status": 405,
-                        "message": "Method Not Allowed: %s" % method,
-                    }
+                handle, ok = next(handles)
                 if ok:
+                    context.timer.lap("filter")
                     res = handle(context)
                 else:
                     res = handle(context, next_handle)
@@ -256,7 +1614,20 @@ class BaseView(object):
                     return await res
                 return res
             context.filter_keys = filter_keys
-            return await next_handle()
+            if not self.db.labeled:
+                return await next_handle()
+            # 查询时隐藏的字段，慢查询日志中同样隐藏
+            token = set_label(self.name, method, plan.label_filter)
+            try:
+                return await next_handle()
+            finally:
+                reset_label(token)
+        except json.JSONDecodeError as e:
+            # 请求体在第一次访问 form_data 时才解析
+            return {
+                "status": 400,
+                "message": "Bad Request: %s" % e,
+            }
         except Exception as e:
             LOGGER.error("view.BaseView.dispatch_request Error", exc_info=e)
             error = str(e)
@@ -265,6 +1636,21 @@ class BaseView(object):
                 "message": "dispatch_request: " + error,
             }
 
+    def key_filter(self, method: str):
+        """
+        method 对应的字段过滤函数
+        """
+        if method in self.cache:
+            return self.cache[method]
+        filter_keys = return_true
+        if self.__filter_keys__ is not None:
+            if isinstance(self.__filter_keys__, list):
+                filter_keys = get_filter_list(*self.__filter_keys__)
+            elif method in self.__filter_keys__:
+                filter_keys = get_filter_list(*self.__filter_keys__[method])
+        self.cache[method] = filter_keys
+        return filter_keys
+
     def generate_filter(self, method, decorator_filter, generate_sql=False):
         """
         把所有的方法都作为中间件处理
@@ -293,4 +1679,5 @@ class BaseView(object):
         return {}, 200
 
     patch = put
+    patch_sql = put_sql
     # options = get
@@ -1,7 +1,7 @@
 import sqlalchemy as sa
 
 
-__all__ = ["User"]
+__all__ = ["User", "Article"]
 
 metadata = sa.MetaData()
 User = sa.Table(
@@ -47,3 +47,29 @@ User = sa.Table(
     ),
     sqlite_autoincrement=True,
 )
+
+Article = sa.Table(
+    'article',
+    metadata,
+    sa.Column(
+        'id',
+        sa.Integer,
+        autoincrement=True,
+        primary_key=True,
+        nullable=False,
+        doc="主键"
+    ),
+    sa.Column(
+        'user_id',
+        sa.Integer,
+        nullable=False,
+        doc="作者"
+    ),
+    sa.Column(
+        'title',
+        sa.String(64),
+        nullable=False,
+        doc="标题"
+    ),
+    sqlite_autoincrement=True,
+)
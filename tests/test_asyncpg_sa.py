@@ -0,0 +1,73 @@
+import pytest
+import sqlalchemy as sa
+
+from .model import User
+from restful_model.utils import (
+    insert_sql,
+    update_sql,
+    select_sql,
+    CachedStatement,
+    return_true,
+)
+
+asyncpg_sa = pytest.importorskip("restful_model.asyncpg_sa")
+
+
+def test_asyncpg_compile():
+    dialect = asyncpg_sa.AsyncpgDialect()
+    compiled = insert_sql(User, {"account": "a"}).compile(dialect=dialect)
+    assert compiled.string == \
+        'INSERT INTO "user" (account) VALUES ($1) RETURNING "user".id'
+    sql = CachedStatement(update_sql(User, {
+        "where": {"id": sa.bindparam("id")},
+        "values": {"account": sa.bindparam("account")},
+    }))
+    compiled = sql.compile(dialect=dialect)
+    assert compiled is sql.compile(dialect=dialect)
+    assert compiled.string == \
+        'UPDATE "user" SET account=$1 WHERE "user".id = $2'
+    assert compiled.positiontup == ["account", "id"]
+
+
+def test_asyncpg_expanding():
+    dialect = asyncpg_sa.AsyncpgDialect()
+    sql = select_sql(User, {
+        "id": {"opt": "$bind", "val": {"opt": "$in", "val": "ids"}},
+        "account": {"opt": "$bind", "val": {"opt": "$nin", "val": "names"}},
+    }, return_true, ["id"])
+    compiled = sql.compile(dialect=dialect)
+    # 展开参数作为一个数组绑定，语句不随列表长度变化
+    assert compiled.string.endswith(
+        'WHERE "user".id = ANY($1) AND "user".account != ALL($2)'
+    )
+    assert asyncpg_sa.bind_args(compiled, {
+        "ids": (1, 2, 3),
+        "names": ["a"],
+    }) == [[1, 2, 3], ["a"]]
+    compiled = User.select().where(User.c.id.in_([1, 2])).compile(
+        dialect=dialect,
+    )
+    assert compiled.string.endswith('WHERE "user".id IN ($1, $2)')
+
+
+def test_asyncpg_result():
+    assert asyncpg_sa.parse_status("INSERT 0 5") == 5
+    assert asyncpg_sa.parse_status("UPDATE 3") == 3
+    assert asyncpg_sa.parse_status("CREATE TABLE") == -1
+    assert asyncpg_sa.distill_params((), {"a": 1}) == [{"a": 1}]
+    assert asyncpg_sa.distill_params(([{"a": 1}, {"a": 2}],), {}) == [
+        {"a": 1},
+        {"a": 2},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_asyncpg_result_proxy():
+    result = asyncpg_sa.ResultProxy([1, 2, 3], ["id"], 3, True)
+    assert result.keys() == ["id"]
+    assert await result.fetchmany(2) == [1, 2]
+    assert await result.fetchone() == 3
+    assert await result.fetchall() == []
+    result = asyncpg_sa.ResultProxy([], ["id"], 0, True)
+    assert result.keys() == ["id"]
+    assert await result.first() is None
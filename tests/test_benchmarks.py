@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+
+from benchmarks import measure, compare, report
+from benchmarks.load import Client, parse_mix, percentile, summary
+
+
+def test_measure():
+    res = measure(lambda: sum(range(100)), repeat=3, min_time=0.001)
+    assert res["repeat"] == 3
+    assert res["loops"] >= 1
+    assert 0 < res["min"] <= res["median"]
+    assert res["peak_bytes"] >= 0
+
+
+def test_measure_async(loop):
+    async def func():
+        await asyncio.sleep(0)
+    res = measure(func, loop, repeat=2, min_time=0.001)
+    assert res["repeat"] == 2
+    assert res["min"] > 0
+
+
+def test_compare():
+    def item(seconds):
+        return {
+            "min": seconds,
+            "median": seconds,
+            "stdev": 0.0,
+            "loops": 1,
+            "repeat": 1,
+            "peak_bytes": 0,
+            "blocks": 0,
+        }
+    baseline = {"results": {"a": item(1.0), "b": item(1.0)}}
+    current = {"results": {"a": item(1.05), "b": item(1.2), "c": item(1.0)}}
+    diff = compare(current, baseline, 0.1)
+    assert diff["a"]["regression"] is False
+    assert diff["b"]["regression"] is True
+    assert "c" not in diff
+    lines, regressions = report(current, diff, 0.1)
+    assert regressions == ["b"]
+    assert lines[-1] == "1 regression(s), threshold 10%"
+    assert lines[2].endswith("(new)")
+
+
+def test_parse_mix():
+    assert parse_mix("get_pk=4, insert,page=0") == [
+        ("get_pk", 4),
+        ("insert", 1),
+    ]
+    with pytest.raises(ValueError):
+        parse_mix("unknown=1")
+    with pytest.raises(ValueError):
+        parse_mix("get_pk=0")
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 99) == 0.0
+    res = summary([0.2, 0.1], 1, 2.0)
+    assert res["requests"] == 2
+    assert res["errors"] == 1
+    assert res["rps"] == 1.0
+    assert res["max"] == 0.2
+
+
+@pytest.mark.asyncio
+async def test_client():
+    async def handle(reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            length = 0
+            while True:
+                header = await reader.readline()
+                if header == b"\r\n":
+                    break
+                if header.lower().startswith(b"content-length:"):
+                    length = int(header.split(b":")[1])
+            body = await reader.readexactly(length)
+            if line.startswith(b"POST"):
+                writer.write(
+                    b"HTTP/1.1 201 Created\r\n"
+                    b"Transfer-Encoding: chunked\r\n\r\n"
+                    b"%x\r\n%s\r\n0\r\n\r\n" % (len(body), body)
+                )
+            else:
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+                )
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    client = Client("127.0.0.1", port)
+    try:
+        assert (200, b"ok") == await client.request("GET", "/user/1")
+        assert (201, b'{"a": 1}') == await client.request(
+            "POST",
+            "/article",
+            {"a": 1},
+        )
+        assert (200, b"ok") == await client.request("GET", "/user/2")
+    finally:
+        client.close()
+        server.close()
+        await server.wait_closed()
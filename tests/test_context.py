@@ -0,0 +1,53 @@
+import json
+import pytest
+
+from restful_model import Context
+from restful_model.context import EMPTY_HEADERS
+
+
+def test_context_from_raw():
+    query = 'where=%7B%22account%22%3A%22a%22%7D&limit=%5B0%2C2%5D&count=none'
+    context = Context.from_raw(
+        "get",
+        "/user",
+        url_param={"id": 1},
+        query_string=query.encode(),
+    )
+    assert context.has_param
+    assert context.header is EMPTY_HEADERS
+    # 访问前不解析
+    assert context._args is None and not context._built
+    assert context.raw_args["count"] == "none"
+    assert context.form_data == {
+        "where": {"account": "a", "id": 1},
+        "limit": [0, 2],
+        "count": "none",
+    }
+    assert context.form_data is context.form_data
+    assert context.where == {"account": "a", "id": 1}
+    assert context.limit == [0, 2]
+    assert context.keys is None
+
+    context = Context.from_raw(
+        "put",
+        body=json.dumps({"values": {"a": 1}}).encode(),
+        url_param={"id": 2},
+    )
+    assert context.form_data == {"values": {"a": 1}, "where": {"id": 2}}
+    context = Context.from_raw("delete", url_param={"id": 2}, body=b"")
+    assert context.form_data == {"id": 2}
+    # GET 忽略请求体，无法解析的查询参数忽略
+    context = Context.from_raw("get", query_string="where=%7B", body=b"{")
+    assert context.form_data == {}
+    assert context.args == {"where": ["{"]}
+    with pytest.raises(AttributeError):
+        context.cache = {}
+
+
+def test_context_args():
+    context = Context("get", args={"order": ['["-id"]'], "stream": ["1"]})
+    assert context.form_data == {"order": ["-id"], "stream": "1"}
+    context = Context("post", args={"order": ['["-id"]']}, form_data={"a": 1})
+    assert context.form_data == {"a": 1}
+    context.form_data = [{"a": 1}]
+    assert context.form_data == [{"a": 1}]
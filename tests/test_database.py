@@ -132,3 +132,98 @@ async def test_execute_sql(data_bese) -> None:
                     user1["account"] = "test6"
                     assert user1 == model_to_dict(await cursor.fetchone())
     await data.drop_table(User)
+
+
+@pytest.mark.asyncio
+async def test_read_replicas(tmp_db, tmp_db_url) -> None:
+    db = await tmp_db(replicas=[tmp_db_url] * 2, read_your_writes=60)
+    replica1, replica2 = db.replicas
+    await db.create_table(User)
+    async with db.acquire_read() as conn:
+        assert replica2.outstanding == 1
+        async with db.acquire_read() as conn2:
+            assert replica1.outstanding == 1
+            await conn2.execute("SELECT 1")
+        await conn.execute("SELECT 1")
+    assert replica1.outstanding == replica2.outstanding == 0
+    db.replica_policy = "least_outstanding"
+    async with db.acquire_read():
+        assert replica1.outstanding == 1
+        async with db.acquire_read():
+            assert replica2.outstanding == 1
+    sessions = {}
+    db.mark_write(sessions)
+    assert db.pinned(sessions)
+    assert db.acquire_read(sessions).replica is None
+    db.eject_replica(replica1, "test")
+    assert db.select_replica() is replica2
+    db.eject_replica(replica2, "test")
+    assert db.acquire_read().replica is None
+    await db.check_replicas()
+    assert replica1.available and replica2.available
+    await db.drop_table(User)
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics(tmp_db) -> None:
+    from restful_model import BaseView, Context
+
+    class UserView(BaseView):
+        __model__ = User
+
+    db = await tmp_db({"minsize": 2}, pool_metrics=True)
+    assert await db.warmup() == 2
+    await db.create_table(User)
+    await UserView(db).raw_dispatch_request(Context("get", "", {}))
+    metrics = db.engine.metrics
+    async with db.engine.acquire():
+        assert len(metrics.leaks(0)) == 1
+        assert "test_pool_metrics" in metrics.leaks(0)[0]["stack"]
+    stats = db.pool_stats()["primary"]
+    assert stats["acquires"] == 5
+    assert stats["in_use"] == 0
+    assert stats["maxsize"] == db.engine.maxsize
+    assert stats["hold"]["user.get"]["count"] == 1
+    assert stats["hold"]["-"]["count"] == 4
+    assert len(stats["longest"]) == 5
+    metrics.reset()
+    assert db.pool_stats()["primary"]["acquires"] == 0
+    await db.drop_table(User)
+
+
+@pytest.mark.asyncio
+async def test_statement_timeout(tmp_db) -> None:
+    import sqlite3
+    db = await tmp_db()
+    sql = (
+        "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) "
+        "SELECT max(x) FROM c"
+    )
+    with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+        async with db.acquire_read(timeout=0.01) as conn:
+            async with conn.execute(sql) as cursor:
+                await cursor.first()
+    # 退出后不再限制
+    async with db.acquire_read() as conn:
+        async with conn.execute("SELECT 1 AS x") as cursor:
+            assert (await cursor.first()).x == 1
+
+
+def test_is_unsupported_function() -> None:
+    import sqlite3
+    from restful_model.database import is_unsupported_function
+    assert is_unsupported_function(
+        sqlite3.OperationalError("no such function: json_group_array"),
+    )
+    assert is_unsupported_function(Exception(
+        "function json_agg(record) does not exist",
+    ))
+    assert is_unsupported_function(Exception(
+        "(1305, 'FUNCTION test.JSON_ARRAYAGG does not exist')",
+    ))
+    assert not is_unsupported_function(
+        sqlite3.OperationalError("interrupted"),
+    )
+    assert not is_unsupported_function(Exception(
+        'database "test" does not exist',
+    ))
@@ -0,0 +1,45 @@
+import pytest
+
+from restful_model.lru_cache import LRUCache, ResultCache
+
+
+def test_lru_cache() -> None:
+    cache = LRUCache(2)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    # b 最久未使用被淘汰
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert tuple(cache.cache_info()) == (3, 1, 2, 2)
+    assert cache.pop("a") == 1
+    assert len(cache) == 1
+    cache.cache_clear()
+    assert tuple(cache.cache_info()) == (0, 0, 2, 0)
+
+
+def test_result_cache() -> None:
+    cache = ResultCache(ttl=60, maxsize=3, maxbytes=10)
+    cache.set("a", 1, b"aaaa")
+    cache.set("b", 1, b"bbbb")
+    assert cache.get("a", 1) == b"aaaa"
+    assert cache.get("a", 2) is None
+    assert "a" not in cache
+    cache.set("a", 2, b"aaaa")
+    cache.set("c", 2, b"cccc")
+    assert "b" not in cache
+    assert cache.nbytes == 8
+    cache.set("d", 2, b"d" * 11)
+    assert "d" not in cache
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (1, 1, 2)
+    assert info.hit_rate == 0.5
+    cache = ResultCache(ttl=0)
+    cache.set("a", 1, b"a")
+    assert cache.get("a", 1) is None
+    assert cache.nbytes == 0
+    with pytest.raises(TypeError):
+        ResultCache(maxsize=0)
@@ -0,0 +1,58 @@
+import pytest
+
+from .model import User
+from restful_model import BaseView, Context
+from restful_model.metrics import Metrics, NULL_TIMER, response_summary
+
+
+def test_metrics_render():
+    metrics = Metrics(buckets=(0.1, 1))
+    timer = metrics.timer("user", "get")
+    timer.laps = [("sql", 0.05), ("execute", 0.5)]
+    timer.finish({"status": 200, "data": [{}, {}]})
+    metrics.timer("user", "get").finish(({}, 404))
+    text = metrics.render()
+    assert 'restful_model_phase_seconds_bucket{view="user",method="get",' \
+        'phase="sql",le="0.1"} 1' in text
+    assert 'restful_model_phase_seconds_bucket{view="user",method="get",' \
+        'phase="execute",le="0.1"} 0' in text
+    assert 'restful_model_phase_seconds_count{view="user",method="get",' \
+        'phase="execute"} 1' in text
+    assert 'restful_model_request_seconds_count{view="user",method="get"} 2' \
+        in text
+    assert 'restful_model_responses_total{view="user",method="get",' \
+        'status="404"} 1' in text
+    assert 'restful_model_rows_total{view="user",method="get"} 2' in text
+    assert response_summary({"status": 201, "meta": {"count": 3}}) == (201, 3)
+    assert response_summary({"status": 200, "data": {}}) == (200, 1)
+
+
+class MetricsView(BaseView):
+    __model__ = User
+    __metrics__ = Metrics()
+
+
+@pytest.mark.asyncio
+async def test_view_metrics(db):
+    if await db.exists_table("user"):
+        await db.drop_table(User)
+    await db.create_table(User)
+    api = MetricsView(db)
+    context = Context("get", "/user", {})
+    await api.dispatch_request(context)
+    assert context.timer is not NULL_TIMER
+    phases = {labels[2] for labels in api.__metrics__.phases.counts}
+    assert phases == {"args", "filter", "sql", "execute", "convert"}
+    context = Context("get", "/user", {})
+    await api.dispatch_request(context, generate_sql=True)
+    assert context.timer is NULL_TIMER
+    # 未知的 method 参数不产生新的标签
+    for i in range(3):
+        context = Context("get", "/user", {}, args={"method": ["x%d" % i]})
+        assert (await api.dispatch_request(context))["status"] == 405
+    methods = {labels[1] for labels in api.__metrics__.responses}
+    assert methods == {"get"}
+    context = Context("get", "/user", {}, args={"method": ["delete"]})
+    await api.dispatch_request(context)
+    assert ("user", "delete", 200) in api.__metrics__.responses
+    await db.drop_table(User)
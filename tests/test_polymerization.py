@@ -0,0 +1,262 @@
+import pytest
+
+from .model import User, Article
+from restful_model import BaseView, BasePolymerization, Context
+from restful_model.polymerization import insert_plan
+
+
+class UserView(BaseView):
+    __model__ = User
+
+
+class ArticleView(BaseView):
+    __model__ = Article
+
+
+def build_user(account: str):
+    return {
+        "account": account,
+        "email": "%s@test.com" % account,
+        "role_name": account,
+        "password": "123456",
+        "create_time": 0,
+    }
+
+
+def test_insert_plan():
+    items = [
+        ("article", {"user_id": "$user.id", "title": "a"}),
+        ("user", build_user("test1")),
+        ("article", {"user_id": "$user.id", "title": "b"}),
+        ("article", {"user_id": "$user.0.id", "title": "c"}),
+        ("article", {"user_id": 1, "title": "$not.ref"}),
+        ("user", build_user("test2")),
+        ("article", {"user_id": 2, "title": "d"}),
+    ]
+    groups, deps = insert_plan(items)
+    # 按列表顺序，只合并相邻的项
+    assert groups == [[0], [1], [2, 3, 4], [5], [6]]
+    # 只引用前面的项
+    assert deps[0] == {}
+    assert deps[2] == deps[3] == {"user": 1}
+    assert deps[4] == {}
+    # 引用组内前面的项时另起一组
+    items = [("user", build_user("u0"))] + [
+        ("user", dict(build_user("u"), role_name="$user.account"))
+        for _ in range(3000)
+    ]
+    groups, deps = insert_plan(items)
+    assert len(groups) == 3001
+    assert deps[3000] == {"user": 2999}
+
+
+@pytest.mark.asyncio
+async def test_polymerization_post(db):
+    for table in (User, Article):
+        if await db.exists_table(table.name):
+            await db.drop_table(table)
+        await db.create_table(table)
+    polymerization = BasePolymerization(db)
+    polymerization.add_view(UserView(db))
+    polymerization.add_view(ArticleView(db))
+    form_data = [{"name": "user", "data": build_user("test1")}]
+    form_data.extend(
+        {"name": "article", "data": {"user_id": "$user.id", "title": str(i)}}
+        for i in range(5)
+    )
+    form_data.append({"name": "user", "data": build_user("test2")})
+    form_data.append({"name": "unknown", "data": {}})
+    context = Context("post", "", {}, form_data=form_data)
+    assert {
+        "status": 201,
+        "message": "Inserts Ok!",
+        "meta": {"count": 7}
+    } == await polymerization.dispatch_request(context)
+    assert form_data[-2]["data"]["id"] == 2
+    assert [1, 2, 3, 4, 5] == [
+        item["data"]["id"] for item in form_data[1:6]
+    ]
+    query_context = Context("get", "", {})
+    res = await ArticleView(db).raw_dispatch_request(query_context)
+    assert [(i + 1, 1) for i in range(5)] == [
+        (row["id"], row["user_id"]) for row in res["data"]
+    ]
+    form_data = [
+        {"name": "user", "data": dict(
+            build_user("test3"),
+            role_name="$article.title",
+        )},
+        {"name": "article", "data": {"user_id": "$user.id", "title": "a"}},
+    ]
+    context = Context("post", "", {}, form_data=form_data)
+    res = await polymerization.dispatch_request(context)
+    # 引用后面的项时不替换，与逐项插入一致
+    assert res["status"] == 201
+    assert form_data[0]["data"]["role_name"] == "$article.title"
+    assert form_data[1]["data"]["user_id"] == form_data[0]["data"]["id"]
+    await db.drop_table(User)
+    await db.drop_table(Article)
+
+
+@pytest.mark.asyncio
+async def test_polymerization_version(db):
+    await db.create_table(User)
+    polymerization = BasePolymerization(db)
+    polymerization.add_view(UserView(db))
+    version = db.table_version("user")
+    form_data = [{"name": "user", "data": build_user("test1")}]
+    context = Context("post", "", {}, form_data=form_data)
+    await polymerization.dispatch_request(context)
+    assert db.table_version("user") == version + 1
+    form_data = [{"name": "user", "data": {"id": 1}}]
+    context = Context("delete", "", {}, form_data=form_data)
+    res = await polymerization.dispatch_request(context)
+    assert res["meta"]["count"] == 1
+    assert db.table_version("user") == version + 2
+    await db.drop_table(User)
+
+
+class AuthArticleView(ArticleView):
+    def __init__(self, db):
+        super().__init__(db)
+        self.seen = []
+
+    async def auth_filter(self, context: Context, next_handle):
+        self.seen.append(context.form_data)
+        if isinstance(context.form_data, dict):
+            context.form_data["title"] = "auth " + context.form_data["title"]
+        return await next_handle()
+
+
+@pytest.mark.asyncio
+async def test_polymerization_auth_filter(db):
+    for table in (User, Article):
+        if await db.exists_table(table.name):
+            await db.drop_table(table)
+        await db.create_table(table)
+    polymerization = BasePolymerization(db)
+    article_view = AuthArticleView(db)
+    polymerization.add_view(UserView(db))
+    polymerization.add_view(article_view)
+    form_data = [{"name": "user", "data": build_user("test1")}]
+    form_data.extend(
+        {"name": "article", "data": {"user_id": "$user.id", "title": str(i)}}
+        for i in range(3)
+    )
+    context = Context("post", "", {}, form_data=form_data)
+    res = await polymerization.dispatch_request(context)
+    assert res["status"] == 201
+    # 有 auth_filter 时不合并，每项单独经过过滤器
+    assert len(article_view.seen) == 3
+    assert all(isinstance(data, dict) for data in article_view.seen)
+    res = await ArticleView(db).raw_dispatch_request(Context("get", "", {}))
+    assert ["auth 0", "auth 1", "auth 2"] == [
+        row["title"] for row in res["data"]
+    ]
+    await db.drop_table(User)
+    await db.drop_table(Article)
+
+
+@pytest.mark.asyncio
+async def test_polymerization_get(tmp_db):
+    import asyncio
+
+    class HiddenUserView(UserView):
+        __filter_keys__ = {"get": (["password"],)}
+
+    class CountArticleView(ArticleView):
+        def __init__(self, db):
+            super().__init__(db)
+            self.running = 0
+            self.max_running = 0
+            self.conns = []
+
+        async def get_filter(self, context: Context, next_handle):
+            self.conns.append(self.db.snapshot_conn())
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            try:
+                await asyncio.sleep(0.01)
+                return await next_handle()
+            finally:
+                self.running -= 1
+
+    db = await tmp_db()
+    for table in (User, Article):
+        await db.create_table(table)
+    polymerization = BasePolymerization(db)
+    polymerization.__get_parallel__ = 2
+    article_view = CountArticleView(db)
+    polymerization.add_view(HiddenUserView(db))
+    polymerization.add_view(article_view)
+    form_data = [{"name": "user", "data": build_user("test1")}]
+    form_data.extend(
+        {"name": "article", "data": {"user_id": "$user.id", "title": str(i)}}
+        for i in range(3)
+    )
+    res = await polymerization.dispatch_request(
+        Context("post", "", {}, form_data=form_data),
+    )
+    assert res["status"] == 201
+
+    queries = [{"name": "user", "data": {}}]
+    queries.extend(
+        {"name": "article", "data": {"where": {"title": str(i)}}}
+        for i in range(3)
+    )
+    queries.append({"name": "unknown", "data": {}})
+    res = await polymerization.dispatch_request(
+        Context("get", "", {}, form_data=queries),
+    )
+    assert res["status"] == 200
+    data = res["data"]
+    assert data[0]["status"] == 200
+    assert "password" not in data[0]["data"][0]
+    assert [item["data"][0]["title"] for item in data[1:4]] == [
+        "0", "1", "2",
+    ]
+    assert data[4]["status"] == 404
+    # 每个查询经过 view 的过滤器，同时最多 __get_parallel__ 个
+    assert article_view.max_running == 2
+    assert article_view.conns == [None] * 3
+
+    article_view.max_running = 0
+    article_view.conns = []
+    res = await polymerization.dispatch_request(Context(
+        "get",
+        "",
+        {},
+        form_data={
+            "users": {"name": "user", "data": {"limit": [0, 1]}},
+            "first": {"name": "article", "data": {"limit": [0, 2]}},
+            "last": {"name": "article", "data": {"order": ["-id"]}},
+        },
+        args={"snapshot": ["1"]},
+    ))
+    data = res["data"]
+    assert data["users"]["meta"]["pagination"]["total"] == 1
+    assert [row["id"] for row in data["first"]["data"]] == [1, 2]
+    assert data["last"]["data"][0]["id"] == 3
+    # 快照事务中依次执行，使用同一个连接
+    assert article_view.max_running == 1
+    assert article_view.conns[0] is not None
+    assert article_view.conns[0] is article_view.conns[1]
+    assert db.snapshot_conn() is None
+    # 查询数超出上限
+    polymerization.__get_max_queries__ = 4
+    res = await polymerization.dispatch_request(
+        Context("get", "", {}, form_data=queries),
+    )
+    assert res == {
+        "status": 400,
+        "message": "polymerization get: queries 5 exceeds the limit 4",
+    }
+
+
+@pytest.mark.asyncio
+async def test_polymerization_bad_body(db):
+    polymerization = BasePolymerization(db)
+    polymerization.add_view(UserView(db))
+    context = Context.from_raw("post", body=b"[{")
+    res = await polymerization.dispatch_request(context)
+    assert res["status"] == 400
@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+
+from restful_model import Context
+from restful_model.single_flight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_single_flight() -> None:
+    flight = SingleFlight()
+    calls = []
+    release = asyncio.Event()
+
+    async def query():
+        calls.append(1)
+        await release.wait()
+        return {"status": 200}
+
+    tasks = [
+        asyncio.ensure_future(flight.do("a", query))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0)
+    assert len(flight) == 1
+    release.set()
+    res = await asyncio.gather(*tasks)
+    assert [shared for _, shared in res] == [False, True, True]
+    assert len(calls) == 1
+    assert len(flight) == 0
+    assert (flight.calls, flight.shared) == (1, 2)
+    # 完成后重新执行
+    await flight.do("a", query)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_single_flight_cancel() -> None:
+    flight = SingleFlight()
+    release = asyncio.Event()
+    cancelled = []
+
+    async def query():
+        try:
+            await release.wait()
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+        return 1
+
+    leader = asyncio.ensure_future(flight.do("a", query))
+    follower = asyncio.ensure_future(flight.do("a", query))
+    await asyncio.sleep(0)
+    # 发起请求的客户端断开，其他等待者仍然得到结果
+    leader.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await follower == (1, True)
+    assert leader.cancelled()
+    assert not cancelled
+
+    # 所有等待者都取消时取消执行
+    release.clear()
+    task = asyncio.ensure_future(flight.do("b", query))
+    await asyncio.sleep(0)
+    task.cancel()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert cancelled == [1]
+    assert len(flight) == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_error() -> None:
+    flight = SingleFlight()
+
+    async def query():
+        await asyncio.sleep(0)
+        raise ValueError("error")
+
+    tasks = [
+        asyncio.ensure_future(flight.do("a", query))
+        for _ in range(2)
+    ]
+    res = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(e, ValueError) for e in res)
+    assert len(flight) == 0
+
+
+def test_context_fingerprint() -> None:
+    c1 = Context("get", "", {}, form_data={"where": {"id": 1, "a": 2}})
+    c2 = Context("get", "", {}, form_data={"where": {"a": 2, "id": 1}})
+    assert c1.fingerprint() == c2.fingerprint()
+    # 与进程无关的固定值
+    assert c1.fingerprint() == "a46ebd589dd7dc2d2f4ccdeff7e6a8ab1bbf2646"
+    assert c1.fingerprint("user") != c1.fingerprint("article")
+    c3 = Context("get", "", {}, form_data={"where": {"id": 2, "a": 2}})
+    assert c1.fingerprint() != c3.fingerprint()
+    assert repr(c1) == "<Context %s>" % c1.fingerprint()
@@ -0,0 +1,78 @@
+import pytest
+
+from .model import User
+from restful_model import BaseView, Context
+from restful_model.slow_query import SlowQueryLog, bind_columns, format_plan
+
+
+def test_bind_columns():
+    sql = User.select().where(User.c.password == "x").where(
+        User.c.id.in_([1, 2])
+    )
+    assert sorted(bind_columns(sql).values()) == ["id", "id", "password"]
+    assert format_plan([(2, 0, 0, "SCAN user")]) == "SCAN user"
+    assert format_plan([("a", 1, None)]) == "a | 1 | None"
+
+
+def test_rate_limit():
+    log = SlowQueryLog(limit=2, period=60)
+    assert log.allow()
+    assert log.allow()
+    assert not log.allow()
+    log._window_start -= 61
+    assert log.allow()
+    assert not SlowQueryLog(sample_rate=0.0).allow()
+
+
+@pytest.mark.asyncio
+async def test_slow_query(tmp_db) -> None:
+    class UserView(BaseView):
+        __model__ = User
+        __filter_keys__ = {"get": ({"email"},)}
+
+    log = SlowQueryLog(threshold=0, limit=3)
+    db = await tmp_db(slow_query=log)
+    assert db.labeled
+    await db.create_table(User)
+    context = Context("put", "", {}, form_data={
+        "where": {
+            "password": "secret",
+            "email": "a@test.com",
+            "account": "test",
+        },
+        "values": {"role_name": "test2"},
+    })
+    resp = await UserView(db).dispatch_request(context)
+    assert resp["status"] == 201
+    await log.wait()
+    entry = log.entries[-1]
+    assert entry["label"] == "user.put"
+    assert entry["sql"].startswith("UPDATE")
+    assert sorted(entry["params"].values(), key=str) == [
+        "***",
+        "***",
+        "test",
+        "test2",
+    ]
+    assert "user" in entry["plan"]
+    assert "_args" not in entry
+    # 限流: 建表和查询已用掉 2 条，第 4 条开始丢弃
+    await db.drop_table(User)
+    await db.create_table(User)
+    assert log.slow == 4
+    assert log.dropped == 1
+    assert entry["error"] is None
+    # 执行失败的语句也记录
+    log._window_start -= 61
+    async with db.engine.acquire() as conn:
+        with pytest.raises(Exception):
+            await conn.execute("SELECT * FROM missing")
+        with pytest.raises(Exception):
+            async with conn.execute("SELECT * FROM missing"):
+                pass
+    await log.wait()
+    assert log.slow == 6
+    assert [e["sql"] for e in list(log.entries)[-2:]] == [
+        "SELECT * FROM missing",
+    ] * 2
+    assert "missing" in log.entries[-1]["error"]
@@ -5,6 +5,15 @@ from restful_model.utils import (
     handle_param,
     handle_param_desc,
     handle_where_param,
+    lift_where_param,
+    CachedStatement,
+    index_columns,
+    index_guard,
+    where_cost,
+    count_funcs,
+    get_header,
+    etag_match,
+    return_true,
     insert_sql,
     delete_sql,
     select_sql,
@@ -854,3 +863,125 @@ def test_update_incr():
         sql,
         User.update().values({"account": User.c.account + 1, "email": 1})
     )
+
+
+def test_lift_where_param():
+    params = {}
+    where = {
+        "id": {"opt": "$in", "val": [1, 2]},
+        "$or": {"account": "test", "email": None},
+    }
+    shape, lifted = lift_where_param(User.c, where, params)
+    assert params == {"_p0": 1, "_p1": 2, "_p2": "test"}
+    params2 = {}
+    where["id"]["val"] = [3, 4]
+    where["$or"]["account"] = "test2"
+    shape2, _ = lift_where_param(User.c, where, params2)
+    assert shape == shape2
+    assert params2 == {"_p0": 3, "_p1": 4, "_p2": "test2"}
+    where["id"]["val"] = [3]
+    assert lift_where_param(User.c, where, {})[0] != shape
+    assert lift_where_param(
+        User.c,
+        {"id": {"opt": "$raw", "val": User.c.id > 1}},
+        {},
+    )[0] is None
+
+    sql = CachedStatement(select_sql(User, lifted))
+    compiled = sql.compile(dialect=dialect)
+    assert compiled is sql.compile(dialect=dialect)
+    assert compiled.statement is sql.statement
+    assert compiled.construct_params(params2)["_p2"] == "test2"
+    assert str(compiled) == str(select_sql(User, {
+        "id": {"opt": "$in", "val": [bindparam("_p0"), bindparam("_p1")]},
+        "$or": {"account": bindparam("_p2"), "email": None},
+    }).compile(dialect=dialect))
+    # 语句本身不变，由它生成的新语句重新编译
+    base = CachedStatement(select_sql(User, None))
+    base.compile(dialect=dialect)
+    assert "compile" not in base.statement.__dict__
+    assert "WHERE" in str(
+        base.statement.where(User.c.id == 1).compile(dialect=dialect)
+    )
+    assert "LIMIT" in str(base.statement.limit(1).compile(dialect=dialect))
+
+
+def test_index_guard():
+    table = sa.Table(
+        "guard",
+        sa.MetaData(),
+        sa.Column("id", sa.Integer, primary_key=True),
+        sa.Column("account", sa.String(16), unique=True),
+        sa.Column("user_id", sa.Integer),
+        sa.Column("title", sa.String(64)),
+        sa.Column("email", sa.String(64)),
+        sa.Index("ix_user_title", "user_id", "title"),
+    )
+    indexed = index_columns(table)
+    assert indexed == {"id", "account", "user_id"}
+
+    def guard(where=None, orders=None, filter_list=return_true):
+        return index_guard(table, indexed, where, orders, filter_list)
+    # 没有条件和排序即全表扫描
+    assert "where (no condition)" in guard()
+    assert "where (no condition)" in guard({}, ["nothing"])
+    assert guard({"account": "test"}) is None
+    assert guard({"user_id": {"opt": "$gt", "val": 1}, "email": "a"}) is None
+    assert guard({"account": {"opt": "$like", "val": "te%"}}) is None
+    assert guard(orders=["-user_id"]) is None
+    assert guard({"id": 1}, ["email"]) is None
+    assert guard({"$or": {"id": 1, "account": "test"}}) is None
+    message = guard({"email": "a"})
+    assert message.startswith("Query needs an index on guard: email")
+    assert "account, id, user_id" in message
+    assert "$like leading wildcard" in guard(
+        {"account": {"opt": "$like", "val": "%test"}}
+    )
+    assert "$ne" in guard({"id": {"opt": "$ne", "val": 1}})
+    assert "email" in guard({"$or": {"id": 1, "email": "a"}})
+    assert "order not indexed" in guard(orders=["-title"])
+    # 被过滤的字段不生成条件
+    assert "no condition" in guard(
+        {"email": "a"},
+        filter_list=lambda key: key != "email",
+    )
+    assert guard(
+        {"email": "a", "id": 1},
+        filter_list=lambda key: key != "email",
+    ) is None
+
+
+def test_where_cost():
+    columns = User.columns
+    assert where_cost(columns, None) == (0, 1, 0)
+    assert where_cost(columns, {"id": 1, "account": "a"}) == (2, 1, 0)
+    assert where_cost(columns, {
+        "id": [
+            {"opt": "$gt", "val": 1},
+            {"opt": "$in", "val": [1, 2, 3]},
+        ],
+        "$or": {
+            "account": "a",
+            "$and": {"email": {"opt": "$nin", "val": [1, 2, 3, 4]}},
+        },
+        "unknown": 1,
+    }) == (4, 3, 4)
+    assert count_funcs(None) == 0
+    assert count_funcs([
+        "id",
+        'lower("$account",):account',
+        {"func": "count", "args": ["$id"]},
+        {"name": "email"},
+    ]) == 2
+
+
+def test_etag_match():
+    assert get_header(None, "If-None-Match") is None
+    assert get_header({"if-none-match": '"a"'}, "If-None-Match") == '"a"'
+    assert get_header({"If-None-Match": ['"a"', '"b"']}, "If-None-Match") \
+        == '"a", "b"'
+    assert etag_match('"a"', 'W/"a"')
+    assert etag_match('W/"b", W/"a"', 'W/"a"')
+    assert etag_match("*", 'W/"a"')
+    assert not etag_match('"b"', 'W/"a"')
+    assert not etag_match(None, 'W/"a"')